@@ -4,85 +4,156 @@ dataframe and create text embedding of the email content
 """
 
 from microsoft_graph_outlook import MSGraphOutlook
+from email_archive import EmailArchive
+from preprocessing import preprocess_emails
+from deduplication import deduplicate
+from embedding_cache import EmbeddingCache
+from embedding_providers import get_provider
+from embedding_providers import save_provider
+from embedding_providers import word_tokenizer
 from helper_functions import *
 import ast
+import os
 import pandas as pd
-import nltk
-
-#initiate MS graph outlook API
-graph = MSGraphOutlook()
-graph_client = graph.start_graph_client()
-graph_client.login()
-
-#download all emails from outlook
-email_content = graph.get_emails_all(graph_client)
-
-#get only relevant information needed and put in a dataframe
-email_content_processed = []
-
-for i in range(len(email_content)):
-    
-    temp = graph.extract_email_info(email_content[i])
-    email_content_processed.append(temp)
-    
-df = pd.DataFrame()
-df['email_messages'] =  [x['message'] for x in email_content_processed ]
-df['sender'] =  [x['sender_name'] for x in email_content_processed ]
-df['sender_email'] =  [x['sender_email'] for x in email_content_processed ]
-df['sent_date'] = [x['sent_date'] for x in email_content_processed ]
-df['sent_date'] = pd.to_datetime(df['sent_date']).dt.date
-df['subject'] =  [x['subject'] for x in email_content_processed ]
-df['recipients'] =  [x['to_names'] for x in email_content_processed ]
-df['recipients_email'] =  [x['to_email_address'] for x in email_content_processed ]
-df['email_weblink'] = [x['email_weblink'] for x in email_content_processed ]
-
-
-#testing, 
-#test = df.head(100)
-#test2 = df[~df['email_weblink'].isin(test['email_weblink'])]
-
-#process the emails
-df['email_messages'] = df['email_messages'].apply(lambda x : normalize_text(x))
-
-# count number of words in emails and only keep emails that have >5 words
-df['tokens'] = df['email_messages'].apply(lambda x :len(nltk.word_tokenize(x)))
-df = df[(df['tokens']>5)]
-df = df.sort_values(by=['tokens'])
-df = df.reset_index()
-
-# Chunk up the email messages into chunks of 4000 words
-df['chunked'] = df['email_messages'].apply(chunk_string)
-df['chunked'] = df['chunked'].apply(str).apply(ast.literal_eval)
-
-#get the embeddings for the email messages
-n_chunks = max(df['chunked'].apply(lambda x: len(x)))
-embeddings = [[] for _ in range(n_chunks)]
-embeddings_index = [[] for _ in range(n_chunks)]
-
-for i in range(len(df)):
-    for j in range(len(df['chunked'][i])):
-       temp = generate_embeddings (df['chunked'][i][j])
-       embeddings[j].append(temp)
-       embeddings_index[j].append(i)
-
-#merge all embeddings to dataframe
-for i in range(n_chunks):
-    temp =  pd.DataFrame(columns= ['embeddings_' + str(i)])
-    temp['embeddings_' + str(i)] = embeddings[i]
-    temp.index = embeddings_index[i]
-
-    df = pd.merge(df, temp, how = 'left', left_index=True, right_index=True)
+
+#set to False to rerun the processing on the emails already in the raw email
+#archive, e.g. after changing the cleaning or chunking, without fetching them
+#from outlook again
+REFETCH = True
+
+#set to True to list every email in outlook again instead of only the changes
+#since the last run, e.g. if the archive was edited by hand. The emails no longer
+#in outlook are removed from the archive
+FULL_RESYNC = False
+
+#the deltaLink of each synced folder, see MSGraphOutlook.sync_emails
+DELTA_PATH = 'configs/ms_graph_delta.json'
+
+#set to True to also embed only once the chunks that are nearly the same, e.g.
+#alerts made from one template, and give them all the same embedding
+NEAR_DUPLICATES = False
+
+#the model the emails are embedded with, see embedding_providers.get_provider,
+#e.g. {'provider': 'sentence-transformers', 'model': 'all-MiniLM-L6-v2'} to
+#embed on the local CPU. It is saved with the index, so the queries are
+#embedded with the same model
+EMBEDDING_PROVIDER = {'provider': 'azure', 'model': 'text_embedding-ada-002-default'}
+
+#the preprocessing workers import this script on Windows, so the script only
+#runs when started directly
+if __name__ == '__main__':
+
+    graph = MSGraphOutlook()
+    archive = EmailArchive('data/email_archive')
+
+    if REFETCH:
+        #initiate MS graph outlook API
+        graph_client = graph.start_graph_client()
+        graph_client.login()
+
+        #without the saved deltaLinks every folder is listed in full again
+        if FULL_RESYNC and os.path.exists(DELTA_PATH):
+            os.remove(DELTA_PATH)
+
+        #sync the folders one at a time through the delta query. The first sync of
+        #a folder returns all its emails, later runs only the emails added,
+        #updated or removed since the previous run, so only one folder's changes
+        #are held in memory at once. Emails already archived with the same
+        #changeKey are not written again. Bodies are requested as text so they
+        #need no html conversion
+        synced_ids = set()
+        removed_ids = set()
+
+        for folder in graph.get_folder_tree(graph_client).values():
+            changes = graph.sync_emails(graph_client, folder_id = folder['id'],
+                                        delta_path = DELTA_PATH, body_type = 'text')
+            archive.add(changes['added_updated'])
+            synced_ids.update(x['id'] for x in changes['added_updated'])
+            removed_ids.update(changes['removed'])
+
+        #an email moved to another folder is removed from the old folder and
+        #added to the new one, so only the ids not added back are removed
+        if FULL_RESYNC:
+            removed_ids.update(archive.ids())
+        archive.remove([x for x in removed_ids if x not in synced_ids])
+
+    #replay the raw emails from the archive, get only relevant information needed
+    #and normalize the email messages, across all cores
+    email_content_processed = list(preprocess_emails(archive.iter_emails()))
+
+    df = pd.DataFrame()
+    df['email_messages'] =  [x['message'] for x in email_content_processed ]
+    df['sender'] =  [x['sender_name'] for x in email_content_processed ]
+    df['sender_email'] =  [x['sender_email'] for x in email_content_processed ]
+    df['sent_date'] = [x['sent_date'] for x in email_content_processed ]
+    df['sent_date'] = pd.to_datetime(df['sent_date']).dt.date
+    df['subject'] =  [x['subject'] for x in email_content_processed ]
+    df['recipients'] =  [x['to_names'] for x in email_content_processed ]
+    df['recipients_email'] =  [x['to_email_address'] for x in email_content_processed ]
+    df['email_weblink'] = [x['email_weblink'] for x in email_content_processed ]
+    df['conversation_id'] = [x['conversation_id'] for x in email_content_processed ]
+
+
+    #testing, 
+    #test = df.head(100)
+    #test2 = df[~df['email_weblink'].isin(test['email_weblink'])]
+
+    # count number of words in emails and only keep emails that have >5 words
+    df['tokens'] = df['email_messages'].apply(lambda x :len(word_tokenizer.encode(x)))
+    df = df[(df['tokens']>5)]
+    df = df.sort_values(by=['tokens'])
+    df = df.reset_index()
+
+    # Chunk up the email messages into chunks of at most as many tokens as the
+    # embedding model takes, counted with its tokenizer, snapped to sentence
+    # boundaries
+    provider = get_provider(EMBEDDING_PROVIDER)
+    max_tokens = provider.max_tokens
+    tokenizer = provider.tokenizer
+    df['chunked'] = df['email_messages'].apply(
+        lambda x : list(chunk_text(x, max_tokens, min(200, max_tokens // 10), tokenizer = tokenizer)))
+    df['chunked'] = df['chunked'].apply(str).apply(ast.literal_eval)
+
+    #get the embeddings for the email messages
+    n_chunks = max(df['chunked'].apply(lambda x: len(x)))
+    embeddings = [[] for _ in range(n_chunks)]
+    embeddings_index = [[] for _ in range(n_chunks)]
+
+    #embed every distinct chunk once and give its embedding to every chunk with
+    #the same text, e.g. the copies of an email in Sent Items and Inbox
+    unique_chunks, unique_index = deduplicate([x for chunks in df['chunked'] for x in chunks],
+                                              near_duplicates = NEAR_DUPLICATES)
+    #chunks embedded by an earlier run are taken from the embedding cache
+    with EmbeddingCache('data/embedding_cache.sqlite') as cache:
+        unique_embeddings = provider.embed(unique_chunks, cache = cache)
+        print(cache.stats())
+    print(embedding_scheduler.report())
+
+    n = 0
+    for i in range(len(df)):
+        for j in range(len(df['chunked'][i])):
+           embeddings[j].append(unique_embeddings[unique_index[n]])
+           embeddings_index[j].append(i)
+           n = n + 1
+
+    #merge all embeddings to dataframe
+    for i in range(n_chunks):
+        temp =  pd.DataFrame(columns= ['embeddings_' + str(i)])
+        temp['embeddings_' + str(i)] = embeddings[i]
+        temp.index = embeddings_index[i]
+
+        df = pd.merge(df, temp, how = 'left', left_index=True, right_index=True)
       
-#get long format of dataframe
-embedding_columns = df.filter(like='embedding').columns
-df_long = pd.melt(df, id_vars = ['index','email_messages', 'sender', 'sender_email', 'sent_date', 'subject','recipients', 'recipients_email', 'email_weblink'],
-                  value_vars = embedding_columns ,
-                  var_name = 'embedding',
-                  value_name = 'embedding_values'
-                  )
-df_long = df_long[~df_long['embedding_values'].isnull()]
-
-#save datasets
-df.to_csv('data/df.csv', index = False)
-df_long.to_csv('data/df_long.csv', index = False)
-  
\ No newline at end of file
+    #get long format of dataframe
+    embedding_columns = df.filter(like='embedding').columns
+    df_long = pd.melt(df, id_vars = ['index','email_messages', 'sender', 'sender_email', 'sent_date', 'subject','recipients', 'recipients_email', 'email_weblink', 'conversation_id'],
+                      value_vars = embedding_columns ,
+                      var_name = 'embedding',
+                      value_name = 'embedding_values'
+                      )
+    df_long = df_long[~df_long['embedding_values'].isnull()]
+
+    #save datasets
+    df.to_csv('data/df.csv', index = False)
+    df_long.to_csv('data/df_long.csv', index = False)
+    save_provider(provider, 'data/embedding_provider.json')
@@ -5,6 +5,8 @@ emails that are highly similar to the query from the email database
 
 
 from helper_functions import *
+from embedding_providers import load_provider
+from query_cache import QueryCache
 import ast
 import pandas as pd
 
@@ -13,10 +15,16 @@ df = pd.read_csv('data/df.csv')
 df_long = pd.read_csv('data/df_long.csv')
 df_long['embedding_values'] = df_long['embedding_values'].apply(lambda s: list(ast.literal_eval(s)))
 
+#the queries are embedded with the model the emails were embedded with
+provider = load_provider('data/embedding_provider.json')
+
+#queries asked again, also in a later session, do not call the models again
+query_cache = QueryCache(path = 'data/query_cache.jsonl')
+
 #extract top N emails that are related to the query
-see = find_email('which email by wei fong is about openai coding?', 5, df, df_long, advance_filter = "Y")
-see = find_email('which is the email from kohei where he approved uat for lan wan ip extension?', 5, df, df_long, advance_filter = "Y")
-see = find_email("martin's farewell", 5, df, df_long)
+see = find_email('which email by wei fong is about openai coding?', 5, df, df_long, advance_filter = "Y", provider = provider, query_cache = query_cache)
+see = find_email('which is the email from kohei where he approved uat for lan wan ip extension?', 5, df, df_long, advance_filter = "Y", provider = provider, query_cache = query_cache)
+see = find_email("martin's farewell", 5, df, df_long, provider = provider, query_cache = query_cache)
 
 
 NER = get_NER(labels, 'which email by wei fong is about openai coding?')
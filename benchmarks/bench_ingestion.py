@@ -0,0 +1,169 @@
+"""
+This script benchmarks fetching emails against a local fake Microsoft Graph
+server, so that changes to the fetch path can be measured without a tenant.
+It reports the messages per second of get_emails_all, iter_emails,
+sync_emails, the asyncio get_emails_all and the ingestion script.
+
+Example:
+    python benchmarks/bench_ingestion.py --messages 5000 --latency 0.05 --throttle-rate 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import runpy
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ms_graph.async_session_GBNOC import AsyncGraphSession
+from ms_graph.fake_server_GBNOC import FakeGraphServer
+from ms_graph.fake_server_GBNOC import FakeMailbox
+from ms_graph.retry_GBNOC import TokenBucket
+from microsoft_graph_outlook import AsyncMSGraphOutlook
+from microsoft_graph_outlook import MSGraphOutlook
+
+SCENARIOS = ['get_emails_all', 'iter_emails', 'sync_emails', 'async_get_emails_all', 'ingestion']
+
+
+def run_scenario(name, server, workers, rate):
+    """
+    Runs one scenario against the server, returns the number of emails
+    fetched and the session the requests went through
+    """
+
+    graph = MSGraphOutlook()
+    graph_client = server.client(rate_limiter=TokenBucket(rate=rate))
+
+    if name == 'get_emails_all':
+        count = len(graph.get_emails_all(graph_client, max_workers=workers, body_type='text'))
+        return count, graph_client.graph_session
+
+    if name == 'iter_emails':
+        count = sum(1 for _ in graph.iter_emails(graph_client, body_type='text'))
+        return count, graph_client.graph_session
+
+    if name == 'sync_emails':
+        directory = tempfile.mkdtemp()
+        try:
+            result = graph.sync_emails(graph_client, delta_path=os.path.join(directory, 'delta.json'),
+                                       body_type='text')
+        finally:
+            shutil.rmtree(directory)
+        return len(result['added_updated']), graph_client.graph_session
+
+    if name == 'async_get_emails_all':
+        async def fetch():
+            async with AsyncGraphSession(graph_client, max_concurrency=workers,
+                                         rate_limiter=TokenBucket(rate=rate)) as graph_session:
+                emails = await AsyncMSGraphOutlook().get_emails_all(graph_session, body_type='text')
+                return len(emails), graph_session
+        return asyncio.run(fetch())
+
+    if name == 'ingestion':
+        return run_ingestion(graph_client), graph_client.graph_session
+
+    raise ValueError(f'Unknown scenario "{name}"')
+
+
+def run_ingestion(graph_client):
+    """
+    Runs "1. text_embedding.py" end to end against the fake server, in a
+    temporary directory and with the hashing embedder in place of the Azure
+    OpenAI deployment, so that only the local processing is measured
+    """
+
+    import embedding_providers
+    import helper_functions
+    from embedding_providers import HashingEmbeddingProvider
+
+    original_start = MSGraphOutlook.start_graph_client
+    original_embeddings = helper_functions.generate_embeddings
+    original_get_provider = embedding_providers.get_provider
+    original_directory = os.getcwd()
+    directory = tempfile.mkdtemp()
+
+    MSGraphOutlook.start_graph_client = lambda self: graph_client
+    helper_functions.generate_embeddings = lambda text, *args, **kwargs: HashingEmbeddingProvider().embed_query(text)
+    embedding_providers.get_provider = lambda config: HashingEmbeddingProvider()
+
+    try:
+        os.makedirs(os.path.join(directory, 'data'))
+        os.chdir(directory)
+        runpy.run_path(os.path.join(ROOT, '1. text_embedding.py'), run_name='__main__')
+        with open(os.path.join(directory, 'data', 'df.csv'), 'r', encoding='utf-8') as file:
+            #rows of emails kept by the script, the header line excluded
+            count = sum(1 for _ in file) - 1
+    finally:
+        os.chdir(original_directory)
+        shutil.rmtree(directory)
+        MSGraphOutlook.start_graph_client = original_start
+        helper_functions.generate_embeddings = original_embeddings
+        embedding_providers.get_provider = original_get_provider
+
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark fetching emails against a fake Microsoft Graph server')
+    parser.add_argument('--messages', type=int, default=5000, help='number of emails in the mailbox')
+    parser.add_argument('--body-words', type=int, default=200, help='number of words per email body')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of a 429, in seconds')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4], help='concurrent requests to try')
+    parser.add_argument('--rate', type=float, default=16, help='client side requests per second')
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS[:-1], choices=SCENARIOS)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario, the fastest is reported')
+    parser.add_argument('--metrics', action='store_true', help='print the request metrics of every run')
+    parser.add_argument('--json', help='also write the results to this json file')
+    args = parser.parse_args()
+
+    mailbox = FakeMailbox(message_count=args.messages, body_words=args.body_words, attachment_every=0)
+    results = []
+
+    with FakeGraphServer(mailbox=mailbox, latency=args.latency, throttle_rate=args.throttle_rate,
+                         retry_after=args.retry_after) as server:
+        for name in args.scenarios:
+            #only these scenarios fetch pages concurrently
+            workers_list = args.workers if name in ['get_emails_all', 'async_get_emails_all'] else [1]
+
+            for workers in workers_list:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    count, graph_session = run_scenario(name, server, workers, args.rate)
+                    seconds = time.perf_counter() - start
+                    if best is None or seconds < best['seconds']:
+                        best = {
+                            'scenario': name,
+                            'workers': workers,
+                            'emails': count,
+                            'seconds': round(seconds, 3),
+                            'emails_per_second': round(count / seconds, 1),
+                            'retries': graph_session.retry_stats.snapshot()
+                        }
+                    if args.metrics:
+                        print(graph_session.metrics_report())
+                    #the asyncio session is closed when leaving its context
+                    if not isinstance(graph_session, AsyncGraphSession):
+                        graph_session.close()
+                results.append(best)
+
+    print(f"{'scenario':<24} {'workers':>7} {'emails':>8} {'seconds':>9} {'emails/s':>10} {'throttles':>9}")
+    for result in results:
+        print(f"{result['scenario']:<24} {result['workers']:>7} {result['emails']:>8} "
+              f"{result['seconds']:>9.2f} {result['emails_per_second']:>10.1f} {result['retries']['throttles']:>9}")
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'arguments': vars(args), 'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
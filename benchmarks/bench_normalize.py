@@ -0,0 +1,168 @@
+"""
+This script checks that helper_functions.normalize_text returns exactly the
+same text as the original implementation, kept below as legacy_normalize_text,
+on a golden corpus, and compares the speed of the two.
+
+The corpus is made of synthetic email bodies in html and text, hand written
+edge cases and random strings built from the characters the cleaning steps
+look for. The emails of a raw email archive can be added with --archive.
+
+Example:
+    python benchmarks/bench_normalize.py --emails 5000 --archive data/email_archive
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from helper_functions import normalize_text
+from ms_graph.fake_server_GBNOC import FakeMailbox
+
+LEGACY_START_STRING = '________________________________________________________________________________'
+LEGACY_END_STRING = '________________________________________________________________________________'
+
+EDGE_CASES = [
+    '',
+    '   ',
+    'plain text without anything to clean',
+    'a .,b . ,c.. d . . e .... f ..... g',
+    '**bold** and *stars*',
+    '**[CAUTION: External email]** Do not click links or open attachments unless you recognize the sender and know the content is safe. Hello',
+    'image (cid:image001.png@01DA2B3C.4D5E6F70) here (data:image/png;base64,AAAA) and (https://www.singtel.com/)',
+    '(data:image (cid:image) ) nested',
+    '(data:ima(cid:image1)ge x) split',
+    '(http (cid:image) ) after',
+    '(cid:image never closed',
+    '[a<b]c> and <a[b>c] crossed',
+    '[outer [inner] outer] and <<double>>',
+    'line one\nline two\r\n\ttabbed nbsp em　ideographic\x1c\x1dseparators',
+    'keep > this > and <that',
+    'before ' + '_' * 80 + ' signature ' + '_' * 80 + ' after',
+    '_' * 200 + ' long rule',
+    'From: Kohei [mailto:kohei@example.com] Sent: Monday <http://example.com> Subject: RE: UAT',
+]
+
+
+def legacy_normalize_text(s, sep_token = " \n "):
+    """
+    The original normalize_text, before the patterns were compiled once and
+    the passes without anything to remove were skipped
+    """
+
+    def remove_cid_image(text):
+        pattern = re.compile(r'\(cid:image.*?\)')
+        result_string = re.sub(pattern, '', text)
+        pattern = re.compile(r'\(data:image.*?\)')
+        result_string = re.sub(pattern, '', result_string)
+        return result_string
+
+    def remove_http(text):
+        pattern = re.compile(r'\(http.*?\)')
+        result_string = re.sub(pattern, '', text)
+        return result_string
+
+    def remove_between_strings(input_string, start_string, end_string):
+        pattern = re.compile(re.escape(start_string) + '.*?' + re.escape(end_string), re.DOTALL)
+        result_string = re.sub(pattern, '', input_string)
+        return result_string
+
+    s = re.sub(r'\s+',  ' ', s).strip()
+    s = re.sub(r". ,","",s)
+    s = s.replace("..",".")
+    s = s.replace(". .",".")
+    s = s.replace("\n", "")
+    s = s.replace("*", "")
+    s = remove_cid_image(s)
+    s = remove_http(s)
+    s = s.replace('**[CAUTION: External email]** Do not click links or open attachments unless you recognize the sender and know the content is safe.', '')
+    s = remove_between_strings(s, '[', ']')
+    s = remove_between_strings(s, '<', '>')
+    s = s.replace(">", "")
+    s = remove_between_strings(s, LEGACY_START_STRING, LEGACY_END_STRING)
+    s = s.strip()
+
+    return s
+
+
+def build_corpus(emails, fuzz, archive_directory, seed):
+    """
+    Builds the golden corpus of texts to normalize
+    """
+
+    corpus = list(EDGE_CASES)
+
+    mailbox = FakeMailbox(message_count=emails, attachment_every=0, seed=seed)
+    for record in mailbox.messages.values():
+        corpus.append(record['message']['body']['content'])
+        corpus.append(record['text'])
+
+    #random strings of the characters and pieces the cleaning steps look for
+    pieces = ['a', 'b', ' ', '  ', '\n', '\t', '.', ',', '*', '(', ')', '[', ']', '<', '>',
+              '(cid:image', '(data:image', '(http', '_' * 80, '. ,', '..', ' ']
+    rng = random.Random(seed)
+    for _ in range(fuzz):
+        corpus.append(''.join(rng.choice(pieces) for _ in range(rng.randint(0, 60))))
+
+    if archive_directory is not None:
+        from email_archive import EmailArchive
+        for email_content in EmailArchive(archive_directory).iter_emails():
+            corpus.append(email_content['body']['content'])
+
+    return corpus
+
+
+def time_function(function, corpus, repeat):
+    """
+    Returns the fastest of 'repeat' runs of 'function' over the corpus
+    """
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in corpus:
+            function(text)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare normalize_text with the original implementation')
+    parser.add_argument('--emails', type=int, default=2000, help='number of synthetic emails in the corpus')
+    parser.add_argument('--fuzz', type=int, default=20000, help='number of random strings in the corpus')
+    parser.add_argument('--archive', help='also add the emails of this raw email archive directory')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per implementation, the fastest is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.emails, args.fuzz, args.archive, args.seed)
+
+    mismatches = [text for text in corpus if normalize_text(text) != legacy_normalize_text(text)]
+    print(f'{len(corpus)} texts, {len(mismatches)} with a different output')
+    for text in mismatches[:5]:
+        print(f'  input:  {text[:200]!r}')
+        print(f'  legacy: {legacy_normalize_text(text)[:200]!r}')
+        print(f'  new:    {normalize_text(text)[:200]!r}')
+
+    legacy_seconds = time_function(legacy_normalize_text, corpus, args.repeat)
+    seconds = time_function(normalize_text, corpus, args.repeat)
+    megabytes = sum(len(text) for text in corpus) / 1048576
+
+    print(f"{'implementation':<16} {'seconds':>9} {'texts/s':>10} {'MB/s':>8}")
+    for name, run_seconds in [('legacy', legacy_seconds), ('normalize_text', seconds)]:
+        print(f'{name:<16} {run_seconds:>9.3f} {len(corpus) / run_seconds:>10.0f} {megabytes / run_seconds:>8.2f}')
+    print(f'speed up: {legacy_seconds / seconds:.2f}x')
+
+    if len(mismatches) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
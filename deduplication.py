@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+This module finds the chunks of email text that are the same, or nearly the
+same, so that each is only embedded once. The same body is often found many
+times, in mail sent to distribution lists, forwards, automated alerts and the
+copies in Sent Items and Inbox.
+
+Classes:
+    SimHashIndex
+
+Functions:
+    content_hash
+    simhash
+    deduplicate
+"""
+import hashlib
+import re
+
+import numpy as np
+
+word_pattern = re.compile(r'\w+')
+#numbers, dates and times, not the digits inside words and ids
+number_pattern = re.compile(r'\b\d[\d.,:/-]*\b')
+
+#bit positions of a 64 bit simhash
+SIMHASH_BITS = np.arange(64, dtype=np.uint64)
+
+
+def content_hash(text : str) -> str:
+    """
+    Hashes a text, two texts have the same hash only if they are the same.
+
+    Args:
+        text (str): the text to hash
+
+    Raises:
+        TypeError: If 'text' is not a string
+
+    Returns:
+        str: the sha1 hex digest of the utf-8 text
+
+    """
+
+    if not isinstance(text, str):
+        raise TypeError ('Text needs to be a string')
+
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def simhash(text : str, shingle_size = 2) -> int:
+    """
+    Computes the 64 bit SimHash of a text from its overlapping word shingles.
+    Texts that share most of their shingles, e.g. alerts made from the same
+    template, have hashes that differ in only a few bits. All numbers count as
+    the same word.
+
+    Args:
+        text (str): the text to hash
+        shingle_size (int): number of words per shingle, default 2
+
+    Raises:
+        TypeError: If 'text' is not a string
+
+    Returns:
+        int: the SimHash, 0 for a text without words
+
+    Examples:
+        >>> bin(simhash('Disk usage on server 1 is at 91%') ^ simhash('Disk usage on server 2 is at 93%')).count('1')
+        returns a small number of differing bits
+
+    """
+
+    if not isinstance(text, str):
+        raise TypeError ('Text needs to be a string')
+
+    #numbers and dates are what usually changes between alerts of one template
+    words = word_pattern.findall(number_pattern.sub('0', text.lower()))
+    if len(words) == 0:
+        return 0
+
+    shingles = {}
+    for i in range(max(1, len(words) - shingle_size + 1)):
+        shingle = ' '.join(words[i:i + shingle_size])
+        shingles[shingle] = shingles.get(shingle, 0) + 1
+
+    hashes = np.array([int.from_bytes(hashlib.blake2b(x.encode('utf-8'), digest_size=8).digest(), 'little')
+                       for x in shingles], dtype=np.uint64)
+    weights = np.array(list(shingles.values()), dtype=np.int64)
+
+    #weighted vote of every shingle on every bit
+    bits = ((hashes[:, None] >> SIMHASH_BITS) & np.uint64(1)).astype(np.int64)
+    votes = weights @ (2 * bits - 1)
+
+    return int(sum(1 << i for i in range(64) if votes[i] > 0))
+
+
+class SimHashIndex (object):
+
+    """
+    Finds texts whose SimHash is within 'max_distance' bits of a text already
+    added. The 64 bits are cut into max_distance + 1 bands, two hashes within
+    max_distance bits have at least one band the same, so only the texts
+    sharing a band with the new text are compared.
+    """
+
+    def __init__ (self, max_distance = 3, shingle_size = 2) -> None:
+        """
+        Creates an empty index.
+
+        Args:
+            max_distance (int): maximum number of differing bits of two near
+            duplicates, default 3
+            shingle_size (int): number of words per shingle, see simhash
+
+        Raises:
+            TypeError: If 'max_distance' or 'shingle_size' is not an integer
+            ValueError: If 'max_distance' is not between 0 and 63
+
+        Returns:
+            None
+
+        Examples:
+            >>> index = SimHashIndex()
+            >>> index.add('alert-1', 'Disk usage on server 1 is at 91%')
+            returns None
+            >>> index.add('alert-2', 'Disk usage on server 2 is at 93%')
+            returns 'alert-1' if the texts are near duplicates
+
+        """
+
+        if not isinstance(max_distance, int) or not isinstance(shingle_size, int):
+            raise TypeError ('Max distance and shingle size need to be integers')
+
+        if max_distance < 0 or max_distance > 63:
+            raise ValueError ('Max distance needs to be between 0 and 63')
+
+        self.max_distance = max_distance
+        self.shingle_size = shingle_size
+
+        band_count = max_distance + 1
+        #start and width of every band, the first bands get the extra bits
+        self._bands = []
+        start = 0
+        for i in range(band_count):
+            width = 64 // band_count + (1 if i < 64 % band_count else 0)
+            self._bands.append((start, width))
+            start = start + width
+
+        self._buckets = {}
+        self._hashes = {}
+
+    def __len__ (self) -> int:
+        return len(self._hashes)
+
+    def query (self, text : str):
+        """
+        Finds a near duplicate of a text among the texts added.
+
+        Args:
+            text (str): the text to look for
+
+        Returns:
+            the key of the closest near duplicate, None if there is none
+
+        """
+
+        return self._query(simhash(text, self.shingle_size))
+
+    def add (self, key, text : str):
+        """
+        Adds a text unless it is a near duplicate of a text already added.
+
+        Args:
+            key: the key returned for the text when it is found again, e.g. its
+            position in a list
+            text (str): the text to add
+
+        Returns:
+            the key of the near duplicate found, None if the text was added
+
+        """
+
+        text_hash = simhash(text, self.shingle_size)
+        duplicate = self._query(text_hash)
+        if duplicate is not None:
+            return duplicate
+
+        self._hashes[key] = text_hash
+        for band_number, (start, width) in enumerate(self._bands):
+            band = (text_hash >> start) & ((1 << width) - 1)
+            self._buckets.setdefault((band_number, band), []).append(key)
+
+        return None
+
+    def _query (self, text_hash : int):
+
+        """
+        Key of the closest added hash within max_distance bits, or None
+        """
+
+        best_key = None
+        best_distance = self.max_distance + 1
+        for band_number, (start, width) in enumerate(self._bands):
+            band = (text_hash >> start) & ((1 << width) - 1)
+            for key in self._buckets.get((band_number, band), []):
+                distance = bin(self._hashes[key] ^ text_hash).count('1')
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+
+        return best_key
+
+
+def deduplicate(texts : list, near_duplicates = False, max_distance = 3,
+                min_words = 20) -> tuple:
+    """
+    Finds the distinct texts of a list, so that each is embedded once and its
+    embedding given to every text it stands for.
+
+    Args:
+        texts (list): list of texts, e.g. the chunks of all emails
+        near_duplicates (bool): also treat texts whose SimHash is within
+        'max_distance' bits as the same, e.g. alerts made from one template.
+        The first of them stands for the others. Default False, only the
+        exact same texts are merged
+        max_distance (int): see SimHashIndex, default 3
+        min_words (int): texts with fewer words are only merged with exact
+        copies, as few shingles make the SimHash unreliable, default 20
+
+    Raises:
+        TypeError: If 'texts' is not a list
+
+    Returns:
+        tuple: the list of distinct texts, and for every text of 'texts' the
+        position of the distinct text standing for it
+
+    Examples:
+        >>> unique_texts, unique_index = deduplicate(['a b', 'c d', 'a b'])
+        returns ['a b', 'c d'] and [0, 1, 0]
+        >>> embeddings = [generate_embeddings(x) for x in unique_texts]
+        >>> [embeddings[i] for i in unique_index]
+        returns the embedding of every text
+
+    """
+
+    if not isinstance(texts, list):
+        raise TypeError ('Texts needs to be a list')
+
+    unique_texts = []
+    unique_index = []
+    positions = {}
+    index = SimHashIndex(max_distance) if near_duplicates else None
+
+    for text in texts:
+        text_hash = content_hash(text)
+        if text_hash not in positions:
+            duplicate = None
+            if index is not None and len(word_pattern.findall(text)) >= min_words:
+                duplicate = index.add(len(unique_texts), text)
+
+            if duplicate is None:
+                positions[text_hash] = len(unique_texts)
+                unique_texts.append(text)
+            else:
+                positions[text_hash] = duplicate
+
+        unique_index.append(positions[text_hash])
+
+    return unique_texts, unique_index
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides an on-disk archive of the raw emails fetched from
+Microsoft Graph, so that the emails can be processed again after a change to
+the cleaning or chunking without fetching them from outlook again.
+
+Classes:
+    EmailArchive
+"""
+import gzip
+import json
+import os
+import shutil
+import threading
+
+
+class EmailArchive (object):
+
+    """
+    An append-only archive of raw emails, keyed by email id and changeKey.
+
+    The emails are stored as gzip compressed JSON lines in numbered segment
+    files of at most 'segment_size' emails. Every call to add appends one gzip
+    member to the last segment, and index.jsonl records where each version of
+    an email is. manifest.json holds the committed size of every segment and
+    is replaced in one step after each write, so bytes left behind by a crash
+    halfway through a write are cut off the next time the archive is opened,
+    and the index only points to committed emails.
+
+    An email is only written again when its changeKey changed, and replaying
+    the archive yields the latest version of every email not removed.
+    """
+
+    def __init__ (self, directory = 'data/email_archive', segment_size = 10000,
+                  compresslevel = 6) -> None:
+        """
+        Opens the archive in 'directory', creating it if needed.
+
+        Args:
+            directory (str): directory of the archive files
+            segment_size (int): number of emails per segment file, default
+            10000
+            compresslevel (int): gzip compression level from 1 (fastest) to 9
+            (smallest), default 6
+
+        Raises:
+            TypeError: If 'directory' is not a string. If 'segment_size' or
+            'compresslevel' is not an integer
+
+        Returns:
+            None
+
+        Examples:
+            >>> archive = EmailArchive('data/email_archive')
+            >>> archive.add(graph.get_emails_all(graph_client))
+            >>> for email_content in archive.iter_emails():
+                    extract_email_info(email_content)
+
+        """
+
+        if not isinstance(directory, str):
+            raise TypeError ('Directory needs to be a string')
+
+        if not isinstance(segment_size, int) or not isinstance(compresslevel, int):
+            raise TypeError ('Segment size and compress level need to be integers')
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.compresslevel = compresslevel
+
+        self._lock = threading.Lock()
+
+        #a compact cut short between its two renames, go back to the old archive
+        if not os.path.exists(directory) and os.path.exists(self._sibling('old')):
+            os.replace(self._sibling('old'), directory)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._manifest = self._load_manifest()
+        self._index = self._load_index()
+        self._truncate_uncommitted()
+
+    def __len__ (self) -> int:
+        return sum(1 for x in self._index.values() if not x.get('removed'))
+
+    def __contains__ (self, message_id) -> bool:
+        entry = self._index.get(message_id)
+        return entry is not None and not entry.get('removed')
+
+    def ids (self) -> list:
+        """
+        Returns the ids of all emails in the archive, removed ones excluded
+        """
+
+        return [x for x, entry in self._index.items() if not entry.get('removed')]
+
+    def add (self, email_contents : list) -> int:
+        """
+        Appends emails to the archive. Emails already archived with the same
+        changeKey are skipped, so the same emails can be added again after a
+        refetch at little cost.
+
+        Args:
+            email_contents (list): list of dictionaries of the raw email
+            attributes, as returned by MSGraphOutlook.get_emails_all
+
+        Raises:
+            TypeError: If 'email_contents' is not a list
+
+        Returns:
+            int: number of emails written
+
+        Examples:
+            >>> archive.add(graph.get_emails(graph_client, top_n = 50))
+            archives the 50 latest emails
+
+        """
+
+        if not isinstance(email_contents, list):
+            raise TypeError ('Email contents needs to be a list')
+
+        with self._lock:
+            new_emails = []
+            seen = {}
+            for email_content in email_contents:
+                entry = self._index.get(email_content['id'])
+                #an email without changeKey is only written the first time
+                if (entry is not None and not entry.get('removed')
+                    and entry.get('changeKey') == email_content.get('changeKey')):
+                    continue
+                #keep only the last version if an email is given twice
+                if email_content['id'] in seen:
+                    new_emails[seen[email_content['id']]] = email_content
+                else:
+                    seen[email_content['id']] = len(new_emails)
+                    new_emails.append(email_content)
+
+            start = 0
+            while start < len(new_emails):
+                segments = self._manifest['segments']
+                if len(segments) == 0 or segments[-1]['count'] >= self.segment_size:
+                    segments.append({'name': 'segment-{0:06d}.jsonl.gz'.format(len(segments) + 1),
+                                     'bytes': 0, 'count': 0})
+
+                segment_number = len(segments) - 1
+                segment = segments[-1]
+                batch = new_emails[start:start + self.segment_size - segment['count']]
+
+                lines = ''.join(json.dumps(x, ensure_ascii=False) + '\n' for x in batch)
+                member = gzip.compress(lines.encode('utf-8'), compresslevel=self.compresslevel)
+
+                with open(os.path.join(self.directory, segment['name']), 'ab') as file:
+                    file.write(member)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+                entries = [{'id': x['id'], 'changeKey': x.get('changeKey'),
+                            'segment': segment_number, 'line': segment['count'] + i}
+                           for i, x in enumerate(batch)]
+
+                #commit the segment before indexing it, an email committed but
+                #not indexed is only written again by the next add
+                segment['bytes'] = segment['bytes'] + len(member)
+                segment['count'] = segment['count'] + len(batch)
+                self._save_manifest()
+                self._append_index(entries)
+
+                start = start + len(batch)
+
+            return len(new_emails)
+
+    def remove (self, message_ids) -> int:
+        """
+        Marks emails as removed, e.g. the ids returned as 'removed' by
+        MSGraphOutlook.sync_emails. They are no longer replayed and their
+        data is dropped by the next compact.
+
+        Args:
+            message_ids (list): ids of the emails to remove
+
+        Returns:
+            int: number of archived emails removed
+
+        """
+
+        with self._lock:
+            entries = [{'id': x, 'removed': True} for x in message_ids if x in self]
+            if len(entries) > 0:
+                self._append_index(entries)
+            return len(entries)
+
+    def iter_emails (self):
+        """
+        Iterates over the latest version of every archived email, in the
+        order they were archived, reading the segments one after another.
+
+        Yields:
+            dict: dictionary of the raw email attributes
+
+        Examples:
+            >>> for email_content in archive.iter_emails():
+                    extract_email_info(email_content)
+            processes all archived emails without fetching them again
+
+        """
+
+        latest = {(entry['segment'], entry['line'])
+                  for entry in self._index.values() if not entry.get('removed')}
+        segments = list(self._manifest['segments'])
+
+        used_segments = {key[0] for key in latest}
+
+        for segment_number, segment in enumerate(segments):
+            if segment_number not in used_segments:
+                continue
+            for line_number, line in enumerate(self._read_segment(segment)):
+                if (segment_number, line_number) in latest:
+                    yield json.loads(line)
+
+    def get (self, message_id : str) -> dict:
+        """
+        Gets the latest archived version of one email.
+
+        Args:
+            message_id (str): the email id
+
+        Returns:
+            dict: dictionary of the raw email attributes, None if the email is
+            not in the archive
+
+        """
+
+        entry = self._index.get(message_id)
+        if entry is None or entry.get('removed'):
+            return None
+
+        segment = self._manifest['segments'][entry['segment']]
+        for line_number, line in enumerate(self._read_segment(segment)):
+            if line_number == entry['line']:
+                return json.loads(line)
+
+    def compact (self) -> None:
+        """
+        Rewrites the archive with only the latest version of every email not
+        removed, reclaiming the space taken by older versions. The compacted
+        archive is built next to the current one and swapped in once complete.
+
+        Returns:
+            None
+
+        """
+
+        with self._lock:
+            compacted_directory = self._sibling('compacted')
+            if os.path.exists(compacted_directory):
+                shutil.rmtree(compacted_directory)
+
+            compacted = EmailArchive(compacted_directory, self.segment_size, self.compresslevel)
+
+            batch = []
+            for email_content in self.iter_emails():
+                batch.append(email_content)
+                if len(batch) == 1000:
+                    compacted.add(batch)
+                    batch = []
+            compacted.add(batch)
+
+            os.replace(self.directory, self._sibling('old'))
+            os.replace(compacted_directory, self.directory)
+            shutil.rmtree(self._sibling('old'))
+
+            self._manifest = self._load_manifest()
+            self._index = self._load_index()
+
+    def _sibling (self, suffix : str) -> str:
+
+        """
+        Path of a directory next to the archive, used while compacting
+        """
+
+        return os.path.normpath(self.directory) + '.' + suffix
+
+    def _read_segment (self, segment : dict):
+
+        """
+        Iterates over the lines of the committed part of a segment
+        """
+
+        path = os.path.join(self.directory, segment['name'])
+        with open(path, 'rb') as raw_file:
+            with gzip.open(raw_file, 'rt', encoding='utf-8') as file:
+                for line_number, line in enumerate(file):
+                    if line_number >= segment['count']:
+                        break
+                    yield line
+
+    def _load_manifest (self) -> dict:
+
+        """
+        Loads the segment list, empty for a new archive
+        """
+
+        path = os.path.join(self.directory, 'manifest.json')
+        if not os.path.exists(path):
+            return {'segments': []}
+
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def _save_manifest (self) -> None:
+
+        """
+        Saves the segment list, replacing the file in one step
+        """
+
+        path = os.path.join(self.directory, 'manifest.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(self._manifest, file, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def _load_index (self) -> dict:
+
+        """
+        Loads the location of the latest version of every email, ignoring
+        entries that point past the committed part of a segment
+        """
+
+        path = os.path.join(self.directory, 'index.jsonl')
+        index = {}
+        if not os.path.exists(path):
+            return index
+
+        segments = self._manifest['segments']
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #a line cut short by a crash
+                    continue
+                if entry.get('removed'):
+                    index[entry['id']] = entry
+                elif (entry['segment'] < len(segments)
+                      and entry['line'] < segments[entry['segment']]['count']):
+                    index[entry['id']] = entry
+
+        return index
+
+    def _append_index (self, entries : list) -> None:
+
+        """
+        Appends entries to the index file and the loaded index
+        """
+
+        with open(os.path.join(self.directory, 'index.jsonl'), 'a', encoding='utf-8') as file:
+            file.write(''.join(json.dumps(x) + '\n' for x in entries))
+
+        for entry in entries:
+            self._index[entry['id']] = entry
+
+    def _truncate_uncommitted (self) -> None:
+
+        """
+        Cuts off the bytes a crash left behind after the committed part of
+        the last segment, and ends a cut short index line
+        """
+
+        path = os.path.join(self.directory, 'index.jsonl')
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb+') as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b'\n':
+                    file.write(b'\n')
+
+        for segment in self._manifest['segments']:
+            path = os.path.join(self.directory, segment['name'])
+            if os.path.exists(path) and os.path.getsize(path) > segment['bytes']:
+                with open(path, 'r+b') as file:
+                    file.truncate(segment['bytes'])
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides a persistent cache of text embeddings, so that a rerun
+of the embedding only sends the texts that were never embedded before with
+the same model.
+
+Classes:
+    EmbeddingCache
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from deduplication import content_hash
+
+#number of keys per SELECT, under the SQLite limit on query parameters
+LOOKUP_SIZE = 500
+
+
+class EmbeddingCache (object):
+
+    """
+    An SQLite cache of embeddings, keyed by the hash of the text, with its
+    whitespace collapsed, and the model or deployment name. The embeddings
+    are stored as float64 so they come back exactly as the API returned them.
+
+    When 'max_entries' is set, the embeddings used least recently are evicted
+    once the cache holds more. Hits and misses are counted from the time the
+    cache is opened.
+    """
+
+    def __init__ (self, path = 'data/embedding_cache.sqlite', max_entries = None) -> None:
+        """
+        Opens the cache in 'path', creating it if needed.
+
+        Args:
+            path (str): path of the SQLite database file
+            max_entries (int): maximum number of embeddings kept, default None
+            for no limit
+
+        Raises:
+            TypeError: If 'path' is not a string. If 'max_entries' is not an
+            integer
+
+        Returns:
+            None
+
+        Examples:
+            >>> cache = EmbeddingCache('data/embedding_cache.sqlite')
+            >>> generate_embeddings_batch(chunks, cache = cache)
+            only sends the chunks not in the cache
+            >>> cache.stats()
+            returns the hits and misses
+
+        """
+
+        if not isinstance(path, str):
+            raise TypeError ('Path needs to be a string')
+
+        if max_entries is not None and not isinstance(max_entries, int):
+            raise TypeError ('Max entries needs to be an integer')
+
+        self.path = path
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS embeddings ('
+                                 'key TEXT PRIMARY KEY, model TEXT, embedding BLOB, last_used REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._connection.commit()
+
+    def __len__ (self) -> int:
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def get (self, text : str, model : str) -> list:
+        """
+        Looks up the embedding of one text, see get_many
+        """
+
+        return self.get_many([text], model)[0]
+
+    def put (self, text : str, embedding : list, model : str) -> None:
+        """
+        Stores the embedding of one text, see put_many
+        """
+
+        self.put_many([text], [embedding], model)
+
+    def get_many (self, texts : list, model : str) -> list:
+        """
+        Looks up the embeddings of many texts.
+
+        Args:
+            texts (list): the list of texts
+            model (str): the model or deployment the embeddings were made with
+
+        Raises:
+            TypeError: If 'texts' is not a list
+
+        Returns:
+            list: the embedding of every text, None for the texts not in the
+            cache
+
+        """
+
+        if not isinstance(texts, list):
+            raise TypeError ('Texts needs to be a list')
+
+        keys = [self._key(x, model) for x in texts]
+        found = {}
+
+        with self._lock:
+            unique_keys = list(set(keys))
+            for start in range(0, len(unique_keys), LOOKUP_SIZE):
+                lookup = unique_keys[start:start + LOOKUP_SIZE]
+                rows = self._connection.execute(
+                    'SELECT key, embedding FROM embeddings WHERE key IN ({0})'.format(','.join('?' * len(lookup))),
+                    lookup).fetchall()
+                for key, embedding in rows:
+                    found[key] = np.frombuffer(embedding, dtype=np.float64).tolist()
+
+            #mark the hits as used, for the eviction
+            now = time.time()
+            self._connection.executemany('UPDATE embeddings SET last_used = ? WHERE key = ?',
+                                         [(now, x) for x in found])
+            self._connection.commit()
+
+            embeddings = [found.get(x) for x in keys]
+            self.hits = self.hits + sum(1 for x in embeddings if x is not None)
+            self.misses = self.misses + sum(1 for x in embeddings if x is None)
+
+        return embeddings
+
+    def put_many (self, texts : list, embeddings : list, model : str) -> None:
+        """
+        Stores the embeddings of many texts, replacing any already stored, and
+        evicts the least recently used ones if the cache is over max_entries.
+
+        Args:
+            texts (list): the list of texts
+            embeddings (list): the embedding of every text
+            model (str): the model or deployment the embeddings were made with
+
+        Raises:
+            TypeError: If 'texts' or 'embeddings' is not a list
+            ValueError: If 'texts' and 'embeddings' do not have the same length
+
+        Returns:
+            None
+
+        """
+
+        if not isinstance(texts, list) or not isinstance(embeddings, list):
+            raise TypeError ('Texts and embeddings need to be lists')
+
+        if len(texts) != len(embeddings):
+            raise ValueError ('Texts and embeddings need to have the same length')
+
+        now = time.time()
+        rows = [(self._key(text, model), model, np.asarray(embedding, dtype=np.float64).tobytes(), now)
+                for text, embedding in zip(texts, embeddings)]
+
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+
+            if self.max_entries is not None:
+                count = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+                if count > self.max_entries:
+                    self._connection.execute(
+                        'DELETE FROM embeddings WHERE key IN '
+                        '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                        (count - self.max_entries,))
+
+            self._connection.commit()
+
+    def get_or_compute_many (self, texts : list, model : str, function) -> list:
+        """
+        Looks up the embeddings of many texts, computing and storing the ones
+        not in the cache. Every missing text is computed once, however often
+        it is in 'texts'.
+
+        Args:
+            texts (list): the list of texts
+            model (str): the model or deployment the embeddings are made with
+            function (callable): computes the embeddings of a list of the
+            missing texts, in the same order
+
+        Returns:
+            list: the embedding of every text, in the same order as 'texts'
+
+        Examples:
+            >>> cache.get_or_compute_many(chunks, provider.cache_key, provider._embed)
+            returns the embeddings of the chunks, embedding only the new ones
+
+        """
+
+        embeddings = self.get_many(texts, model)
+        #positions of every text not in the cache
+        missing = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(texts[i], []).append(i)
+
+        if len(missing) > 0:
+            missing_texts = list(missing)
+            missing_embeddings = function(missing_texts)
+            self.put_many(missing_texts, missing_embeddings, model)
+            for text, embedding in zip(missing_texts, missing_embeddings):
+                for i in missing[text]:
+                    embeddings[i] = embedding
+
+        return embeddings
+
+    def stats (self) -> dict:
+        """
+        Gets the number of embeddings in the cache and the hits and misses
+        since it was opened.
+
+        Returns:
+            dict: entries, hits, misses and hit_rate
+
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else 0.0
+        }
+
+    def clear (self) -> None:
+        """
+        Removes all embeddings from the cache
+        """
+
+        with self._lock:
+            self._connection.execute('DELETE FROM embeddings')
+            self._connection.commit()
+
+    def close (self) -> None:
+        """
+        Closes the database
+        """
+
+        with self._lock:
+            self._connection.close()
+
+    def _key (self, text : str, model : str) -> str:
+
+        """
+        Hash of the model and of the text with its whitespace collapsed
+        """
+
+        return content_hash(model + '\n' + ' '.join(text.split()))
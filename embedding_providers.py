@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+This module provides the embedding models the email index can be built with:
+the Azure OpenAI deployment, a sentence-transformers model run on the local
+CPU, and a deterministic hashing embedder that needs no model or network, for
+tests and benchmarks. The provider an index is built with is saved next to it,
+so the queries are embedded with the same one.
+
+Classes:
+    WordTokenizer
+    EmbeddingProvider
+    AzureOpenAIEmbeddingProvider
+    SentenceTransformerEmbeddingProvider
+    HashingEmbeddingProvider
+
+Functions:
+    get_provider
+    save_provider
+    load_provider
+"""
+import hashlib
+import json
+import os
+import re
+from abc import ABC
+from abc import abstractmethod
+
+import numpy as np
+
+#the words the hashing embedder hashes
+word_pattern = re.compile(r'\w+')
+
+#the tokens of the word tokenizer, every word and punctuation mark with the
+#whitespace before it
+token_pattern = re.compile(r'\s*(?:\w+|[^\w\s])')
+
+
+class WordTokenizer (object):
+
+    """
+    A tokenizer that needs no model or download, for the providers without a
+    tokenizer of their own: every word and punctuation mark is a token. The
+    tokens keep the whitespace before them, so decode gives the text back.
+    """
+
+    def encode (self, text : str) -> list:
+        return token_pattern.findall(text)
+
+    def decode (self, tokens : list) -> str:
+        return ''.join(tokens)
+
+
+word_tokenizer = WordTokenizer()
+
+
+class _ModelTokenizer (object):
+
+    """
+    The tokenizer of a sentence-transformers model, without the special tokens
+    the model adds around every text
+    """
+
+    def __init__ (self, tokenizer) -> None:
+        self._tokenizer = tokenizer
+
+    def encode (self, text : str) -> list:
+        return self._tokenizer.encode(text, add_special_tokens=False)
+
+    def decode (self, tokens : list) -> str:
+        return self._tokenizer.decode(tokens)
+
+
+class EmbeddingProvider (ABC):
+
+    """
+    The interface of the embedding providers. A provider embeds a list of
+    texts with _embed, and is described by its config, from which get_provider
+    creates it again. The texts are chunked with its tokenizer to at most
+    max_tokens tokens, so the model never cuts them short.
+    """
+
+    provider = None
+    max_tokens = 8000
+
+    @property
+    def tokenizer (self):
+        """
+        The tokenizer the texts are chunked with, with encode and decode methods
+        """
+
+        return word_tokenizer
+
+    @abstractmethod
+    def config (self) -> dict:
+        """
+        Gets the settings of the provider, see get_provider
+        """
+
+    @property
+    def cache_key (self) -> str:
+        """
+        The model name the embeddings of the provider are cached under
+        """
+
+        return json.dumps(self.config(), sort_keys=True)
+
+    def embed (self, texts : list, cache = None) -> list:
+        """
+        Embeds many texts.
+
+        Args:
+            texts (list): the list of texts to be embedded
+            cache (EmbeddingCache): only the texts not in the cache are
+            embedded, and their embeddings are stored in it
+
+        Raises:
+            TypeError: If 'texts' is not a list of strings
+
+        Returns:
+            list: the list of embeddings, in the same order as 'texts'
+
+        Examples:
+            >>> HashingEmbeddingProvider(dimensions = 8).embed(['first chunk', 'second chunk'])
+            returns two embeddings of 8 floats
+
+        """
+
+        if not isinstance(texts, list) or not all(isinstance(x, str) for x in texts):
+            raise TypeError ('Texts needs to be a list of strings')
+
+        if cache is None:
+            return self._embed(texts) if len(texts) > 0 else []
+
+        return cache.get_or_compute_many(texts, self.cache_key, self._embed)
+
+    def embed_query (self, text : str) -> list:
+        """
+        Embeds one text, e.g. a query.
+
+        Args:
+            text (str): the text to be embedded
+
+        Raises:
+            TypeError: If 'text' is not a string
+
+        Returns:
+            list: the embedding
+
+        """
+
+        if not isinstance(text, str):
+            raise TypeError ('Text needs to be a string')
+
+        return self._embed([text])[0]
+
+    @abstractmethod
+    def _embed (self, texts : list) -> list:
+
+        """
+        Embeddings of a non empty list of texts
+        """
+
+
+class AzureOpenAIEmbeddingProvider (EmbeddingProvider):
+
+    """
+    Embeds with an Azure OpenAI deployment through
+    helper_functions.generate_embeddings_batch, paced by its
+    embedding_scheduler.
+    """
+
+    provider = 'azure'
+    #the limit of text-embedding-ada-002 is 8191 tokens
+    max_tokens = 8000
+
+    def __init__ (self, model = 'text_embedding-ada-002-default', max_batch_size = 16,
+                  max_batch_tokens = 100000, max_workers = 4) -> None:
+        """
+        Args:
+            model (str): the deployment name of the embedding model
+            max_batch_size (int): the maximum number of texts in each request
+            max_batch_tokens (int): the maximum number of tokens in each
+            request
+            max_workers (int): the number of requests sent at a time
+        """
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_workers = max_workers
+
+    def config (self) -> dict:
+        return {'provider': self.provider, 'model': self.model}
+
+    @property
+    def cache_key (self) -> str:
+        #the deployment name, as used by generate_embeddings
+        return self.model
+
+    @property
+    def tokenizer (self):
+        #imported here, helper_functions is only needed by this provider
+        from helper_functions import get_tokenizer
+
+        return get_tokenizer()
+
+    def _embed (self, texts : list) -> list:
+        #imported here, helper_functions is only needed by this provider
+        from helper_functions import generate_embeddings_batch
+
+        return generate_embeddings_batch(texts, self.model, self.max_batch_size,
+                                         self.max_batch_tokens, self.max_workers)
+
+
+class SentenceTransformerEmbeddingProvider (EmbeddingProvider):
+
+    """
+    Embeds on the local CPU, or GPU, with a sentence-transformers model. The
+    sentence-transformers package is only needed by this provider, and the
+    model is loaded on first use.
+    """
+
+    provider = 'sentence-transformers'
+
+    def __init__ (self, model = 'all-MiniLM-L6-v2', device = None, batch_size = 64) -> None:
+        """
+        Args:
+            model (str): the name or local path of the model
+            device (str): e.g. 'cpu' or 'cuda', default None for the best
+            device found
+            batch_size (int): the number of texts embedded at a time
+        """
+
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self._model = None
+
+    def config (self) -> dict:
+        return {'provider': self.provider, 'model': self.model}
+
+    @property
+    def max_tokens (self) -> int:
+        #the model truncates longer texts, the special tokens it adds included
+        return self._load().max_seq_length - 2
+
+    @property
+    def tokenizer (self):
+        return _ModelTokenizer(self._load().tokenizer)
+
+    def _embed (self, texts : list) -> list:
+        embeddings = self._load().encode(texts, batch_size=self.batch_size, normalize_embeddings=True)
+        return [x.tolist() for x in embeddings]
+
+    def _load (self):
+
+        """
+        The model, loaded on first use
+        """
+
+        if self._model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                raise ImportError ('The sentence-transformers package needs to be installed '
+                                   'to use the sentence-transformers provider')
+            self._model = SentenceTransformer(self.model, device=self.device)
+
+        return self._model
+
+
+class HashingEmbeddingProvider (EmbeddingProvider):
+
+    """
+    A deterministic embedder without a model: every word and pair of words of
+    the text is hashed to one of 'dimensions' positions with a sign, and the
+    vector is normalized. Texts sharing words are close, which is enough to
+    test and benchmark the pipeline offline. Texts are chunked with the word
+    tokenizer.
+    """
+
+    provider = 'hashing'
+
+    def __init__ (self, dimensions = 1536) -> None:
+        """
+        Args:
+            dimensions (int): the length of the embeddings
+        """
+
+        self.dimensions = dimensions
+
+    def config (self) -> dict:
+        return {'provider': self.provider, 'dimensions': self.dimensions}
+
+    def _embed (self, texts : list) -> list:
+        embeddings = []
+        for text in texts:
+            words = word_pattern.findall(text.lower())
+            features = words + [a + ' ' + b for a, b in zip(words, words[1:])]
+
+            vector = np.zeros(self.dimensions)
+            for feature in features:
+                value = int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little')
+                vector[value % self.dimensions] += 1.0 if value >> 63 else -1.0
+
+            norm = np.linalg.norm(vector)
+            embeddings.append((vector / norm if norm > 0 else vector).tolist())
+
+        return embeddings
+
+
+PROVIDERS = {
+    AzureOpenAIEmbeddingProvider.provider: AzureOpenAIEmbeddingProvider,
+    SentenceTransformerEmbeddingProvider.provider: SentenceTransformerEmbeddingProvider,
+    HashingEmbeddingProvider.provider: HashingEmbeddingProvider
+}
+
+
+def get_provider(config : dict) -> EmbeddingProvider:
+    """
+    Creates an embedding provider from its settings.
+
+    Args:
+        config (dict): 'provider', one of 'azure', 'sentence-transformers'
+        and 'hashing', and the arguments of its class
+
+    Raises:
+        TypeError: If 'config' is not a dict
+        ValueError: If the provider is not known
+
+    Returns:
+        EmbeddingProvider: the provider
+
+    Examples:
+        >>> get_provider({'provider': 'sentence-transformers', 'model': 'all-MiniLM-L6-v2'})
+        returns a SentenceTransformerEmbeddingProvider
+
+    """
+
+    if not isinstance(config, dict):
+        raise TypeError ('Config needs to be a dict')
+
+    arguments = dict(config)
+    name = arguments.pop('provider', None)
+    if name not in PROVIDERS:
+        raise ValueError (f'Unknown embedding provider "{name}", needs to be one of {list(PROVIDERS)}')
+
+    return PROVIDERS[name](**arguments)
+
+
+def save_provider(provider : EmbeddingProvider, path = 'data/embedding_provider.json') -> None:
+    """
+    Saves the settings of the provider an index is built with, next to it.
+
+    Args:
+        provider (EmbeddingProvider): the provider
+        path (str): path of the json file
+
+    Returns:
+        None
+
+    """
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(provider.config(), file, indent=4)
+
+
+def load_provider(path = 'data/embedding_provider.json') -> EmbeddingProvider:
+    """
+    Creates the provider an index was built with.
+
+    Args:
+        path (str): path of the json file written by save_provider
+
+    Returns:
+        EmbeddingProvider: the provider, the Azure OpenAI deployment for an
+        index built before the providers were saved
+
+    """
+
+    if not os.path.exists(path):
+        return AzureOpenAIEmbeddingProvider()
+
+    with open(path, 'r', encoding='utf-8') as file:
+        return get_provider(json.load(file))
@@ -6,22 +6,57 @@ given
 
 
 import ast
+import functools
 import re
 import jellyfish
 import json
-import nltk
 import numpy as np
 import os
 import pandas as pd
+import tiktoken
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from openai import AzureOpenAI
 from datetime import datetime
+from quota_scheduler import QuotaScheduler
+from query_cache import QueryCache
 
-client = AzureOpenAI(
-  azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"), 
-  api_key=os.getenv("AZURE_OPENAI_KEY"),  
-  api_version="2023-05-15"
+@functools.lru_cache(maxsize=1)
+def get_client():
+    """
+     creates the Azure OpenAI client on first use, so that everything not 
+     calling Azure OpenAI, e.g. a local embedding provider, runs without it
+
+     Returns:
+         AzureOpenAI: the client
+
+     """
+    # throttled calls are retried by the schedulers below, not by the client
+    return AzureOpenAI(
+      azure_endpoint = os.getenv("AZURE_OPENAI_ENDPOINT"), 
+      api_key=os.getenv("AZURE_OPENAI_KEY"),  
+      api_version="2023-05-15",
+      max_retries=0
+    )
+
+# pace the calls under the requests and tokens per minute quotas of the 
+# deployments, e.g. AZURE_OPENAI_EMBEDDING_TPM=120000. Without a quota set the 
+# calls are not paced, but are still retried when throttled
+embedding_scheduler = QuotaScheduler(
+  requests_per_minute = int(os.getenv("AZURE_OPENAI_EMBEDDING_RPM", 0)) or None,
+  tokens_per_minute = int(os.getenv("AZURE_OPENAI_EMBEDDING_TPM", 0)) or None,
+  name = 'embeddings'
+)
+chat_scheduler = QuotaScheduler(
+  requests_per_minute = int(os.getenv("AZURE_OPENAI_CHAT_RPM", 0)) or None,
+  tokens_per_minute = int(os.getenv("AZURE_OPENAI_CHAT_TPM", 0)) or None,
+  name = 'chat'
 )
 
+# the query embeddings and named entities of find_email, kept in memory for 
+# the session when no other query cache is given
+default_query_cache = QueryCache()
+
 start_string = '________________________________________________________________________________'
 end_string = '________________________________________________________________________________'
 
@@ -43,6 +78,33 @@ labels = [
     "quantity",    # measurements, e.g., weight or distance
 ]
 
+# patterns used to clean the email messages, compiled once when the module is 
+# loaded instead of on every call
+cid_image_pattern = re.compile(r'\(cid:image.*?\)')
+data_image_pattern = re.compile(r'\(data:image.*?\)')
+http_pattern = re.compile(r'\(http.*?\)')
+dot_comma_pattern = re.compile(r'. ,')
+# same matches as remove_between_strings(s, '[', ']') and (s, '<', '>'), 
+# without the backtracking of '.*?'
+square_brackets_pattern = re.compile(r'\[[^\]]*\]')
+angle_brackets_pattern = re.compile(r'<[^>]*>')
+# the end of a sentence, used to snap chunks to sentence boundaries
+sentence_end_pattern = re.compile(r'(?<=[.!?])(?=\s+\S)')
+# the start of the reply history, signature or disclaimer under the new content
+# of an email, used by strip_quoted_reply
+quoted_reply_patterns = [
+    # outlook reply and forward headers, "From: ..." followed by "Sent: ..."
+    re.compile(r'^[ \t>*_]*From:.*\n(?:.*\n){0,3}?[ \t>*_]*(?:Sent|Date):', re.MULTILINE),
+    re.compile(r'^[ \t>*]*-{2,} ?(?:Original|Forwarded) Message ?-{2,}', re.MULTILINE | re.IGNORECASE),
+    # "On Mon, 1 Jan 2024 at 10:00, Kohei <kohei@example.com> wrote:", can wrap
+    re.compile(r'^[ \t>*]*On [^\n]*(?:\n[^\n]*)?wrote:[ \t*]*$', re.MULTILINE),
+    re.compile(r'^(?:-- ?|Sent from my .*|Get Outlook for .*)$', re.MULTILINE),
+    re.compile(r'^[ \t>*_]*(?:disclaimer\b|(?:this|the information (?:contained )?in this) '
+               r'(?:e-?mail|message)[^\n]{0,100}(?:confidential|privileged|intended (?:solely|only)))',
+               re.MULTILINE | re.IGNORECASE),
+]
+quoted_line_pattern = re.compile(r'^[ \t]*>.*(?:\n|$)', re.MULTILINE)
+
 def remove_cid_image(text):
     """
        removes all 'cid:image ...' and 'data:image ...' links
@@ -65,10 +127,8 @@ def remove_cid_image(text):
     if not isinstance(text, str):
         raise TypeError ('text needs to be a string')
             
-    pattern = re.compile(r'\(cid:image.*?\)')
-    result_string = re.sub(pattern, '', text)
-    pattern = re.compile(r'\(data:image.*?\)')
-    result_string = re.sub(pattern, '', result_string)
+    result_string = cid_image_pattern.sub('', text)
+    result_string = data_image_pattern.sub('', result_string)
     return result_string
 
 def remove_http(text):
@@ -93,8 +153,7 @@ def remove_http(text):
     if not isinstance(text, str):
         raise TypeError ('text needs to be a string')
             
-    pattern = re.compile(r'\(http.*?\)')
-    result_string = re.sub(pattern, '', text)
+    result_string = http_pattern.sub('', text)
     return result_string
 
 def remove_between_strings(input_string, start_string, end_string):
@@ -127,10 +186,26 @@ def remove_between_strings(input_string, start_string, end_string):
     if not isinstance(end_string, str):
         raise TypeError ('end_string needs to be a string')
         
-    pattern = re.compile(re.escape(start_string) + '.*?' + re.escape(end_string), re.DOTALL)
-    result_string = re.sub(pattern, '', input_string)
+    pattern = between_strings_pattern(start_string, end_string)
+    result_string = pattern.sub('', input_string)
     return result_string
 
+@functools.lru_cache(maxsize=64)
+def between_strings_pattern(start_string, end_string):
+    """
+       compiles the pattern used by remove_between_strings, once for each 
+       start_string and end_string
+
+       Args:
+           start_string (str): the pattern of the start_string
+           end_string (str): the pattern of the end_string
+           
+       Returns:
+           re.Pattern: the compiled pattern
+
+       """
+    return re.compile(re.escape(start_string) + '.*?' + re.escape(end_string), re.DOTALL)
+
 # s is input text
 def normalize_text(s, sep_token = " \n "):
     """
@@ -148,32 +223,93 @@ def normalize_text(s, sep_token = " \n "):
        """
     if not isinstance(s, str):
         raise TypeError ('s needs to be a string')
-        
-    s = re.sub(r'\s+',  ' ', s).strip()
-    s = re.sub(r". ,","",s)
-    # remove all instances of multiple spaces
+    
+    # collapse all whitespace in to single spaces and strip, same as 
+    # re.sub(r'\s+', ' ', s).strip() in one pass. No newlines are left after 
+    # this, so there is no need to remove them
+    s = ' '.join(s.split())
+    if ' ,' in s:
+        s = dot_comma_pattern.sub('', s)
+    # remove all instances of multiple dots
     s = s.replace("..",".")
     s = s.replace(". .",".")
-    s = s.replace("\n", "")
     s = s.replace("*", "")
-    s = remove_cid_image(s)
-    s = remove_http(s)
-    s = s.replace('**[CAUTION: External email]** Do not click links or open attachments unless you recognize the sender and know the content is safe.', '')
-    s = remove_between_strings(s, '[', ']')
-    s = remove_between_strings(s, '<', '>')
+    # the removals below stay separate passes in the same order, as a match of
+    # one can sit inside a match of another. Each pass is skipped if the text
+    # does not contain what it removes, which is the case for most emails.
+    # The CAUTION banner starts with '**', so it cannot match anymore once 
+    # the '*' are removed, only its '[CAUTION: External email]' is removed
+    if '(cid:image' in s:
+        s = cid_image_pattern.sub('', s)
+    if '(data:image' in s:
+        s = data_image_pattern.sub('', s)
+    if '(http' in s:
+        s = http_pattern.sub('', s)
+    if '[' in s:
+        s = square_brackets_pattern.sub('', s)
+    if '<' in s:
+        s = angle_brackets_pattern.sub('', s)
     s = s.replace(">", "")
-    s = remove_between_strings(s, start_string, end_string) 
+    if start_string in s:
+        s = remove_between_strings(s, start_string, end_string) 
     s = s.strip()
     
     return s
 
-def generate_embeddings(text, model='text_embedding-ada-002-default'): # model = "deployment_name"
+def strip_quoted_reply(text):
+    """
+       keeps only the new content of an email, cutting off the reply history 
+       and forwarded emails under it ("From: ... Sent: ..." headers, "-----
+       Original Message-----", "On ... wrote:"), quoted lines starting with '>', 
+       signatures ("-- ", "Sent from my ...") and disclaimers. Needs to be run 
+       before normalize_text, which removes the line breaks the headers are 
+       found with. An email with nothing above its reply history, e.g. a 
+       forward without a comment, is returned whole
+
+       Args:
+           text (str): the text of the email body
+
+       Raises:
+           TypeError: If 'text' is not a string
+           
+       Returns:
+           str: the new content of the email
+
+       Examples:
+           >>> strip_quoted_reply("Approved.\n\nFrom: Kohei\nSent: Monday\nSubject: RE: UAT\n\nPlease approve")
+           returns "Approved."
+
+       """
+    if not isinstance(text, str):
+        raise TypeError ('text needs to be a string')
+
+    text = text.replace('\r\n', '\n')
+
+    # cut at the earliest marker, searching only the text before the cut so far
+    cut = len(text)
+    for pattern in quoted_reply_patterns:
+        match = pattern.search(text[:cut])
+        if match is not None:
+            cut = match.start()
+
+    new_content = text[:cut]
+    if '>' in new_content:
+        new_content = quoted_line_pattern.sub('', new_content)
+    new_content = new_content.rstrip(' \t\n_')
+
+    if len(new_content.strip()) == 0:
+        return text
+    return new_content
+
+def generate_embeddings(text, model='text_embedding-ada-002-default', cache=None): # model = "deployment_name"
     """
      generate text embedding
 
      Args:
          text (str): the text to be embedded
          model (str): the OpenAI model to be used for the text embedding
+         cache (EmbeddingCache): the embedding is taken from the cache if the 
+         text was embedded before with the same model, and stored in it if not
 
      Raises:
          TypeError: If 'text' is not a string
@@ -184,38 +320,186 @@ def generate_embeddings(text, model='text_embedding-ada-002-default'): # model =
      """
     if not isinstance(text, str):
         raise TypeError ('text needs to be a string')
-    return client.embeddings.create(input = [text], model=model).data[0].embedding
-
-def chunk_string(text, max_words=4000):
+    if cache is not None:
+        embedding = cache.get(text, model)
+        if embedding is not None:
+            return embedding
+    # the tokens are only counted when there is a tokens per minute quota
+    tokens = len(get_tokenizer().encode(text)) if embedding_scheduler.tokens_per_minute else 0
+    embedding = embedding_scheduler.run(lambda: get_client().embeddings.create(input = [text], model=model), 
+                                        tokens).data[0].embedding
+    if cache is not None:
+        cache.put(text, embedding, model)
+    return embedding
+
+def generate_embeddings_batch(texts, model='text_embedding-ada-002-default', max_batch_size=16, 
+                              max_batch_tokens=100000, max_workers=4, tokenizer=None, cache=None):
     """
-     cut up the text into chunks of specified number of words
+     generate text embeddings of many texts, packing several texts in each 
+     request and sending several requests at a time
 
      Args:
-         text (str): the text to be chunked
-         max_words (int): the maximum number of words in each chunk
+         texts (list): the list of texts to be embedded
+         model (str): the OpenAI model to be used for the text embedding
+         max_batch_size (int): the maximum number of texts in each request, 16
+         for text-embedding-ada-002 on Azure OpenAI
+         max_batch_tokens (int): the maximum number of tokens in each request
+         max_workers (int): the number of requests sent at a time
+         tokenizer (object): any tokenizer with an encode method, used to count 
+         the tokens of the texts, the default is get_tokenizer()
+         cache (EmbeddingCache): only the texts not in the cache are sent, and 
+         their embeddings are stored in it
 
      Raises:
-         TypeError: If 'text' is not a string
+         TypeError: If 'texts' is not a list of strings
+         ValueError: If 'max_batch_size', 'max_batch_tokens' or 'max_workers' 
+         is less than 1
          
      Returns:
-         list: the list of chunked strings
+         list: the list of embeddings, in the same order as 'texts'
+
+     Examples:
+         >>> generate_embeddings_batch(['first chunk', 'second chunk'])
+         returns [embedding of 'first chunk', embedding of 'second chunk']
+
+     """
+    if not isinstance(texts, list) or not all(isinstance(x, str) for x in texts):
+        raise TypeError ('texts needs to be a list of strings')
+    if max_batch_size < 1 or max_batch_tokens < 1 or max_workers < 1:
+        raise ValueError ('max_batch_size, max_batch_tokens and max_workers need to be at least 1')
+
+    if cache is not None:
+        # only the texts not in the cache are sent, each of them once
+        return cache.get_or_compute_many(texts, model, lambda missing_texts: generate_embeddings_batch(
+            missing_texts, model, max_batch_size, max_batch_tokens, max_workers, tokenizer))
+
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+
+    # cut the texts in to consecutive batches, a text longer than 
+    # max_batch_tokens is sent on its own
+    batches = []
+    batches_tokens = []
+    for text in texts:
+        n_tokens = len(tokenizer.encode(text))
+        if (len(batches) == 0 or len(batches[-1]) >= max_batch_size 
+            or batches_tokens[-1] + n_tokens > max_batch_tokens):
+            batches.append([])
+            batches_tokens.append(0)
+        batches[-1].append(text)
+        batches_tokens[-1] = batches_tokens[-1] + n_tokens
+
+    def embed_batch(batch, tokens):
+        # paced under the quotas of the deployment, see embedding_scheduler
+        response = embedding_scheduler.run(lambda: get_client().embeddings.create(input = batch, model=model), 
+                                           tokens)
+        # the embeddings are matched to the inputs by their index
+        return [x.embedding for x in sorted(response.data, key=lambda x: x.index)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return [x for embeddings in executor.map(embed_batch, batches, batches_tokens) for x in embeddings]
+
+@functools.lru_cache(maxsize=8)
+def get_tokenizer(encoding_name='cl100k_base'):
+    """
+     loads a tiktoken encoding, once for each encoding name. cl100k_base is the
+     encoding of text-embedding-ada-002. Set the TIKTOKEN_CACHE_DIR environment
+     variable to a folder holding the encoding file when it cannot be downloaded
+
+     Args:
+         encoding_name (str): the name of the tiktoken encoding
+
+     Returns:
+         tiktoken.Encoding: the encoding, with encode and decode methods
+
+     """
+    return tiktoken.get_encoding(encoding_name)
+
+def chunk_text(text, max_tokens=8000, overlap_tokens=200, snap_to_sentences=True, tokenizer=None):
+    """
+     cut up the text into chunks of at most max_tokens model tokens, so that no
+     chunk is rejected by the embedding model for being too long. Every
+     sentence is tokenized once and the chunks are built in a single pass
+
+     Args:
+         text (str): the text to be chunked
+         max_tokens (int): the maximum number of tokens in each chunk, the limit
+         of text-embedding-ada-002 is 8191
+         overlap_tokens (int): the number of tokens at the end of a chunk that
+         are repeated at the start of the next one
+         snap_to_sentences (bool): end the chunks, and start the overlap, at a
+         sentence boundary. A sentence longer than max_tokens is cut on its own
+         tokenizer (object): any tokenizer with encode and decode methods, e.g.
+         the tokenizer of an embedding provider, the default is get_tokenizer()
+
+     Raises:
+         TypeError: If 'text' is not a string, or 'max_tokens', 'overlap_tokens'
+         are not integers
+         ValueError: If 'max_tokens' is less than 1, or 'overlap_tokens' is not
+         between 0 and max_tokens - 1
+
+     Yields:
+         str: the chunks of the text, in order
+
+     Examples:
+         >>> list(chunk_text("First sentence. Second sentence.", max_tokens=4, overlap_tokens=0))
+         returns ['First sentence.', 'Second sentence.']
 
      """
     if not isinstance(text, str):
         raise TypeError ('text needs to be a string')
-    words = nltk.word_tokenize(text)
-    chunks = []
-    current_chunk = []
-
-    for word in words:
-        if len(current_chunk + [word]) <= max_words:
-            current_chunk.append(word)
+    if not isinstance(max_tokens, int) or not isinstance(overlap_tokens, int):
+        raise TypeError ('max_tokens and overlap_tokens need to be integers')
+    if max_tokens < 1:
+        raise ValueError ('max_tokens needs to be at least 1')
+    if overlap_tokens < 0 or overlap_tokens >= max_tokens:
+        raise ValueError ('overlap_tokens needs to be between 0 and max_tokens - 1')
+
+    if tokenizer is None:
+        tokenizer = get_tokenizer()
+
+    if not snap_to_sentences:
+        tokens = tokenizer.encode(text)
+        for start in range(0, len(tokens), max_tokens - overlap_tokens):
+            yield tokenizer.decode(tokens[start:start + max_tokens]).strip()
+            if start + max_tokens >= len(tokens):
+                break
+        return
+
+    # the sentences of the current chunk with their number of tokens
+    chunk = deque()
+    chunk_tokens = 0
+
+    for sentence in sentence_end_pattern.split(text):
+        tokens = tokenizer.encode(sentence)
+        if len(tokens) <= max_tokens:
+            pieces = [(sentence, len(tokens))]
         else:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = [word]
+            pieces = [(tokenizer.decode(tokens[i:i + max_tokens]), len(tokens[i:i + max_tokens]))
+                      for i in range(0, len(tokens), max_tokens)]
+
+        for piece in pieces:
+            if chunk_tokens + piece[1] > max_tokens and len(chunk) > 0:
+                yield ''.join(x[0] for x in chunk).strip()
+
+                # the last sentences, up to overlap_tokens, start the next chunk
+                overlap = deque()
+                overlap_size = 0
+                while len(chunk) > 0 and overlap_size + chunk[-1][1] <= overlap_tokens:
+                    overlap.appendleft(chunk.pop())
+                    overlap_size = overlap_size + overlap[0][1]
+                chunk, chunk_tokens = overlap, overlap_size
 
-    chunks.append(' '.join(current_chunk))
-    return chunks
+                # leave room for the sentence
+                while len(chunk) > 0 and chunk_tokens + piece[1] > max_tokens:
+                    chunk_tokens = chunk_tokens - chunk.popleft()[1]
+
+            chunk.append(piece)
+            chunk_tokens = chunk_tokens + piece[1]
+
+    last_chunk = ''.join(x[0] for x in chunk).strip()
+    if len(last_chunk) > 0:
+        yield last_chunk
 
 def cosine(u, v):
     """
@@ -319,14 +603,20 @@ def get_NER(labels, text):
           {"role": "user", "content": user_message(text=text)}
       ]
 
-    response = client.chat.completions.create(
+    # the tokens of the prompt, the completion is taken from the tokens per 
+    # minute budget once its usage is known
+    tokens = 0
+    if chat_scheduler.tokens_per_minute:
+        tokens = sum(len(get_tokenizer().encode(x['content'])) for x in messages)
+
+    response = chat_scheduler.run(lambda: get_client().chat.completions.create(
         model="gpt-35-turbo-16k-0613-vanilla",
         messages=messages,
 
         temperature=0,
         frequency_penalty=0,
         presence_penalty=0,
-    )
+    ), tokens)
 
     response_message = json.loads(response.choices[0].message.content)
     
@@ -506,7 +796,7 @@ def find_date (df_long, query, date_list):
     
     return df_long    
 
-def find_email (query, top_n, df, df_long, advance_filter = 'N'):
+def find_email (query, top_n, df, df_long, advance_filter = 'N', provider = None, query_cache = None):
     """
      filter for all rows in dataframe which fits the prompt query
 
@@ -517,6 +807,12 @@ def find_email (query, top_n, df, df_long, advance_filter = 'N'):
          df_long (dataframe): dataframe of emails in long format
          person_name (list): the list of person's names
          advance_filter (str): whether to use advance filtering
+         provider (EmbeddingProvider): the provider the embeddings of df_long 
+         were made with, see embedding_providers.load_provider. Default None
+         for the Azure OpenAI deployment
+         query_cache (QueryCache): the query embedding and named entities are 
+         taken from it when the same query was asked before. Default None for 
+         default_query_cache, kept in memory for the session
      Raises:
          TypeError: If 'df' or 'df_long' is not pandas dataframe, If 'query' or 
          'advance_filter' is not a string, If 'top_n' is not integer
@@ -536,13 +832,20 @@ def find_email (query, top_n, df, df_long, advance_filter = 'N'):
     if not isinstance(advance_filter, str):
         raise TypeError ('advance_filter needs to be a str')
         
-    embedding = generate_embeddings(
-            query,
-            model='text_embedding-ada-002-default' 
-        )
+    if query_cache is None:
+        query_cache = default_query_cache
+
+    if provider is not None:
+        embedding = query_cache.get_or_compute('embedding', query, provider.cache_key, 
+                                               lambda: provider.embed_query(query))
+    else:
+        embedding = query_cache.get_or_compute('embedding', query, 'text_embedding-ada-002-default', 
+                                               lambda: generate_embeddings(query, model='text_embedding-ada-002-default'))
     
-    NER = get_NER(labels, query)
     if advance_filter != 'N':
+        # the entities are only needed for the advance filtering
+        NER = query_cache.get_or_compute('ner', query, 'gpt-35-turbo-16k-0613-vanilla', 
+                                         lambda: get_NER(labels, query))
         if 'person' in NER:
             df_long = find_person (df_long, query, NER['person'])
         
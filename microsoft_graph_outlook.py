@@ -5,17 +5,252 @@ messages and getting the attachments through Microsoft Graph API.
 
 Classes:
     MSGraphOutlook
+    AsyncMSGraphOutlook
 """
+import asyncio
 import base64
+import hashlib
+import json
+import threading
+import requests
 import yaml
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 import os
 import html2text
 import re
 from ms_graph.client_GBNOC import MicrosoftGraphClient
 
-class MSGraphOutlook (object):
+#email properties used by extract_email_info, get_attachments and EmailArchive,
+#only these are requested from Microsoft Graph unless a different 'select' is given
+EMAIL_SELECT_FIELDS = ['id', 'changeKey', 'conversationId', 'subject', 'body', 'sender',
+                       'sentDateTime', 'toRecipients', 'ccRecipients', 'webLink',
+                       'hasAttachments']
+
+#folder properties kept in the folder tree cache
+FOLDER_SELECT_FIELDS = ['displayName', 'parentFolderId', 'childFolderCount',
+                        'totalItemCount']
+
+class _OutlookRequestMixin (object):
+
+    """
+    The query options, headers and attachment paths shared by MSGraphOutlook
+    and AsyncMSGraphOutlook, so that both send the same requests and save
+    attachments under the same names.
+    """
+
+    def _build_filter_query (self, subject = None, start_date = None,
+                             end_date = None, sender = None, top_n = None) -> str:
+
+        """
+        Builds the $filter query option, and the $top option if 'top_n' is
+        given, from the email filter requirements of get_emails
+        """
+        
+        filter_query = ''
+        
+        if subject is not None:
+            #check if subject is a string
+            if not isinstance(subject, str):
+                raise TypeError ('Email subject needs to be a string')
+            else:
+                filter_query = filter_query + f"subject%20eq%20%27{subject}%27"
+        
+        if start_date is not None:
+            #check if date is a string
+            if not isinstance(start_date, str):
+                raise TypeError ('Email start received date needs to be a date')
+            else:
+                start_date  = start_date  + 'T00:00:00Z'
+                #if filter query is not empty, add an 'and' expression to the join
+                if filter_query == '':
+                    filter_query = filter_query + f'receivedDateTime%20ge%20{start_date}'
+                else:
+                    filter_query = filter_query + f'%20and%20receivedDateTime%20ge%20{start_date}'
+        
+        if end_date is not None:
+            #check if date is a string
+            if not isinstance(end_date, str):
+                raise TypeError ('Email end received date needs to be a date')
+            else:
+                end_date = end_date + 'T23:59:59Z'
+                #if filter query is not empty, add an 'and' expression to the join
+                if filter_query == '':
+                    filter_query = filter_query + f'receivedDateTime%20le%20{end_date}'
+                else:
+                    filter_query = filter_query + f'%20and%20receivedDateTime%20le%20{end_date}'
+                    
+        if sender is not None:
+            #check if sender is a string 
+            if not isinstance(sender, str):
+                raise TypeError ('Email sender needs to be a string')
+            else:
+                #if filter query is not empty, add an 'and' expression to the join
+                if filter_query == '':
+                    filter_query = filter_query + f'sender/emailAddress/address%20eq%20%27{sender}%27'
+                else:
+                    filter_query = filter_query + f'%20and%20sender/emailAddress/address%20eq%20%27{sender}%27'
+        
+        if top_n is not None:
+            #check if top_n is an integer
+            if not isinstance(top_n, int):
+                raise TypeError ('top N needs to be an integer')
+            else:
+                filter_query = filter_query + f'&%24top={top_n}'
+
+        return filter_query
+
+    def _build_select_query (self, select) -> str:
+
+        """
+        Builds the $select query option from a list of email properties, empty
+        if 'select' is None so that all properties are returned
+        """
+
+        if select is None:
+            return ''
+
+        if not isinstance(select, list):
+            raise TypeError ('select needs to be a list')
+
+        return '$select=' + ','.join(select)
+
+    def _build_prefer_header (self, body_type, max_page_size = None):
+
+        """
+        Builds the Prefer header asking for the email body in 'body_type'
+        format and for pages of at most 'max_page_size' emails, None if
+        neither is needed
+        """
+
+        preferences = []
+
+        if max_page_size is not None:
+            preferences.append(f'odata.maxpagesize={max_page_size}')
+
+        if body_type is not None:
+            if body_type not in ['text', 'html']:
+                raise ValueError ("body type needs to be 'text' or 'html'")
+            preferences.append(f'outlook.body-content-type="{body_type}"')
+
+        if len(preferences) == 0:
+            return None
+
+        return {'Prefer': ', '.join(preferences)}
+
+    def _build_messages_endpoint (self, folder_id = None, query = '') -> str:
+
+        """
+        Builds the endpoint listing the emails in outlook, or in a folder, with
+        the query options in 'query'
+        """
+
+        if folder_id is None:
+            endpoint = '/me/messages'
+        else:
+            if not isinstance(folder_id, str):
+                raise TypeError ('Email folder id needs to be a string')
+            else:
+                endpoint = '/me/mailFolders/{0}/messages'.format(folder_id)
+
+        if query != '':
+            endpoint = endpoint + '?' + query
+
+        return endpoint
+
+    def _build_count_endpoint (self, folder_id = None, received_before = None) -> str:
+
+        """
+        Builds the endpoint counting the emails in outlook, or in a folder,
+        received until 'received_before' if given
+        """
+
+        #only the count is needed, so fetch a single email id along with it
+        endpoint = self._build_messages_endpoint(folder_id, '$count=true&$top=1&$select=id')
+
+        if received_before is not None:
+            endpoint = endpoint + f'&$filter=receivedDateTime%20le%20{received_before}'
+
+        return endpoint
+
+    def _build_page_endpoint (self, batch_size : int, skip : int, select_query = '',
+                              received_before = None) -> str:
+
+        """
+        Builds the endpoint of one page of all emails, newest first, received
+        until 'received_before' if given
+        """
+
+        endpoint = self._build_messages_endpoint(
+            query = '$top={0}&$skip={1}&$orderby=receivedDateTime%20desc'.format(batch_size, skip))
+        if received_before is not None:
+            endpoint = endpoint + f'&$filter=receivedDateTime%20le%20{received_before}'
+        if select_query != '':
+            endpoint = endpoint + '&' + select_query
+
+        return endpoint
+
+    def _build_attachments_endpoint (self, email_id : str, attachment_id = None,
+                                     select = None, content = False) -> str:
+
+        """
+        Builds the endpoint listing the attachments of an email, or of one of
+        its attachments, the raw content of the attachment with 'content'
+        """
+
+        endpoint = '/me/messages/{0}/attachments'.format(email_id)
+        if attachment_id is not None:
+            endpoint = endpoint + '/{0}'.format(attachment_id)
+            if content:
+                endpoint = endpoint + '/$value'
+        if select is not None:
+            endpoint = endpoint + '?$select=' + ','.join(select)
+
+        return endpoint
+
+    def _crawl_start (self) -> str:
+
+        """
+        The current time in UTC, as used in a receivedDateTime filter. Emails
+        received after the start of a crawl are left out of it, so that they
+        do not shift the pages, sync_emails picks them up
+        """
+
+        return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    def _merge_pages (self, pages : list) -> list:
+
+        """
+        Joins pages fetched concurrently in order, keeping only the first copy
+        of an email found on two pages
+        """
+
+        seen = set()
+        content = []
+        for email_content in chain(*pages):
+            if email_content['id'] not in seen:
+                seen.add(email_content['id'])
+                content.append(email_content)
+
+        return content
+
+    def _attachment_path (self, directory : str, email_id : str, attachment : dict) -> str:
+
+        """
+        Path an attachment is saved to, its name prefixed with a hash of its
+        email and attachment id so that attachments of the same name in
+        different emails do not overwrite each other
+        """
+
+        prefix = hashlib.sha1('{0}/{1}'.format(email_id, attachment['id']).encode('utf-8')).hexdigest()[:12]
+        #keep only the file name part, in case the name holds a path
+        name = os.path.basename(attachment['name'].replace('\\', '/'))
+
+        return os.path.join(directory, f'{prefix}_{name}')
+
+
+class MSGraphOutlook (_OutlookRequestMixin):
     
     """
     A class for filtering out email messages, processing the messages and 
@@ -59,15 +294,21 @@ class MSGraphOutlook (object):
         
         return graph_client
     
-    def get_child_folder_id(self, graph_client, target_folder : str, main_folder = 'inbox'):
+    def get_child_folder_id(self, graph_client, target_folder : str, main_folder = 'inbox',
+                            cache_path = 'configs/ms_graph_folders.json'):
         """
-        Gets the folder id of a named subfolder.
+        Gets the folder id of a named subfolder, at any depth below the parent
+        folder. The nearest match is returned if several subfolders have the
+        same name. The folders are looked up in the cached folder tree, see
+        get_folder_tree, which is only refreshed if the name is not found.
 
         Args:
             graph_client (obj): microsoft graph client object
             target_folder (str): The name of the child folder to get the 
             folder id of
-            main_folder (str): The name of the parent folder, default is inbox
+            main_folder (str): The name or id of the parent folder, default is
+            inbox
+            cache_path (str): path of the json file caching the folder tree
 
         Raises:
             TypeError: If 'target_folder' or 'main_folder' is not a string
@@ -89,22 +330,227 @@ class MSGraphOutlook (object):
         if not isinstance(target_folder, str):
             raise TypeError ('Target folder name needs to be a string')    
         
+        main_folder_id = self._resolve_folder_id(graph_client, main_folder, cache_path)
 
-        childfolders = graph_client.graph_session.make_request(method='get',
-                                                               endpoint='/me/mailFolders/{0}/childFolders'.format(main_folder))
-        
-        childfolders_names = [x['displayName'] for x in childfolders[1]['value']]
+        #look in the cached tree first, the folder may be new if not found
+        for refresh in [False, True]:
+            folder_tree = self.get_folder_tree(graph_client, cache_path, refresh = refresh)
 
-        try:
-            target_folder_id = childfolders[1]['value'][childfolders_names.index(target_folder)]['id']
-            return target_folder_id
-        except ValueError:
-            print (f'No subfolder with name "{target_folder}" found')
+            #search the levels below the parent one at a time, nearest first
+            parent_ids = [main_folder_id]
+            while len(parent_ids) > 0:
+                children = [x for x in folder_tree.values()
+                            if x['parentFolderId'] in parent_ids]
+                for child in children:
+                    if child['displayName'] == target_folder:
+                        return child['id']
+                parent_ids = [x['id'] for x in children]
+
+        print (f'No subfolder with name "{target_folder}" found')
+
+    def get_child_folders(self, graph_client, main_folders : list) -> dict:
+        """
+        Gets the child folders of many folders at once, looking up 20 folders
+        per request through Microsoft Graph JSON batching.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            main_folders (list): The names or ids of the parent folders
+
+        Raises:
+            TypeError: If 'main_folders' is not a list
+
+        Returns:
+            dict: each parent folder mapped to a dict of its child folder
+            names and ids, empty if the parent folder cannot be found
+
+        Examples:
+            >>> get_child_folders(graph_client, ['inbox', 'sentitems'])
+            returns the names and ids of the subfolders of Inbox and Sent Items
+
+        """
+
+        if not isinstance(main_folders, list):
+            raise TypeError ('Main folders needs to be a list')
+
+        responses = graph_client.graph_session.make_batch_request(
+            [{'url': '/me/mailFolders/{0}/childFolders?$select=id,displayName'.format(main_folder)}
+             for main_folder in main_folders])
+
+        child_folders = {}
+        for main_folder, response in zip(main_folders, responses):
+            if response['status'] != 200:
+                print (f'No folder with name "{main_folder}" found')
+                child_folders[main_folder] = {}
+            else:
+                child_folders[main_folder] = {x['displayName']: x['id'] for x in response['body']['value']}
+
+        return child_folders
+
+    def get_folder_tree(self, graph_client, cache_path = 'configs/ms_graph_folders.json',
+                        refresh = True) -> dict:
+        """
+        Gets every mail folder in the mailbox, at any depth. The folders are
+        cached in 'cache_path' with the deltaLink of the Microsoft Graph folder
+        delta query, so a refresh only fetches the folders added, renamed,
+        moved or removed since the previous refresh.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            cache_path (str): path of the json file caching the folder tree
+            refresh (bool): update the cached folders first, default True. If
+            False the cached folders are returned without a request, unless
+            there are none yet
+
+        Raises:
+            TypeError: If 'cache_path' is not a string
+
+        Returns:
+            dict: each folder id mapped to a dict of its 'id', 'displayName',
+            'parentFolderId', 'childFolderCount', 'totalItemCount' and 'path',
+            the names of the folders from the top folder down joined by '/'
+
+        Examples:
+            >>> folder_tree = get_folder_tree(graph_client)
+            >>> [x['path'] for x in folder_tree.values()]
+            returns the paths of all folders, e.g. 'Inbox/Instant Quote'
+
+        """
+
+        if not isinstance(cache_path, str):
+            raise TypeError ('Cache path needs to be a string')
+
+        cache = self._load_json_file(cache_path)
+        folders = cache.get('folders', {})
+
+        if refresh or 'deltaLink' not in cache:
+            initial_endpoint = '/me/mailFolders/delta?' + self._build_select_query(FOLDER_SELECT_FIELDS)
+            endpoint = cache.get('deltaLink', initial_endpoint)
+
+            while True:
+                try:
+                    content = graph_client.graph_session.make_request(method='get',
+                                                                      endpoint=endpoint)
+                except requests.HTTPError as error:
+                    #the saved deltaLink has expired, fetch all folders again
+                    if ('deltaLink' in cache and error.response is not None
+                        and error.response.status_code in (400, 410)):
+                        print('Folder deltaLink has expired, fetching all folders')
+                        del cache['deltaLink']
+                        folders = {}
+                        endpoint = initial_endpoint
+                        continue
+                    raise
+
+                for folder in content[1]['value']:
+                    if '@removed' in folder:
+                        folders.pop(folder['id'], None)
+                    else:
+                        folders[folder['id']] = {x: folder.get(x) for x in ['id'] + FOLDER_SELECT_FIELDS}
+
+                if '@odata.nextLink' in content[1]:
+                    endpoint = content[1]['@odata.nextLink']
+                else:
+                    break
+
+            cache['deltaLink'] = content[1]['@odata.deltaLink']
+            cache['folders'] = folders
+            self._save_json_file(cache_path, cache)
+
+        folder_tree = {}
+        for folder_id, folder in folders.items():
+            names = []
+            parent_id = folder_id
+            #top folders have the hidden root folder as parent
+            while parent_id in folders and len(names) <= len(folders):
+                names.append(folders[parent_id]['displayName'])
+                parent_id = folders[parent_id]['parentFolderId']
+            folder_tree[folder_id] = dict(folder, path = '/'.join(reversed(names)))
+
+        return folder_tree
+
+    def find_folder_id(self, graph_client, folder : str,
+                       cache_path = 'configs/ms_graph_folders.json') -> str:
+        """
+        Gets the folder id of a folder from its path, its name or its
+        well-known name, looked up in the cached folder tree. The tree is only
+        refreshed if the folder is not found.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            folder (str): the folder path, e.g. 'Inbox/Projects/2024', the
+            folder name if no other folder has the same name, or a well-known
+            name such as 'inbox' or 'sentitems'
+            cache_path (str): path of the json file caching the folder tree
+
+        Raises:
+            TypeError: If 'folder' is not a string
+            ValueError: If the 'folder' cannot be found, or if several folders
+            have that name
+
+        Returns:
+            str: the folder id
+
+        Examples:
+            >>> find_folder_id(graph_client, 'Inbox/Instant Quote')
+            returns the folder id of the Instant Quote subfolder of Inbox
+
+        """
+
+        if not isinstance(folder, str):
+            raise TypeError ('Folder needs to be a string')
+
+        for refresh in [False, True]:
+            folder_tree = self.get_folder_tree(graph_client, cache_path, refresh = refresh)
+
+            matches = [x['id'] for x in folder_tree.values() if x['path'].lower() == folder.lower()]
+            if len(matches) == 0:
+                matches = [x['id'] for x in folder_tree.values() if x['displayName'].lower() == folder.lower()]
+
+            if len(matches) == 1:
+                return matches[0]
+            if len(matches) > 1:
+                raise ValueError (f'Several folders are named "{folder}": '
+                                  + ', '.join(folder_tree[x]['path'] for x in matches))
+
+        folder_id = self._resolve_folder_id(graph_client, folder, cache_path)
+        if folder_id is None:
+            raise ValueError (f'No folder "{folder}" found')
+
+        return folder_id
+
+    def _resolve_folder_id (self, graph_client, folder : str, cache_path : str) -> str:
+
+        """
+        Turns a well-known folder name such as 'inbox' into the folder id,
+        cached with the folder tree. Folder ids are returned as they are, and
+        None if there is no such folder
+        """
+
+        cache = self._load_json_file(cache_path)
+        well_known = cache.get('well_known', {})
+
+        if folder in cache.get('folders', {}):
+            return folder
+
+        if folder not in well_known:
+            content = graph_client.graph_session.make_request(method='get',
+                                endpoint='/me/mailFolders/{0}?$select=id'.format(folder))
+            if content[0] == 404:
+                return None
+            if content[1]['id'] == folder:
+                return folder
+            well_known[folder] = content[1]['id']
+            cache['well_known'] = well_known
+            self._save_json_file(cache_path, cache)
+
+        return well_known[folder]
  
     
     def get_emails (self, graph_client, subject = None, start_date = None, 
                     end_date = None, sender = None, folder_id = None, 
-                    top_n = None) -> list:
+                    top_n = None, select = EMAIL_SELECT_FIELDS,
+                    body_type = None) -> list:
         """
         Gets the required email(s) based on the filter requirement. Default 
         extracts top 10 latest emails across all folders, including deleted items.
@@ -117,10 +563,15 @@ class MSGraphOutlook (object):
             sender (str): sender email address
             folder_id (str): email folder id
             top_n: number of N latest emails to extract
+            select (list): email properties to return, default is the 
+            properties used by extract_email_info. None returns all properties
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
 
         Raises:
             TypeError: If 'subject', 'date', 'sender' or 'folder_id' is not a 
-            string.  If 'top_n' is not an integer.
+            string.  If 'top_n' is not an integer. If 'select' is not a list.
+            ValueError: If 'body_type' is not 'text' or 'html'
             
         Returns:
             list: list containing email attributes
@@ -136,76 +587,27 @@ class MSGraphOutlook (object):
             on 2022-08-25
 
         """
+
+        filter_query = self._build_filter_query(subject, start_date, end_date,
+                                                sender, top_n)
+
+        select_query = self._build_select_query(select)
+        if select_query != '':
+            filter_query = filter_query + '&' + select_query
+
+        prefer_header = self._build_prefer_header(body_type)
         
-        filter_query = ''
-        
-        if subject is not None:
-            #check if subject is a string
-            if not isinstance(subject, str):
-                raise TypeError ('Email subject needs to be a string')
-            else:
-                filter_query = filter_query + f"subject%20eq%20%27{subject}%27"
+        endpoint = self._build_messages_endpoint(folder_id, '$filter=' + filter_query)
+
+        content = graph_client.graph_session.make_request(method='get',
+                                                          endpoint=endpoint,
+                                                          additional_headers=prefer_header)
         
-        if start_date is not None:
-            #check if date is a string
-            if not isinstance(start_date, str):
-                raise TypeError ('Email start received date needs to be a date')
-            else:
-                start_date  = start_date  + 'T00:00:00Z'
-                #if filter query is not empty, add an 'and' expression to the join
-                if filter_query == '':
-                    filter_query = filter_query + f'receivedDateTime%20ge%20{start_date}'
-                else:
-                    filter_query = filter_query + f'%20and%20receivedDateTime%20ge%20{start_date}'
+        email_content = content[1]['value']
         
-        if end_date is not None:
-            #check if date is a string
-            if not isinstance(end_date, str):
-                raise TypeError ('Email end received date needs to be a date')
-            else:
-                end_date = end_date + 'T23:59:59Z'
-                #if filter query is not empty, add an 'and' expression to the join
-                if filter_query == '':
-                    filter_query = filter_query + f'receivedDateTime%20le%20{end_date}'
-                else:
-                    filter_query = filter_query + f'%20and%20receivedDateTime%20le%20{end_date}'
-                    
-        if sender is not None:
-            #check if sender is a string 
-            if not isinstance(sender, str):
-                raise TypeError ('Email sender needs to be a string')
-            else:
-                #if filter query is not empty, add an 'and' expression to the join
-                if filter_query == '':
-                    filter_query = filter_query + f'sender/emailAddress/address%20eq%20%27{sender}%27'
-                else:
-                    filter_query = filter_query + f'%20and%20sender/emailAddress/address%20eq%20%27{sender}%27'
-        
-        if top_n is not None:
-            #check if top_n is an integer
-            if not isinstance(top_n, int):
-                raise TypeError ('top N needs to be an integer')
-            else:
-                filter_query = filter_query + f'&%24top={top_n}'
-        
-        if folder_id is not None:
-            #check if sender is a string 
-            if not isinstance(folder_id, str):
-                raise TypeError ('Email folder id needs to be a string')
-            else:
-                content = graph_client.graph_session.make_request(method='get',
-                                                                  endpoint='/me/mailFolders/{0}/messages?$filter={1}'\
-                                                                      .format(folder_id, filter_query))
-        else:
-            content = graph_client.graph_session.make_request(method='get',
-                                                              endpoint='/me/messages?$filter={0}'\
-                                                                  .format(filter_query))
-        
-        email_content = content[1]['value']
-        
-        return email_content 
-    
-    def extract_email_info(self, email_content : dict) -> dict:
+        return email_content 
+    
+    def extract_email_info(self, email_content : dict) -> dict:
         
         """
         Extract and process the email information
@@ -238,7 +640,11 @@ class MSGraphOutlook (object):
         urls = re.findall(r'(https?://\S+)', message)
         urls = [value for value in urls if 'sharepoint' in value]
 
-        email_info['message'] = html2text.html2text(message)     
+        if email_content['body'].get('contentType', 'html').lower() == 'text':
+            #body was requested as text, no html to convert
+            email_info['message'] = message
+        else:
+            email_info['message'] = html2text.html2text(message)     
         email_info['url'] = urls
         
         if 'sender' in email_content:
@@ -258,6 +664,8 @@ class MSGraphOutlook (object):
         email_info['cc_names'] = [x['emailAddress']['name'] for x in email_content['ccRecipients']]
         email_info['cc_email_address']= [x['emailAddress']['address'] for x in email_content['ccRecipients']]
         email_info['email_weblink'] =  email_content['webLink']
+        #links the email to the other emails of its thread
+        email_info['conversation_id'] = email_content.get('conversationId')
         
         return email_info
         
@@ -292,27 +700,173 @@ class MSGraphOutlook (object):
         if email_content['hasAttachments'] == False:
             print('Email has no attachments')
         else:
-            if not os.path.exists(directory):
-                print(f'"{directory}" does not exist, creating folder now')
-                os.makedirs(directory)
-            
-            attachments = graph_client.graph_session.make_request(method='get',endpoint='/me/messages/{0}/attachments'.format(email_content['id']))
-            attachment_id = [x['id'] for x in attachments[1]['value']]
-            attachment_name = [x['name'] for x in attachments[1]['value']]
-
-            for i in range(len(attachment_id)):
-                graph_client.graph_session.make_request(method='get',
-                                                    endpoint='/me/messages/{0}/attachments/{1}/$value'.format(email_content['id'], attachment_id[i] ), 
-                                                    download = True,  
-                                                    download_path = f"{directory}/{attachment_name[i]}")
-                print(f'Downloaded {attachment_name[i]} to {directory}')
+            self.get_attachments_batch(graph_client, [email_content], directory)
+
+    def get_attachments_batch(self, graph_client, email_contents : list,
+                              directory : str, inline_size_limit = 262144,
+                              inline_batch_bytes = 1048576, max_workers = 4) -> None:
+
+        """
+        Find and download all attachments in many emails. The attachments of
+        20 emails are listed per request through Microsoft Graph JSON batching,
+        and file attachments up to 'inline_size_limit' bytes are fetched with
+        their content, up to 20 and 'inline_batch_bytes' bytes per request, so
+        that only one batch of contents is held in memory at a time. Larger
+        and non-file attachments are streamed to disk, 'max_workers' at a
+        time, and resumed if interrupted.
+
+        Every attachment is saved under a name made unique by a prefix of its
+        email and attachment id, as names such as image001.png repeat across
+        emails. The size, modification time and SHA-256 of every saved
+        attachment are appended to attachments.jsonl in 'directory', and an
+        attachment is only skipped when its file still matches them. Only the
+        files whose modification time has changed are hashed again.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            email_contents (list): list of dictionaries of the raw email
+            attributes
+            directory (str): directory to store the attachments
+            inline_size_limit (int): largest attachment size in bytes fetched
+            through a batch, default 256 KB
+            inline_batch_bytes (int): most attachment bytes fetched per batch
+            request, default 1 MB
+            max_workers (int): number of large attachments downloaded
+            concurrently, default 4
+
+        Raises:
+            TypeError: If 'email_contents' is not a list.
+
+        Returns:
+            None
+
+        Examples:
+            >>> get_attachments_batch(graph_client, email_content, 'test')
+            downloads all attachments in all email dictionaries in to test
+            folder
+
+        """
+
+        if not isinstance(email_contents, list):
+            raise TypeError ('Email contents needs to be a list')
+
+        email_ids = [x['id'] for x in email_contents if x['hasAttachments']]
+
+        if len(email_ids) == 0:
+            print('Emails have no attachments')
+            return
+
+        if not os.path.exists(directory):
+            print(f'"{directory}" does not exist, creating folder now')
+            os.makedirs(directory)
+
+        #list the attachments of the emails, without their content
+        listings = graph_client.graph_session.make_batch_request(
+            [{'url': self._build_attachments_endpoint(email_id, select = ['id', 'name', 'size'])}
+             for email_id in email_ids])
+
+        manifest_path = os.path.join(directory, 'attachments.jsonl')
+        manifest = self._load_manifest(manifest_path)
+        manifest_lock = threading.Lock()
+
+        def record_attachment(download_path, sha256 = None):
+            #size, time and hash of a completed download, checked on the next run
+            if sha256 is None:
+                sha256 = self._file_digest(download_path)[1]
+            stat = os.stat(download_path)
+            entry = {'name': os.path.basename(download_path), 'size': stat.st_size,
+                     'mtime_ns': stat.st_mtime_ns, 'sha256': sha256}
+            with manifest_lock:
+                manifest[entry['name']] = entry
+                with open(manifest_path, 'a', encoding='utf-8') as file:
+                    file.write(json.dumps(entry) + '\n')
+
+        inline_attachments = []
+        separate_attachments = []
+
+        for email_id, listing in zip(email_ids, listings):
+            if listing['status'] != 200:
+                print(f'Could not list attachments of email {email_id}, status code {listing["status"]}')
+                continue
+
+            for attachment in listing['body']['value']:
+                download_path = self._attachment_path(directory, email_id, attachment)
+                recorded = manifest.get(os.path.basename(download_path))
+
+                if self._matches_record(download_path, recorded):
+                    if os.stat(download_path).st_mtime_ns != recorded.get('mtime_ns'):
+                        #matched by its hash, record the new time so it is not hashed again
+                        record_attachment(download_path, recorded['sha256'])
+                    print(f'{attachment["name"]} already in {directory}, skipped')
+                    continue
+
+                #a file that was not recorded or has changed is downloaded again
+                if os.path.exists(download_path):
+                    os.remove(download_path)
+
+                if (attachment.get('@odata.type') == '#microsoft.graph.fileAttachment'
+                      and attachment['size'] <= inline_size_limit):
+                    inline_attachments.append((email_id, attachment))
+                else:
+                    separate_attachments.append((email_id, attachment))
+
+        #group the small attachments so one batch holds at most 20 of them and
+        #inline_batch_bytes of content
+        inline_batches = []
+        batch_bytes = 0
+        for email_id, attachment in inline_attachments:
+            if (len(inline_batches) == 0 or len(inline_batches[-1]) == 20
+                    or batch_bytes + attachment['size'] > inline_batch_bytes):
+                inline_batches.append([])
+                batch_bytes = 0
+            inline_batches[-1].append((email_id, attachment))
+            batch_bytes = batch_bytes + attachment['size']
+
+        for inline_batch in inline_batches:
+            #small file attachments come back with their content base64 encoded
+            contents = graph_client.graph_session.make_batch_request(
+                [{'url': self._build_attachments_endpoint(email_id, attachment['id'])}
+                 for email_id, attachment in inline_batch])
+
+            for (email_id, attachment), content in zip(inline_batch, contents):
+                if content['status'] != 200:
+                    separate_attachments.append((email_id, attachment))
+                    continue
+
+                download_path = self._attachment_path(directory, email_id, attachment)
+                with open(download_path + '.part', 'wb') as file:
+                    file.write(base64.b64decode(content['body']['contentBytes']))
+                os.replace(download_path + '.part', download_path)
+                record_attachment(download_path)
+                print(f'Downloaded {attachment["name"]} to {directory}')
+
+        #the size Graph reports for an attachment is not the exact file size,
+        #the size and hash are recorded from the downloaded file instead
+        def download_attachment(email_id, attachment):
+            download_path = self._attachment_path(directory, email_id, attachment)
+            graph_client.graph_session.download_file(
+                endpoint=self._build_attachments_endpoint(email_id, attachment['id'], content = True),
+                download_path=download_path)
+            record_attachment(download_path)
+            print(f'Downloaded {attachment["name"]} to {directory}')
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloads = [executor.submit(download_attachment, email_id, attachment)
+                         for email_id, attachment in separate_attachments]
+            #raise the first download error, if any
+            for download in downloads:
+                download.result()
     
     
     def send_email (self, graph_client, subject: str, message: str, 
-                    to_address: str, attachment_paths = None) -> None:
+                    to_address: str, attachment_paths = None,
+                    upload_threshold = 3145728) -> None:
         
         """
-        Send email based on given information
+        Send email based on given information. Attachments are sent inline 
+        when they add up to at most 'upload_threshold' bytes. Otherwise the
+        email is created as a draft, attachments above 'upload_threshold' are
+        streamed to it through upload sessions, and the draft is sent.
 
         Args:
             graph_client (obj): microsoft graph client object
@@ -321,6 +875,8 @@ class MSGraphOutlook (object):
             to_address (str): the email address to send the email to
             attachment_paths (list): optional, list of paths of the attachments
             to be sent
+            upload_threshold (int): largest size in bytes sent inline, default
+            3 MB as Microsoft Graph rejects requests above 4 MB
 
         Raises:
             TypeError: If 'subject', 'message' or 'to_address' is not a dict.
@@ -369,24 +925,87 @@ class MSGraphOutlook (object):
             
             if not isinstance(attachment_paths, list):
                 raise TypeError ('attachment paths needs to be in a list')
+
+            #too large to send inline, go through a draft instead
+            if sum(os.path.getsize(x) for x in attachment_paths) > upload_threshold:
+                self._send_email_with_upload(graph_client, email_payload["message"],
+                                             attachment_paths, upload_threshold)
+                return
                 
             for attachment_path in attachment_paths:
-                with open(attachment_path, "rb") as file:
-                    content_bytes = file.read()
-                
-                base64_content = base64.b64encode(content_bytes).decode("utf-8")
-                attachment = {
-                        "@odata.type": "#microsoft.graph.fileAttachment",
-                        "name": attachment_path.split("/")[-1],
-                        "contentBytes": base64_content,
-                    }
-                email_payload["message"]["attachments"].append(attachment)
+                email_payload["message"]["attachments"].append(
+                    self._file_attachment(attachment_path))
         
         graph_client.graph_session.make_request(method='post',
                                                 endpoint = "/me/sendMail", 
                                                 json = email_payload)
+
+    def _send_email_with_upload (self, graph_client, email_message : dict,
+                                 attachment_paths : list,
+                                 upload_threshold : int) -> None:
+
+        """
+        Creates the email as a draft, adds the attachments up to
+        'upload_threshold' bytes inline and streams the larger ones through
+        upload sessions, then sends the draft. The draft is deleted if any
+        step fails.
+        """
+
+        draft = graph_client.graph_session.make_request(method='post',
+                                                        endpoint = "/me/messages",
+                                                        json = email_message)
+        draft_id = draft[1]['id']
+
+        try:
+            for attachment_path in attachment_paths:
+                size = os.path.getsize(attachment_path)
+
+                if size <= upload_threshold:
+                    graph_client.graph_session.make_request(method='post',
+                                        endpoint = "/me/messages/{0}/attachments".format(draft_id),
+                                        json = self._file_attachment(attachment_path))
+                else:
+                    upload_session = graph_client.graph_session.make_request(method='post',
+                                        endpoint = "/me/messages/{0}/attachments/createUploadSession".format(draft_id),
+                                        json = {
+                                            "AttachmentItem": {
+                                                "attachmentType": "file",
+                                                "name": os.path.basename(attachment_path),
+                                                "size": size,
+                                            }
+                                        })
+                    graph_client.graph_session.upload_file(upload_url = upload_session[1]['uploadUrl'],
+                                                           file_path = attachment_path)
+
+            graph_client.graph_session.make_request(method='post',
+                                                    endpoint = "/me/messages/{0}/send".format(draft_id),
+                                                    expect_no_response = True)
+        except Exception:
+            #do not leave a half built draft behind
+            graph_client.graph_session.make_request(method='delete',
+                                                    endpoint = "/me/messages/{0}".format(draft_id),
+                                                    expect_no_response = True)
+            raise
+
+    def _file_attachment (self, attachment_path : str) -> dict:
+
+        """
+        Reads a file into the base64 encoded attachment structure sent inline
+        with an email
+        """
+
+        with open(attachment_path, "rb") as file:
+            content_bytes = file.read()
+
+        base64_content = base64.b64encode(content_bytes).decode("utf-8")
+
+        return {
+                "@odata.type": "#microsoft.graph.fileAttachment",
+                "name": os.path.basename(attachment_path),
+                "contentBytes": base64_content,
+            }
     
-    def count_emails (self, graph_client, folder_id = None) -> int:
+    def count_emails (self, graph_client, folder_id = None, received_before = None) -> int:
         
         """
         Counts the number of emails in outlook by default, else the number of 
@@ -395,6 +1014,8 @@ class MSGraphOutlook (object):
         Args:
             graph_client (obj): microsoft graph client object
             folder_id (str): email folder id
+            received_before (str): only count the emails received until then,
+            e.g. '2024-01-31T23:59:59Z', default None counts all emails
 
         Raises:
             TypeError: If 'email folder id' is not a string.
@@ -409,28 +1030,40 @@ class MSGraphOutlook (object):
 
         """
         
-        if folder_id is None:
-            content =graph_client.graph_session.make_request(method='get',
-                                        endpoint='/me/messages?$count=true')
+        endpoint = self._build_count_endpoint(folder_id, received_before)
 
-        else:
-            if not isinstance(folder_id, str):
-                raise TypeError ('Email folder id needs to be a string')
-            else:
-                content = graph_client.graph_session.make_request(method='get',
-                        endpoint='/me/mailFolders/{0}/messages?$count=true'
-                        .format(folder_id))
-        
+        content = graph_client.graph_session.make_request(method='get', endpoint=endpoint)
 
         return content[1]['@odata.count']
     
-    def get_emails_all (self, graph_client) -> list:
+    def get_emails_all (self, graph_client, max_workers = 1,
+                        select = EMAIL_SELECT_FIELDS, body_type = None) -> list:
         
         """
-        Get all emails in outlook
+        Get all emails in outlook. The emails are fetched in pages of 500, 
+        with 'max_workers' pages in flight at the same time. The pages are put
+        back together in order, so the result does not depend on 'max_workers'.
+        Emails received after the call starts are left out, sync_emails picks
+        them up. If emails still move across the pages while they are fetched,
+        e.g. emails removed meanwhile or received at the same second, some
+        are found twice and others missed. The copies are dropped, and if
+        emails were missed all emails are listed again through iter_emails.
 
         Args:
             graph_client (obj): microsoft graph client object
+            max_workers (int): number of pages fetched concurrently, default 1
+            fetches the pages one after another. Exchange Online allows 4
+            concurrent requests per mailbox, beyond that requests get throttled
+            select (list): email properties to return, default is the 
+            properties used by extract_email_info. None returns all properties
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
+
+        Raises:
+            TypeError: If 'max_workers' is not an integer. If 'select' is not
+            a list.
+            ValueError: If 'max_workers' is less than 1. If 'body_type' is not
+            'text' or 'html'
             
         Returns:
             list
@@ -439,23 +1072,601 @@ class MSGraphOutlook (object):
             >>> get_emails_all(graph_client)
             gets all emails in outlook
 
+            >>> get_emails_all(graph_client, max_workers = 4)
+            gets all emails in outlook, 4 pages at a time
+
         """
+
+        if not isinstance(max_workers, int):
+            raise TypeError ('max workers needs to be an integer')
+
+        if max_workers < 1:
+            raise ValueError ('max workers needs to be at least 1')
         
-        total_count = self.count_emails(graph_client)
+        received_before = self._crawl_start()
+        total_count = self.count_emails(graph_client, received_before = received_before)
         
         batch_size = 500
         
+        skips = range(0, total_count, batch_size)
+
+        select_query = self._build_select_query(select)
+        prefer_header = self._build_prefer_header(body_type)
+
+        if max_workers == 1:
+            content = [self._get_emails_page(graph_client, batch_size, skip,
+                                             select_query, prefer_header, received_before)
+                       for skip in skips]
+        else:
+            #map returns the pages in the order of the skips, not completion
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                content = list(executor.map(
+                    lambda skip: self._get_emails_page(graph_client, batch_size, skip,
+                                                       select_query, prefer_header,
+                                                       received_before),
+                    skips))
+
+        content = self._merge_pages(content)
+
+        if len(content) < total_count:
+            #emails moved across the pages, list them again following nextLink
+            content = list(self.iter_emails(graph_client, select = select, body_type = body_type))
+
+        return content
+
+    def _get_emails_page (self, graph_client, batch_size : int, skip : int,
+                          select_query : str = '', prefer_header : dict = None,
+                          received_before = None) -> list:
+
+        """
+        Gets one page of emails, sorted by received date so that pages
+        fetched concurrently do not overlap
+        """
+
+        endpoint = self._build_page_endpoint(batch_size, skip, select_query, received_before)
+
+        temp = graph_client.graph_session.make_request(method='get',
+                            endpoint=endpoint,
+                            additional_headers=prefer_header)
+
+        return temp[1]['value']
+
+    def iter_emails (self, graph_client, folder_id = None, page_size = 500,
+                     select = EMAIL_SELECT_FIELDS, body_type = None):
+
+        """
+        Iterates over all emails in outlook by default, else over the emails in
+        a specific folder id. The emails are fetched one page at a time by
+        following @odata.nextLink, so only the current page is held in memory
+        and the emails can be processed while the next pages are not yet
+        fetched.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            folder_id (str): email folder id
+            page_size (int): number of emails fetched per request, default 500
+            select (list): email properties to return, default is the 
+            properties used by extract_email_info. None returns all properties
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
+
+        Raises:
+            TypeError: If 'folder_id' is not a string. If 'page_size' is not
+            an integer. If 'select' is not a list.
+            ValueError: If 'body_type' is not 'text' or 'html'
+
+        Yields:
+            dict: dictionary of the raw email attributes
+
+        Examples:
+            >>> for email_content in iter_emails(graph_client):
+                    extract_email_info(email_content)
+            processes the emails in outlook page by page
+
+        """
+
+        if not isinstance(page_size, int):
+            raise TypeError ('page size needs to be an integer')
+
+        endpoint = self._build_messages_endpoint(folder_id, '$top={0}'.format(page_size))
+
+        select_query = self._build_select_query(select)
+        if select_query != '':
+            endpoint = endpoint + '&' + select_query
+
+        prefer_header = self._build_prefer_header(body_type)
+
+        while endpoint is not None:
+            #nextLink keeps the $top and $select of the first request
+            content = graph_client.graph_session.make_request(method='get',
+                                                              endpoint=endpoint,
+                                                              additional_headers=prefer_header)
+
+            endpoint = content[1].get('@odata.nextLink')
+
+            for email_content in content[1]['value']:
+                yield email_content
+
+    def sync_emails (self, graph_client, folder_id = 'inbox',
+                     delta_path = 'configs/ms_graph_delta.json',
+                     select = EMAIL_SELECT_FIELDS, body_type = None) -> dict:
+
+        """
+        Gets the emails added, updated or removed in a folder since the last
+        sync through the Microsoft Graph delta query. The first sync of a
+        folder returns all emails in it, later syncs only return the changes.
+        The deltaLink of each folder is saved to 'delta_path' only after a
+        sync completes, so an interrupted sync is simply run again.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            folder_id (str): email folder id or well-known folder name,
+            default is inbox
+            delta_path (str): path of the json file storing the deltaLink of
+            each folder
+            select (list): email properties to return, default is the 
+            properties used by extract_email_info. None returns all properties.
+            Only used on the first sync, the deltaLink keeps the original
+            selection
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
+
+        Raises:
+            TypeError: If 'folder_id' or 'delta_path' is not a string. If
+            'select' is not a list.
+            ValueError: If the 'folder_id' cannot be found. If 'body_type' is
+            not 'text' or 'html'
+
+        Returns:
+            dict: 'added_updated' is the list of new or changed emails and
+            'removed' is the list of ids of emails deleted from the folder
+
+        Examples:
+            >>> sync_emails(graph_client)
+            gets all emails in inbox on the first run and only the emails that
+            changed since the previous run afterwards
+
+        """
+
+        if not isinstance(folder_id, str):
+            raise TypeError ('Email folder id needs to be a string')
+
+        if not isinstance(delta_path, str):
+            raise TypeError ('Delta path needs to be a string')
+
+        delta_links = self._load_json_file(delta_path)
+
+        initial_endpoint = '/me/mailFolders/{0}/messages/delta'.format(folder_id)
+        select_query = self._build_select_query(select)
+        if select_query != '':
+            initial_endpoint = initial_endpoint + '?' + select_query
+        endpoint = delta_links.get(folder_id, initial_endpoint)
+
+        prefer_header = self._build_prefer_header(body_type, max_page_size = 500)
+
+        added_updated = []
+        removed = []
+
+        while True:
+            try:
+                content = graph_client.graph_session.make_request(method='get',
+                                    endpoint=endpoint,
+                                    additional_headers=prefer_header)
+            except requests.HTTPError as error:
+                #the saved deltaLink has expired, start over with a full sync
+                if (folder_id in delta_links and error.response is not None
+                    and error.response.status_code in (400, 410)):
+                    print(f'deltaLink of "{folder_id}" has expired, running a full sync')
+                    del delta_links[folder_id]
+                    endpoint = initial_endpoint
+                    added_updated = []
+                    removed = []
+                    continue
+                raise
+
+            if content[0] == 404:
+                raise ValueError (f'No folder with id "{folder_id}" found')
+
+            for message in content[1]['value']:
+                if '@removed' in message:
+                    removed.append(message['id'])
+                else:
+                    added_updated.append(message)
+
+            if '@odata.nextLink' in content[1]:
+                endpoint = content[1]['@odata.nextLink']
+            else:
+                break
+
+        delta_links[folder_id] = content[1]['@odata.deltaLink']
+        self._save_json_file(delta_path, delta_links)
+
+        return {'added_updated': added_updated, 'removed': removed}
+
+    def crawl_folders (self, graph_client, folder_ids = None, max_workers = 4,
+                       select = EMAIL_SELECT_FIELDS, body_type = None,
+                       cache_path = 'configs/ms_graph_folders.json') -> dict:
+
+        """
+        Gets all emails folder by folder, with 'max_workers' folders fetched
+        at the same time, so that large folders such as an archive and the
+        inbox are ingested in parallel. All folders with emails are crawled
+        by default, largest first, or only 'folder_ids' so that one folder can
+        be refreshed on its own.
+
+        Args:
+            graph_client (obj): microsoft graph client object
+            folder_ids (list): ids or well-known names of the folders to
+            crawl, default None crawls every folder in the folder tree
+            max_workers (int): number of folders fetched concurrently, default
+            4. Exchange Online allows 4 concurrent requests per mailbox,
+            beyond that requests get throttled
+            select (list): email properties to return, default is the 
+            properties used by extract_email_info. None returns all properties
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
+            cache_path (str): path of the json file caching the folder tree
+
+        Raises:
+            TypeError: If 'folder_ids' is not a list. If 'max_workers' is not
+            an integer. If 'select' is not a list.
+            ValueError: If 'max_workers' is less than 1. If 'body_type' is not
+            'text' or 'html'
+
+        Returns:
+            dict: each folder id mapped to the list of its emails
+
+        Examples:
+            >>> crawl_folders(graph_client)
+            gets all emails in outlook, 4 folders at a time
+
+            >>> crawl_folders(graph_client, [find_folder_id(graph_client, 'Archive')])
+            gets all emails in the Archive folder
+
+        """
+
+        if not isinstance(max_workers, int):
+            raise TypeError ('max workers needs to be an integer')
+
+        if max_workers < 1:
+            raise ValueError ('max workers needs to be at least 1')
+
+        if folder_ids is None:
+            folder_tree = self.get_folder_tree(graph_client, cache_path)
+            #the largest folders take the longest, start them first
+            folders = sorted([x for x in folder_tree.values() if (x['totalItemCount'] or 0) > 0],
+                             key = lambda x: x['totalItemCount'], reverse = True)
+            folder_ids = [x['id'] for x in folders]
+        elif not isinstance(folder_ids, list):
+            raise TypeError ('Folder ids needs to be a list')
+
+        def crawl_folder(folder_id):
+            return list(self.iter_emails(graph_client, folder_id = folder_id,
+                                         select = select, body_type = body_type))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            content = list(executor.map(crawl_folder, folder_ids))
+
+        return dict(zip(folder_ids, content))
+
+    def _file_digest (self, path : str) -> tuple:
+
+        """
+        Size and SHA-256 hex digest of a file, read in chunks
+        """
+
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                sha256.update(chunk)
+
+        return os.path.getsize(path), sha256.hexdigest()
+
+    def _matches_record (self, path : str, recorded : dict) -> bool:
+
+        """
+        Whether a saved attachment still matches its manifest record. The size
+        and modification time are compared first, the file is only hashed if
+        its time has changed
+        """
+
+        if recorded is None or not os.path.exists(path):
+            return False
+
+        stat = os.stat(path)
+        if stat.st_size != recorded['size']:
+            return False
+
+        if stat.st_mtime_ns == recorded.get('mtime_ns'):
+            return True
+
+        return self._file_digest(path)[1] == recorded['sha256']
+
+    def _load_manifest (self, path : str) -> dict:
+
+        """
+        Loads the attachment manifest, a json lines file where the last line
+        of a file wins, and rewrites it without the replaced lines
+        """
+
+        manifest = {}
+        if not os.path.exists(path):
+            return manifest
+
+        lines = 0
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                lines = lines + 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    #a line cut short by a crash
+                    continue
+                manifest[entry['name']] = entry
+
+        if lines > len(manifest):
+            with open(path + '.tmp', 'w', encoding='utf-8') as file:
+                for entry in manifest.values():
+                    file.write(json.dumps(entry) + '\n')
+            os.replace(path + '.tmp', path)
+
+        return manifest
+
+    def _load_json_file (self, path : str) -> dict:
+
+        """
+        Loads a saved json file such as the deltaLinks or the folder tree,
+        empty if never saved
+        """
+
+        if not os.path.exists(path):
+            return {}
+
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def _save_json_file (self, path : str, content : dict) -> None:
+
+        """
+        Saves a json file, replacing the file in one step so a crash halfway
+        through never leaves a corrupted file behind
+        """
+
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump(content, file, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+class AsyncMSGraphOutlook (_OutlookRequestMixin):
+
+    """
+    The asyncio variant of MSGraphOutlook. Fetching emails and attachments
+    are coroutines taking an AsyncGraphSession, so that many requests can
+    wait on Microsoft Graph from one event loop. It shares only the request
+    building with MSGraphOutlook, the emails fetched are processed with
+    MSGraphOutlook, e.g. MSGraphOutlook().extract_email_info.
+
+    Examples:
+        >>> async with AsyncGraphSession(graph_client) as graph_session:
+                email_content = await AsyncMSGraphOutlook().get_emails_all(graph_session)
+    """
+
+    async def get_emails (self, graph_session, subject = None, start_date = None,
+                          end_date = None, sender = None, folder_id = None,
+                          top_n = None, select = EMAIL_SELECT_FIELDS,
+                          body_type = None) -> list:
+        """
+        Gets the required email(s) based on the filter requirement, same as
+        MSGraphOutlook.get_emails.
+
+        Args:
+            graph_session (obj): AsyncGraphSession object
+            subject, start_date, end_date, sender, folder_id, top_n, select,
+            body_type: see MSGraphOutlook.get_emails
+
+        Raises:
+            TypeError: If 'subject', 'date', 'sender' or 'folder_id' is not a
+            string.  If 'top_n' is not an integer. If 'select' is not a list.
+            ValueError: If 'body_type' is not 'text' or 'html'
+
+        Returns:
+            list: list containing email attributes
+
+        Examples:
+            >>> await get_emails(graph_session, sender = 'kyamamoto@singtel.com')
+            returns the emails sent by kyamamoto@singtel.com
+
+        """
+
+        filter_query = self._build_filter_query(subject, start_date, end_date,
+                                                sender, top_n)
+
+        select_query = self._build_select_query(select)
+        if select_query != '':
+            filter_query = filter_query + '&' + select_query
+
+        prefer_header = self._build_prefer_header(body_type)
+
+        endpoint = self._build_messages_endpoint(folder_id, '$filter=' + filter_query)
+
+        content = await graph_session.make_request(method='get',
+                                                   endpoint=endpoint,
+                                                   additional_headers=prefer_header)
+
+        return content[1]['value']
+
+    async def count_emails (self, graph_session, folder_id = None, received_before = None) -> int:
+
+        """
+        Counts the number of emails in outlook by default, else the number of
+        emails in specific folder id
+
+        Args:
+            graph_session (obj): AsyncGraphSession object
+            folder_id (str): email folder id
+            received_before (str): see MSGraphOutlook.count_emails
+
+        Raises:
+            TypeError: If 'email folder id' is not a string.
+
+        Returns:
+            integer
+
+        Examples:
+            >>> await count_emails(graph_session)
+            counts the number of emails in outlook
+
+        """
+
+        endpoint = self._build_count_endpoint(folder_id, received_before)
+
+        content = await graph_session.make_request(method='get', endpoint=endpoint)
+
+        return content[1]['@odata.count']
+
+    async def get_emails_all (self, graph_session, select = EMAIL_SELECT_FIELDS,
+                              body_type = None) -> list:
+
+        """
+        Get all emails in outlook. All pages of 500 emails are requested at
+        once, the session's concurrency limit decides how many are in flight.
+        The pages are put back together in order, dropping the emails found
+        twice and listing all emails again if some were missed, see
+        MSGraphOutlook.get_emails_all.
+
+        Args:
+            graph_session (obj): AsyncGraphSession object
+            select (list): email properties to return, default is the
+            properties used by extract_email_info. None returns all properties
+            body_type (str): 'text' or 'html', the format of the email body,
+            default None returns the body as stored in outlook
+
+        Raises:
+            TypeError: If 'select' is not a list.
+            ValueError: If 'body_type' is not 'text' or 'html'
+
+        Returns:
+            list
+
+        Examples:
+            >>> await get_emails_all(graph_session)
+            gets all emails in outlook
+
+        """
+
+        received_before = self._crawl_start()
+        total_count = await self.count_emails(graph_session, received_before = received_before)
+
+        batch_size = 500
+
+        select_query = self._build_select_query(select)
+        prefer_header = self._build_prefer_header(body_type)
+
+        #gather returns the pages in the order of the skips, not completion
+        content = await asyncio.gather(
+            *[self._get_emails_page(graph_session, batch_size, skip,
+                                    select_query, prefer_header, received_before)
+              for skip in range(0, total_count, batch_size)])
+
+        content = self._merge_pages(content)
+
+        if len(content) < total_count:
+            #emails moved across the pages, list them again following nextLink
+            content = await self._get_emails_following(graph_session, batch_size,
+                                                       select_query, prefer_header)
+
+        return content
+
+    async def _get_emails_page (self, graph_session, batch_size : int, skip : int,
+                                select_query : str = '', prefer_header : dict = None,
+                                received_before = None) -> list:
+
+        """
+        Gets one page of emails, sorted by received date so that pages
+        fetched concurrently do not overlap
+        """
+
+        endpoint = self._build_page_endpoint(batch_size, skip, select_query, received_before)
+
+        temp = await graph_session.make_request(method='get',
+                                                endpoint=endpoint,
+                                                additional_headers=prefer_header)
+
+        return temp[1]['value']
+
+    async def _get_emails_following (self, graph_session, batch_size : int,
+                                     select_query : str = '', prefer_header : dict = None) -> list:
+
+        """
+        Gets all emails one page after another, following @odata.nextLink
+        """
+
+        endpoint = self._build_messages_endpoint(query = '$top={0}'.format(batch_size))
+        if select_query != '':
+            endpoint = endpoint + '&' + select_query
+
         content = []
-        
-        for skip in range(0, total_count, batch_size):
-                temp = graph_client.graph_session.make_request(method='get',
-                                    endpoint="/me/messages?$top={0}&$skip={1}"
-                                    .format(batch_size, skip))
-                
-                content.append(temp[1]['value'])
-        content = list(chain(*content))
-        
+        while endpoint is not None:
+            temp = await graph_session.make_request(method='get',
+                                                    endpoint=endpoint,
+                                                    additional_headers=prefer_header)
+            endpoint = temp[1].get('@odata.nextLink')
+            content.extend(temp[1]['value'])
+
         return content
+
+    async def get_attachments (self, graph_session, email_content : dict,
+                               directory : str) -> None:
+
+        """
+        Find and download all attachments in email, all attachments are
+        downloaded concurrently
+
+        Args:
+            graph_session (obj): AsyncGraphSession object
+            email_content (dict): dictionary of the raw email attributes
+            directory (str): directory to store the attachments
+
+        Raises:
+            TypeError: If 'email_content' is not a dict.
+
+        Returns:
+            None
+
+        Examples:
+            >>> await asyncio.gather(*[get_attachments(graph_session, x, 'test')
+                                       for x in email_content])
+            downloads all attachments of all emails in to test folder
+
+        """
+
+        if not isinstance(email_content, dict):
+            raise TypeError ('Email content needs to be a dict')
+
+        if email_content['hasAttachments'] == False:
+            print('Email has no attachments')
+            return
+
+        if not os.path.exists(directory):
+            print(f'"{directory}" does not exist, creating folder now')
+            os.makedirs(directory, exist_ok=True)
+
+        attachments = await graph_session.make_request(method='get',
+                                                       endpoint=self._build_attachments_endpoint(email_content['id'], select = ['id', 'name']))
+
+        await asyncio.gather(
+            *[graph_session.make_request(method='get',
+                                         endpoint=self._build_attachments_endpoint(email_content['id'], attachment['id'], content = True),
+                                         download = True,
+                                         download_path = self._attachment_path(directory, email_content['id'], attachment))
+              for attachment in attachments[1]['value']])
+
+        for attachment in attachments[1]['value']:
+            print(f'Downloaded {attachment["name"]} to {directory}')
         
         
         
@@ -0,0 +1,552 @@
+import asyncio
+import functools
+import json as json_lib
+import logging
+import os
+import time
+import urllib.parse
+import zlib
+
+from typing import Dict
+from typing import List
+from typing import Union
+
+import aiohttp
+import requests
+
+from ms_graph.metrics_GBNOC import GraphMetrics
+from ms_graph.retry_GBNOC import RetryPolicy
+from ms_graph.retry_GBNOC import RetryStats
+from ms_graph.retry_GBNOC import TokenBucket
+
+
+class AsyncGraphSession():
+
+    """Serves as the asyncio Session for the Current Microsoft
+    Graph API."""
+
+    def __init__(
+        self,
+        client: object,
+        max_concurrency: int = 4,
+        pool_size: int = 100,
+        retry_policy: RetryPolicy = None,
+        rate_limiter: TokenBucket = None,
+        metrics: GraphMetrics = None
+    ) -> None:
+        """Initializes the `AsyncGraphSession` client.
+
+        ### Overview:
+        ----
+        The asyncio counterpart of `GraphSession`. All requests of
+        the session share one `aiohttp` connection pool, and at most
+        `max_concurrency` of them are in flight at the same time, so
+        many coroutines can wait on Microsoft Graph from a single
+        event loop. The session has to be closed, preferably by
+        using it as an async context manager.
+
+        ### Arguments:
+        ----
+        client (str): The Microsoft Graph API Python Client.
+
+        max_concurrency (int): The number of requests in flight at
+            the same time. Exchange Online allows 4 concurrent
+            requests per mailbox. (default: {4})
+
+        pool_size (int): The number of connections kept open.
+            (default: {100})
+
+        retry_policy (RetryPolicy): Decides which responses are
+            retried and the backoff between attempts.
+            (default: {RetryPolicy()})
+
+        rate_limiter (TokenBucket): Spaces out the requests, can be
+            shared with a `GraphSession` on the same mailbox.
+            (default: {16 requests per second})
+
+        metrics (GraphMetrics): Records the latency, bytes and
+            status code of every request sent, can be shared with
+            a `GraphSession`. (default: {GraphMetrics()})
+
+        ### Usage:
+        ----
+            >>> async with AsyncGraphSession(client=graph_client) as graph_session:
+                    content = await graph_session.make_request(method="get", endpoint="/me/messages")
+        """
+
+        from ms_graph.client_GBNOC import MicrosoftGraphClient
+
+        self.client: MicrosoftGraphClient = client
+        self.pool_size = pool_size
+
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate=16)
+        self.retry_stats = RetryStats()
+        self.metrics = metrics if metrics is not None else GraphMetrics()
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._request_session = None
+
+    async def __aenter__(self) -> "AsyncGraphSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Closes the session and all its pooled connections."""
+
+        if self._request_session is not None:
+            await self._request_session.close()
+            self._request_session = None
+
+    def metrics_report(self) -> str:
+        """Returns the request metrics and retry counters of the
+        session as a table, see `GraphMetrics.report`."""
+
+        return self.metrics.report(retry_stats=self.retry_stats)
+
+    def _get_request_session(self) -> aiohttp.ClientSession:
+        """Creates the `aiohttp` session on first use, as it has to
+        be created inside the running event loop."""
+
+        if self._request_session is None:
+            self._request_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                # Bodies are decompressed here, so their size on the wire is known.
+                auto_decompress=False,
+                # Pick up the proxy from the environment like requests does.
+                trust_env=True
+            )
+
+        return self._request_session
+
+    def _encode_body(self, data: dict = None, json: dict = None) -> tuple:
+        """Encodes the body of a request the way `requests` does, so
+        its size is known, and returns it with its content type."""
+
+        if json is not None:
+            return json_lib.dumps(json).encode("utf-8"), "application/json"
+        elif isinstance(data, dict):
+            return urllib.parse.urlencode(data).encode("utf-8"), "application/x-www-form-urlencoded"
+        elif isinstance(data, str):
+            return data.encode("utf-8"), None
+
+        return data, None
+
+    def _decoder(self, response: aiohttp.ClientResponse):
+        """Returns a decompressor for the body of a response sent
+        with gzip or deflate, None if it was sent as is."""
+
+        if response.headers.get("Content-Encoding", "").lower() in ["gzip", "x-gzip", "deflate"]:
+            # Accepts both the gzip and the zlib header.
+            return zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+        return None
+
+    async def _run_blocking(self, function, *args, **kwargs):
+        """Runs a blocking call of the client, e.g. a token refresh,
+        in the default executor so the event loop is not held up."""
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(None, functools.partial(function, *args, **kwargs))
+
+    async def build_headers(self, additional_args: dict = None) -> Dict:
+        """Used to build the headers needed to make the request.
+
+        ### Parameters
+        ----
+        additional_args : dict (optional, Default=None)
+            Any additional headers that need to be sent in the
+            request.
+
+        ### Returns
+        ----
+        dict :
+            A dictionary containing all the components.
+        """
+
+        # Make sure the token outlives the request, this only refreshes
+        # if the client's background refresher has fallen behind.
+        await self._run_blocking(self.client._token_validation)
+
+        headers = {
+            "Authorization": f"Bearer {self.client.access_token}",
+            "Accept-Encoding": "gzip, deflate"
+        }
+
+        if additional_args:
+            headers.update(additional_args)
+
+        return headers
+
+    def build_url(self, endpoint: str) -> str:
+        """Build the URL used the make string.
+
+        ### Parameters
+        ----
+        endpoint : str
+            The endpoint used to make the full URL. Absolute URLs
+            are passed through unchanged.
+
+        ### Returns
+        ----
+        str:
+            The full URL with the endpoint needed.
+        """
+
+        if endpoint.startswith("https://") or endpoint.startswith("http://"):
+            return endpoint
+
+        return self.client.RESOURCE + self.client.api_version + "/" + endpoint
+
+    async def make_request(
+        self,
+        method: str,
+        endpoint: str,
+        params: dict = None,
+        data: dict = None,
+        json: dict = None,
+        additional_headers: dict = None,
+        expect_no_response: bool = False,
+        download = False,
+        download_path = None
+    ) -> Union[Dict, List]:
+        """Handles all the requests of the session.
+
+        ### Overview:
+        ---
+        The asyncio counterpart of `GraphSession.make_request`, it
+        takes the same arguments and returns the same shapes, and
+        retries throttled and failed requests with the same policy.
+        A request rejected with a 401 is sent once more with a
+        renewed token. Token checks and refreshes run in the
+        default executor, as they block.
+
+        ### Arguments:
+        ----
+        method : str
+            The Request method, can be one of the
+            following: ["get","post","put","delete","patch"]
+
+        endpoint : str
+            The API URL endpoint.
+
+        params : dict (optional, Default=None)
+            The URL params for the request.
+
+        data : dict (optional, Default=None)
+            A data payload for a request.
+
+        json : dict (optional, Default=None)
+            A json data payload for a request
+
+        expect_no_response: bool (optional, Default=False)
+            If set to True only the status code is returned.
+
+        download : bool (optional, Default=False)
+            If set to True the response body is streamed to
+            `download_path`, see `download_file`.
+
+        ### Returns:
+        ----
+        Union[List, Dict]:
+            The resource object or objects.
+        """
+
+        if download:
+            return await self.download_file(
+                endpoint=endpoint,
+                download_path=download_path,
+                params=params,
+                additional_headers=additional_headers
+            )
+
+        url = self.build_url(endpoint=endpoint)
+        logging.info(f"URL: {url}")
+
+        body, content_type = self._encode_body(data=data, json=json)
+
+        return await self._send(
+            method=method,
+            url=url,
+            params=params,
+            body=body,
+            content_type=content_type,
+            additional_headers=additional_headers,
+            handler=lambda response: self._handle_response(
+                method=method,
+                response=response,
+                expect_no_response=expect_no_response
+            )
+        )
+
+    async def download_file(
+        self,
+        endpoint: str,
+        download_path: str,
+        params: dict = None,
+        additional_headers: dict = None,
+        chunk_size: int = 1024 * 1024
+    ) -> List:
+        """Streams a file to disk in chunks, resuming partial downloads.
+
+        ### Overview:
+        ----
+        The asyncio counterpart of `GraphSession.download_file`. The
+        body is written to `download_path + ".part"` one chunk at a
+        time and the part file is renamed to `download_path` once it
+        is complete. A part file left behind by an interrupted
+        download is resumed with a Range request, and started over
+        if it does not fit the file anymore. A file already at
+        `download_path` is not downloaded again. The file operations
+        run in the default executor, as they block.
+
+        ### Arguments:
+        ----
+        endpoint : str
+            The API URL endpoint of the file content.
+
+        download_path : str
+            The path the file is saved to.
+
+        params : dict (optional, Default=None)
+            The URL params for the request.
+
+        additional_headers : dict (optional, Default=None)
+            Any additional headers to send.
+
+        chunk_size : int (optional, Default=1 MB)
+            The number of bytes read and written at a time.
+
+        ### Returns:
+        ----
+        List:
+            The status code of the download, 304 if the file was
+            already downloaded.
+        """
+
+        if await self._run_blocking(os.path.exists, download_path):
+            logging.debug(f"Already downloaded, skipped: {download_path}")
+            return [304]
+
+        url = self.build_url(endpoint=endpoint)
+        part_path = download_path + ".part"
+        attempt = 0
+
+        while True:
+            offset = 0
+            if await self._run_blocking(os.path.exists, part_path):
+                offset = await self._run_blocking(os.path.getsize, part_path)
+
+            headers = dict(additional_headers or {})
+            if offset > 0:
+                headers["Range"] = f"bytes={offset}-"
+
+            result = await self._send(
+                method="get",
+                url=url,
+                params=params,
+                additional_headers=headers,
+                handler=lambda response: self._write_part(
+                    response=response,
+                    part_path=part_path,
+                    chunk_size=chunk_size
+                )
+            )
+
+            if result == 416 and offset > 0:
+                # The part file does not fit the file anymore, start over.
+                await self._run_blocking(os.remove, part_path)
+                continue
+
+            if isinstance(result, Exception):
+                # Keep what was written and resume from there.
+                self.retry_stats.increment("connection_errors")
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment("give_ups")
+                    raise result
+                self.retry_stats.increment("retries")
+                await asyncio.sleep(self.retry_policy.compute_delay(attempt))
+                attempt += 1
+                continue
+
+            break
+
+        await self._run_blocking(os.replace, part_path, download_path)
+        logging.debug(f"Downloaded: {download_path}")
+
+        return [result]
+
+    async def _send(
+        self,
+        method: str,
+        url: str,
+        handler,
+        params: dict = None,
+        body: bytes = None,
+        content_type: str = None,
+        additional_headers: dict = None
+    ):
+        """Sends a request, retrying it with the retry policy and
+        once more after a 401, and returns what `handler` makes of
+        the final response."""
+
+        headers = await self.build_headers(additional_args=additional_headers)
+        request_session = self._get_request_session()
+
+        bytes_sent = len(body) if body is not None else 0
+        body_headers = {"Content-Type": content_type} if content_type is not None else {}
+
+        attempt = 0
+        renewed = False
+
+        while True:
+            # Wait for a slot in the request budget shared by all tasks.
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            started = time.perf_counter()
+
+            try:
+                async with self._semaphore:
+                    async with request_session.request(
+                        method=method.upper(),
+                        url=url,
+                        headers={**body_headers, **headers},
+                        params=params,
+                        data=body
+                    ) as response:
+
+                        # The body is counted by the handler as it is read.
+                        self.metrics.record(
+                            method=method,
+                            url=str(response.url),
+                            status=response.status,
+                            seconds=time.perf_counter() - started,
+                            bytes_sent=bytes_sent,
+                            attempt=attempt
+                        )
+
+                        status = response.status
+                        rejected = status == 401 and not renewed
+
+                        if not rejected and (
+                            not self.retry_policy.should_retry(status)
+                            or attempt >= self.retry_policy.max_retries
+                        ):
+                            if self.retry_policy.should_retry(status):
+                                self.retry_stats.increment("give_ups")
+                            return await handler(response)
+
+                        retry_after = self.retry_policy.parse_retry_after(
+                            response.headers.get("Retry-After")
+                        )
+
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.metrics.record(
+                    method=method,
+                    url=url,
+                    status=None,
+                    seconds=time.perf_counter() - started,
+                    bytes_sent=bytes_sent,
+                    attempt=attempt
+                )
+                self.retry_stats.increment("connection_errors")
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment("give_ups")
+                    raise
+                delay = self.retry_policy.compute_delay(attempt)
+            else:
+                if rejected:
+                    # The token was rejected after it was sent, renew it and retry once.
+                    await self._run_blocking(
+                        self.client._renew_token,
+                        used_token=headers["Authorization"][len("Bearer "):]
+                    )
+                    headers = await self.build_headers(additional_args=additional_headers)
+                    renewed = True
+                    continue
+
+                delay = self.retry_policy.compute_delay(attempt, retry_after)
+                if status == 429 or status == 503:
+                    self.retry_stats.increment("throttles")
+                    self.rate_limiter.pause(delay)
+
+            self.retry_stats.increment("retries")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _handle_response(
+        self,
+        method: str,
+        response: aiohttp.ClientResponse,
+        expect_no_response: bool
+    ) -> Union[Dict, List]:
+        """Turns a final response into the shapes returned by
+        `GraphSession.make_request`, counting the body bytes read
+        off the connection."""
+
+        if response.ok and expect_no_response:
+            return {"status_code": response.status}
+
+        decoder = self._decoder(response)
+
+        content = await response.read()
+        self.metrics.add_bytes_received(method=method, url=str(response.url), bytes_received=len(content))
+        if decoder is not None:
+            content = decoder.decompress(content) + decoder.flush()
+
+        if response.ok and len(content) > 0:
+            return [response.status, json_lib.loads(content)]
+        elif response.ok:
+            return {
+                "message": "Request was successful, status code provided.",
+                "status_code": response.status
+            }
+        elif response.status == 404:
+            return [response.status, response.status]
+        else:
+            # The same error as GraphSession, callers need not know the session.
+            raise requests.HTTPError(
+                f"{response.status} error for url: {response.url}"
+            )
+
+    async def _write_part(
+        self,
+        response: aiohttp.ClientResponse,
+        part_path: str,
+        chunk_size: int
+    ):
+        """Writes the body of a download to the part file. Returns
+        the status code, or the error that cut the body short."""
+
+        if response.status == 416:
+            return response.status
+
+        if not response.ok:
+            raise requests.HTTPError(
+                f"{response.status} error for url: {response.url}"
+            )
+
+        decoder = self._decoder(response)
+        # Append if the server sent the rest, otherwise it sent it all.
+        mode = "ab" if response.status == 206 else "wb"
+        received = 0
+
+        file = await self._run_blocking(open, part_path, mode)
+        try:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                received += len(chunk)
+                await self._run_blocking(file.write, decoder.decompress(chunk) if decoder is not None else chunk)
+            if decoder is not None:
+                await self._run_blocking(file.write, decoder.flush())
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as error:
+            return error
+        finally:
+            await self._run_blocking(file.close)
+            self.metrics.add_bytes_received(method="get", url=str(response.url), bytes_received=received)
+
+        return response.status
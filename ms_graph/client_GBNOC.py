@@ -1,4 +1,6 @@
 import json
+import logging
+import threading
 import time
 import urllib
 import random
@@ -28,6 +30,9 @@ class MicrosoftGraphClient:
 #     RESOURCE = "https://outlook.office.com/api/"
 #     RESOURCE = "https://dev.outlook.com/"
     AUTH_ENDPOINT = "/oauth2/v2.0/authorize?"
+    # Bounds on the sleeps of the background token refresher, in seconds.
+    REFRESH_MIN_WAIT = 30
+    REFRESH_MAX_BACKOFF = 3600
 
     def __init__(
         self,
@@ -89,6 +94,12 @@ class MicrosoftGraphClient:
         self.graph_session = None
         self.id_token = None
 
+        # Serializes token refreshes between the background refresher
+        # and the threads making requests.
+        self._token_lock = threading.Lock()
+        self._refresher = None
+        self._refresher_stop = threading.Event()
+
         # self.base_url = self.RESOURCE + self.api_version + "/"
         # self.office_url = self.OFFICE365_AUTHORITY_URL + self.OFFICE365_AUTH_ENDPOINT
         # self.graph_url = self.AUTHORITY_URL + self.account_type + self.AUTH_ENDPOINT
@@ -124,7 +135,93 @@ class MicrosoftGraphClient:
         """
 
         if self._token_seconds(token_type="access_token") < nseconds:
-            self.grab_refresh_token()
+            with self._token_lock:
+                # Another thread may have refreshed it while we waited.
+                if self._token_seconds(token_type="access_token") < nseconds:
+                    self.grab_refresh_token()
+
+    def _renew_token(self, used_token: str) -> None:
+        """Refreshes the access token after the server rejected it.
+
+        Only the first of several threads rejected with the same token
+        refreshes it, the others pick up the new token.
+
+        Arguments:
+        ----
+        used_token {str} -- The access token the rejected request was
+            sent with.
+        """
+
+        with self._token_lock:
+            if self.access_token == used_token:
+                self.grab_refresh_token()
+
+    def start_token_refresher(self, margin: int = 300) -> None:
+        """Starts renewing the access token in the background.
+
+        ### Overview:
+        ----
+        A daemon thread sleeps until the access token is `margin`
+        seconds from expiring and refreshes it, so requests never
+        have to wait for a refresh. Requests in flight keep the
+        token they were sent with, which is still valid for the
+        margin. Calling it again while it runs does nothing.
+
+        The refresher sleeps at least `REFRESH_MIN_WAIT` seconds
+        between refreshes, even if tokens live no longer than the
+        margin. Failed refreshes are retried with an exponential
+        backoff, and the refresher stops if the refresh token is
+        rejected, as only a new login helps then.
+
+        ### Arguments:
+        ----
+        margin : int (optional, Default=300)
+            The number of seconds before expiry to refresh at.
+        """
+
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+
+        self._refresher_stop.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop,
+            args=(margin,),
+            name="graph-token-refresher",
+            daemon=True
+        )
+        self._refresher.start()
+
+    def stop_token_refresher(self) -> None:
+        """Stops the background token refresher."""
+
+        self._refresher_stop.set()
+
+    def _refresh_loop(self, margin: int) -> None:
+        """Body of the background token refresher thread."""
+
+        failures = 0
+
+        while not self._refresher_stop.is_set():
+            wait = self._token_seconds(token_type="access_token") - margin
+
+            if wait <= 0:
+                try:
+                    self._token_validation(nseconds=margin + 1)
+                except PermissionError:
+                    # The refresh token was revoked or has expired.
+                    logging.exception("Refresh token rejected, stopping the background token refresher")
+                    return
+                except Exception:
+                    # Requests still refresh on their own, back off and try again.
+                    logging.exception("Background token refresh failed")
+                    wait = min(self.REFRESH_MIN_WAIT * 2 ** failures, self.REFRESH_MAX_BACKOFF)
+                    failures += 1
+                else:
+                    failures = 0
+                    wait = self._token_seconds(token_type="access_token") - margin
+
+            # Never spin, e.g. when tokens live no longer than the margin.
+            self._refresher_stop.wait(timeout=max(wait, self.REFRESH_MIN_WAIT))
 
     
 
@@ -352,6 +449,7 @@ class MicrosoftGraphClient:
 
             # Set the Session.
             self.graph_session = GraphSession(client=self)
+            self.start_token_refresher()
 
             return True
 
@@ -377,6 +475,7 @@ class MicrosoftGraphClient:
 
             # Set the session.
             self.graph_session = GraphSession(client=self)
+            self.start_token_refresher()
 
     
 
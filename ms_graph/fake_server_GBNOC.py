@@ -0,0 +1,1172 @@
+import base64
+import gzip
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+from urllib.parse import parse_qsl
+from urllib.parse import quote
+from urllib.parse import urlencode
+from urllib.parse import urlsplit
+
+from ms_graph.session_GBNOC import GraphSession
+
+
+WELL_KNOWN_FOLDERS = ["inbox", "sentitems", "archive", "deleteditems", "drafts"]
+
+_WORDS = (
+    "project network circuit upgrade approval uat testing migration firewall "
+    "router switch cutover schedule change request ticket customer service "
+    "outage maintenance window vendor quotation invoice contract renewal "
+    "bandwidth extension ip lan wan site survey report meeting minutes "
+    "follow up action items deadline budget forecast review please kindly "
+    "confirm attached document regards thanks team update status issue"
+).split()
+
+_NAMES = [
+    "Kohei Tanaka", "Alice Tan", "Bob Lim", "Chandra Kumar", "Diana Wong",
+    "Evan Ng", "Farah Aziz", "George Lee", "Hui Min Goh", "Ivan Petrov"
+]
+
+_HTML_TAG = re.compile(r"<[^>]+>")
+
+
+class FakeMailbox():
+
+    """
+    ### Overview:
+    ----
+    A synthetic mailbox served by `FakeGraphServer`. The messages,
+    folders and attachments are generated from `seed`, so two
+    mailboxes built with the same arguments are identical. The
+    mailbox can be changed while it is served, to exercise delta
+    queries.
+    """
+
+    def __init__(
+        self,
+        message_count: int = 1000,
+        child_folder_count: int = 3,
+        nested_folder_count: int = 1,
+        body_words: int = 200,
+        attachment_every: int = 10,
+        attachment_size: int = 64 * 1024,
+        seed: int = 0
+    ) -> None:
+        """Initializes the `FakeMailbox`.
+
+        ### Parameters
+        ----
+        message_count : int (optional, Default=1000)
+            The number of messages generated.
+
+        child_folder_count : int (optional, Default=3)
+            The number of child folders of the inbox.
+
+        nested_folder_count : int (optional, Default=1)
+            The number of child folders of each child folder of the
+            inbox, all named "Archive 1", "Archive 2", ...
+
+        body_words : int (optional, Default=200)
+            The number of words in the body of a message.
+
+        attachment_every : int (optional, Default=10)
+            Every n-th message has attachments, 0 for none.
+
+        attachment_size : int (optional, Default=64 KB)
+            The size in bytes of the first attachment of a message,
+            the second one is four times larger.
+
+        seed : int (optional, Default=0)
+            Seeds the generated content.
+        """
+
+        self.body_words = body_words
+        self.attachment_every = attachment_every
+        self.attachment_size = attachment_size
+        self.seed = seed
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._sequence = 0
+        self._created = 0
+        self._latest = datetime(2024, 1, 1)
+
+        self.folders: Dict[str, Dict] = {}
+        self.well_known: Dict[str, str] = {}
+        self.messages: Dict[str, Dict] = {}
+        self.tombstones: List[Tuple[int, str, str]] = []
+        self.folder_tombstones: List[Tuple[int, str]] = []
+        self._folder_sequences: Dict[str, int] = {}
+        self._order: List[str] = []
+
+        self.root_id = self._make_id("folder", "msgfolderroot")
+        for name in WELL_KNOWN_FOLDERS:
+            self.well_known[name] = self.add_folder(
+                display_name={"sentitems": "Sent Items", "deleteditems": "Deleted Items"}.get(name, name.title()),
+                parent_id=self.root_id
+            )
+        for index in range(child_folder_count):
+            child_id = self.add_folder(display_name=f"Projects {index + 1}")
+            for nested_index in range(nested_folder_count):
+                self.add_folder(display_name=f"Archive {nested_index + 1}", parent_id=child_id)
+
+        # Oldest first, so that the newest message is created last.
+        self._latest = self._latest - timedelta(minutes=17 * message_count)
+        self.add_messages(count=message_count, folder_id=None)
+
+    def _make_id(self, kind: str, key: object) -> str:
+        """Builds an id shaped like an Exchange id."""
+
+        digest = hashlib.sha1(f"{self.seed}:{kind}:{key}".encode()).hexdigest()
+        return "AAMkAGI2" + digest + "AAA="
+
+    def add_folder(self, display_name: str, parent_id: str = "inbox") -> str:
+        """Adds a folder, it shows up in folder delta queries.
+
+        ### Parameters
+        ----
+        display_name : str
+            The name of the folder.
+
+        parent_id : str (optional, Default="inbox")
+            The id or well-known name of the parent folder.
+
+        ### Returns
+        ----
+        str:
+            The id of the new folder.
+        """
+
+        with self._lock:
+            if parent_id != self.root_id:
+                parent_id = self.resolve_folder(parent_id)
+
+            folder_id = self._make_id("folder", f"{parent_id}/{display_name}")
+            self.folders[folder_id] = {
+                "id": folder_id,
+                "displayName": display_name,
+                "parentFolderId": parent_id,
+                "isHidden": False
+            }
+            self._sequence += 1
+            self._folder_sequences[folder_id] = self._sequence
+
+            return folder_id
+
+    def rename_folder(self, folder_id: str, display_name: str) -> None:
+        """Renames a folder."""
+
+        with self._lock:
+            folder_id = self.resolve_folder(folder_id)
+            self.folders[folder_id]["displayName"] = display_name
+            self._sequence += 1
+            self._folder_sequences[folder_id] = self._sequence
+
+    def delete_folder(self, folder_id: str) -> None:
+        """Deletes a folder with its child folders and messages."""
+
+        with self._lock:
+            folder_id = self.resolve_folder(folder_id)
+
+            for child_id in [child["id"] for child in self.folders.values() if child["parentFolderId"] == folder_id]:
+                self.delete_folder(child_id)
+
+            self.delete_messages([record["message"]["id"] for record in self.list_messages(folder_id=folder_id)])
+            del self.folders[folder_id]
+            del self._folder_sequences[folder_id]
+            self._sequence += 1
+            self.folder_tombstones.append((self._sequence, folder_id))
+
+    def resolve_folder(self, folder_id: str) -> str:
+        """Turns a well-known folder name or a folder id into the
+        folder id, None if there is no such folder."""
+
+        folder_id = self.well_known.get(folder_id.lower(), folder_id)
+
+        return folder_id if folder_id in self.folders else None
+
+    def _pick_folder(self) -> str:
+        """Picks the folder of a generated message, mostly the inbox."""
+
+        children = [
+            folder_id for folder_id in self.folders
+            if folder_id not in self.well_known.values()
+        ]
+        roll = self._random.random()
+
+        if roll < 0.6 or (roll >= 0.9 and not children):
+            return self.well_known["inbox"]
+        if roll < 0.8:
+            return self.well_known["sentitems"]
+        if roll < 0.9:
+            return self.well_known["archive"]
+
+        return self._random.choice(children)
+
+    def _make_body(self, sender: str) -> Tuple[str, str]:
+        """Generates the html and the text body of a message."""
+
+        words = [self._random.choice(_WORDS) for _ in range(self.body_words)]
+        paragraphs = [
+            " ".join(words[start:start + 40]).capitalize() + "."
+            for start in range(0, len(words), 40)
+        ]
+
+        html = "<html><head></head><body>"
+        html += "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs)
+        if self._random.random() < 0.3:
+            html += '<p><img src="cid:image001.png@01DA2B3C.4D5E6F70"></p>'
+        if self._random.random() < 0.3:
+            html += '<p>Details at <a href="https://intranet.example.com/tickets/1234">https://intranet.example.com/tickets/1234</a></p>'
+        html += f"<p>Regards,<br>{sender}</p>"
+        if self._random.random() < 0.4:
+            quoted = " ".join(self._random.choice(_WORDS) for _ in range(40))
+            html += (
+                f"<hr><p><b>From:</b> {self._random.choice(_NAMES)}<br><b>Sent:</b> "
+                f"Monday, 1 January 2024 9:00 AM<br><b>Subject:</b> RE: {quoted[:30]}</p>"
+                f"<p>{quoted}</p>"
+            )
+        html += "</body></html>"
+
+        text = html.replace("<br>", "\n").replace("</p>", "\n\n")
+        text = _HTML_TAG.sub("", text).strip()
+
+        return html, text
+
+    def _make_message(self, folder_id: str) -> Dict:
+        """Generates a message record."""
+
+        self._created += 1
+        self._latest = self._latest + timedelta(minutes=17)
+
+        message_id = self._make_id("message", self._created)
+        sender = self._random.choice(_NAMES)
+        recipients = self._random.sample(_NAMES, 2)
+        subject = " ".join(self._random.choice(_WORDS) for _ in range(5)).capitalize()
+        html, text = self._make_body(sender=sender)
+        sent = self._latest.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+        attachments = []
+        if self.attachment_every and self._created % self.attachment_every == 0:
+            for index, size in enumerate([self.attachment_size, self.attachment_size * 4]):
+                attachments.append({
+                    "@odata.type": "#microsoft.graph.fileAttachment",
+                    "id": self._make_id("attachment", f"{self._created}:{index}") + "BEgAQ",
+                    "name": f"attachment_{self._created}_{index}.bin",
+                    "contentType": "application/octet-stream",
+                    "size": size,
+                    "isInline": False
+                })
+
+        def address(name):
+            return {"emailAddress": {"name": name, "address": name.lower().replace(" ", ".") + "@example.com"}}
+
+        message = {
+            "id": message_id,
+            "changeKey": "CQAAABYAAA" + hashlib.sha1(f"{message_id}:0".encode()).hexdigest()[:16],
+            "subject": subject,
+            "bodyPreview": text[:255],
+            "body": {"contentType": "html", "content": html},
+            "sender": address(sender),
+            "from": address(sender),
+            "toRecipients": [address(name) for name in recipients],
+            "ccRecipients": [],
+            "sentDateTime": sent,
+            "receivedDateTime": sent,
+            "hasAttachments": len(attachments) > 0,
+            "isRead": False,
+            "importance": "normal",
+            "conversationId": "AAQkAGI2" + hashlib.sha1(subject.encode()).hexdigest(),
+            "parentFolderId": folder_id,
+            "webLink": f"https://outlook.office365.com/owa/?ItemID={message_id}&exvsurl=1&viewmodel=ReadMessageItem"
+        }
+
+        return {
+            "message": message,
+            "text": text,
+            "folder_id": folder_id,
+            "sequence": 0,
+            "attachments": attachments
+        }
+
+    def add_messages(self, count: int, folder_id: str = "inbox") -> List[str]:
+        """Adds `count` new messages, newer than all others.
+
+        ### Parameters
+        ----
+        count : int
+            The number of messages to add.
+
+        folder_id : str (optional, Default="inbox")
+            The folder of the messages, None spreads them over all
+            folders.
+
+        ### Returns
+        ----
+        List[str]:
+            The ids of the new messages.
+        """
+
+        with self._lock:
+            target = self.resolve_folder(folder_id) if folder_id is not None else None
+            new_ids = []
+
+            for _ in range(count):
+                record = self._make_message(folder_id=target or self._pick_folder())
+                self._sequence += 1
+                record["sequence"] = self._sequence
+                self.messages[record["message"]["id"]] = record
+                new_ids.append(record["message"]["id"])
+
+            # Newest first.
+            self._order = new_ids[::-1] + self._order
+
+            return new_ids
+
+    def update_messages(self, message_ids: List[str]) -> None:
+        """Marks messages as read and changes their changeKey."""
+
+        with self._lock:
+            for message_id in message_ids:
+                record = self.messages[message_id]
+                self._sequence += 1
+                record["sequence"] = self._sequence
+                record["message"]["isRead"] = True
+                record["message"]["changeKey"] = "CQAAABYAAA" + hashlib.sha1(
+                    f"{message_id}:{self._sequence}".encode()
+                ).hexdigest()[:16]
+
+    def delete_messages(self, message_ids: List[str]) -> None:
+        """Deletes messages, they show up as removed in delta queries."""
+
+        with self._lock:
+            for message_id in message_ids:
+                record = self.messages.pop(message_id)
+                self._sequence += 1
+                self.tombstones.append((self._sequence, message_id, record["folder_id"]))
+            removed = set(message_ids)
+            self._order = [message_id for message_id in self._order if message_id not in removed]
+
+    def move_message(self, message_id: str, folder_id: str) -> None:
+        """Moves a message to another folder."""
+
+        with self._lock:
+            record = self.messages[message_id]
+            self._sequence += 1
+            self.tombstones.append((self._sequence, message_id, record["folder_id"]))
+            record["folder_id"] = self.resolve_folder(folder_id)
+            record["message"]["parentFolderId"] = record["folder_id"]
+            record["sequence"] = self._sequence
+
+    def list_messages(self, folder_id: str = None) -> List[Dict]:
+        """Returns the message records of a folder, newest first."""
+
+        with self._lock:
+            records = [self.messages[message_id] for message_id in self._order]
+
+        if folder_id is None:
+            return records
+
+        return [record for record in records if record["folder_id"] == folder_id]
+
+    def changes(self, folder_id: str, since: int, until: int) -> List[Tuple[int, object]]:
+        """Returns the message records changed and the ids removed in
+        a folder between two sequence numbers, oldest change first."""
+
+        with self._lock:
+            changed = [
+                (record["sequence"], record) for record in self.messages.values()
+                if record["folder_id"] == folder_id and since < record["sequence"] <= until
+            ]
+            removed = [
+                (sequence, message_id) for sequence, message_id, removed_from in self.tombstones
+                if removed_from == folder_id and since < sequence <= until
+            ]
+
+        return sorted(changed + removed, key=lambda change: change[0])
+
+    def folder_changes(self, since: int, until: int) -> List[Tuple[int, object]]:
+        """Returns the folders changed and the ids of the folders
+        removed between two sequence numbers, oldest change first."""
+
+        with self._lock:
+            changed = [
+                (sequence, self.folders[folder_id]) for folder_id, sequence in self._folder_sequences.items()
+                if since < sequence <= until
+            ]
+            removed = [
+                (sequence, folder_id) for sequence, folder_id in self.folder_tombstones
+                if since < sequence <= until
+            ]
+
+        return sorted(changed + removed, key=lambda change: change[0])
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    def attachment_bytes(self, attachment: Dict) -> bytes:
+        """Generates the content of an attachment."""
+
+        block = hashlib.sha256(attachment["id"].encode()).digest() * 2048
+        repeats = attachment["size"] // len(block) + 1
+
+        return (block * repeats)[:attachment["size"]]
+
+
+class FakeGraphServer():
+
+    """
+    ### Overview:
+    ----
+    A local stand-in for the Microsoft Graph API, serving a
+    `FakeMailbox` over HTTP so that `GraphSession`, `MSGraphOutlook`
+    and the ingestion script can be benchmarked and tested without
+    a tenant. It supports the requests this library makes: message
+    and folder listing with $top, $skip, $select, $count, $orderby
+    and @odata.nextLink paging, delta queries, JSON $batch,
+    attachments (with Range requests), drafts, sendMail and upload
+    sessions. It can add latency and throttle requests with 429
+    and a Retry-After header.
+
+    $filter and $search are accepted but not evaluated.
+    """
+
+    def __init__(
+        self,
+        mailbox: FakeMailbox = None,
+        latency: float = 0.0,
+        throttle_rate: float = 0.0,
+        retry_after: float = 1,
+        page_size: int = 10,
+        compress: bool = True,
+        access_token: str = "fake-access-token",
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: int = 0
+    ) -> None:
+        """Initializes the `FakeGraphServer`.
+
+        ### Parameters
+        ----
+        mailbox : FakeMailbox (optional, Default=FakeMailbox())
+            The mailbox served.
+
+        latency : float (optional, Default=0.0)
+            The number of seconds added to every request.
+
+        throttle_rate : float (optional, Default=0.0)
+            The fraction of requests, and of $batch sub-requests,
+            answered with 429.
+
+        retry_after : float (optional, Default=1)
+            The Retry-After sent with a 429, in seconds.
+
+        page_size : int (optional, Default=10)
+            The page size when neither $top nor odata.maxpagesize
+            is given.
+
+        compress : bool (optional, Default=True)
+            Gzip the responses when the client accepts it.
+
+        access_token : str (optional, Default="fake-access-token")
+            The bearer token the server accepts.
+
+        host : str (optional, Default="127.0.0.1")
+            The address to listen on.
+
+        port : int (optional, Default=0)
+            The port to listen on, 0 picks a free one.
+
+        seed : int (optional, Default=0)
+            Seeds which requests are throttled.
+
+        ### Usage:
+        ----
+            >>> with FakeGraphServer(mailbox=FakeMailbox(message_count=5000), throttle_rate=0.05) as server:
+                    graph_client = server.client()
+                    emails = MSGraphOutlook().get_emails_all(graph_client, max_workers=4)
+        """
+
+        self.mailbox = mailbox if mailbox is not None else FakeMailbox()
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.compress = compress
+        self.access_token = access_token
+
+        self.stats = {"requests": 0, "throttled": 0, "bytes_sent": 0}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._uploads: Dict[str, Dict] = {}
+        self._thread = None
+
+        self._httpd = _FakeHTTPServer((host, port), _FakeGraphHandler)
+        self._httpd.fake_server = self
+
+    @property
+    def url(self) -> str:
+        """The base URL of the server, e.g. "http://127.0.0.1:50123"."""
+
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGraphServer":
+        """Starts serving in a background thread."""
+
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever,
+            name="fake-graph-server",
+            daemon=True
+        )
+        self._thread.start()
+
+        return self
+
+    def stop(self) -> None:
+        """Stops serving and closes the socket."""
+
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FakeGraphServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+    def client(self, **session_args) -> "FakeGraphClient":
+        """Returns a logged in client for the server.
+
+        ### Parameters
+        ----
+        **session_args :
+            Passed on to `GraphSession`, e.g. `rate_limiter`.
+        """
+
+        graph_client = FakeGraphClient(server=self, **session_args)
+        graph_client.login()
+
+        return graph_client
+
+    def _throttled(self) -> bool:
+        """Rolls whether a request is throttled."""
+
+        if self.throttle_rate <= 0:
+            return False
+
+        with self._lock:
+            return self._random.random() < self.throttle_rate
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def handle(self, method: str, target: str, headers: Dict, body: bytes) -> Tuple[int, Dict, object]:
+        """Answers one HTTP request.
+
+        ### Parameters
+        ----
+        method : str
+            The Request method.
+
+        target : str
+            The path and query string of the request.
+
+        headers : dict
+            The request headers, with lowercase names.
+
+        body : bytes
+            The request body.
+
+        ### Returns
+        ----
+        tuple:
+            The status code, response headers and body, a dictionary
+            for json and bytes otherwise.
+        """
+
+        self._count("requests")
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if self._throttled():
+            self._count("throttled")
+            return _error(429, "TooManyRequests", "Application is over its MailboxConcurrency limit.", self.retry_after)
+
+        path, query = _split_target(target)
+
+        # Upload URLs are pre-authenticated and refuse a token.
+        if path[:1] == ["upload"]:
+            if "authorization" in headers:
+                return _error(401, "InvalidAuthenticationToken", "Upload URLs do not accept an Authorization header.")
+        elif headers.get("authorization") != f"Bearer {self.access_token}":
+            return _error(401, "InvalidAuthenticationToken", "Access token is empty or invalid.")
+
+        if path == ["$batch"] and method == "POST":
+            return self._batch(body=body)
+
+        return self._route(method=method, path=path, query=query, headers=headers, body=body)
+
+    def _batch(self, body: bytes) -> Tuple[int, Dict, object]:
+        """Answers a JSON $batch request."""
+
+        sub_requests = json.loads(body)["requests"]
+
+        if len(sub_requests) > 20:
+            return _error(400, "BadRequest", "The number of requests in a batch cannot exceed 20.")
+
+        responses = []
+
+        for sub_request in sub_requests:
+            self._count("requests")
+
+            if self._throttled():
+                self._count("throttled")
+                status, headers, content = _error(429, "TooManyRequests", "Too many requests.", self.retry_after)
+            else:
+                path, query = _split_target(sub_request["url"])
+                sub_headers = {name.lower(): value for name, value in sub_request.get("headers", {}).items()}
+                sub_body = json.dumps(sub_request["body"]).encode() if "body" in sub_request else b""
+                status, headers, content = self._route(
+                    method=sub_request.get("method", "GET").upper(),
+                    path=path,
+                    query=query,
+                    headers=sub_headers,
+                    body=sub_body
+                )
+
+            if isinstance(content, bytes):
+                content = base64.b64encode(content).decode()
+
+            response = {"id": sub_request["id"], "status": status, "headers": headers}
+            if content is not None:
+                response["body"] = content
+            responses.append(response)
+
+        # Graph does not keep the order of the requests either.
+        with self._lock:
+            self._random.shuffle(responses)
+
+        return 200, {}, {"responses": responses}
+
+    def _route(self, method: str, path: List[str], query: Dict, headers: Dict, body: bytes) -> Tuple[int, Dict, object]:
+        """Dispatches a request to the resource it is for."""
+
+        if path[:1] == ["upload"] and len(path) == 2 and method == "PUT":
+            return self._upload_chunk(token=path[1], headers=headers, body=body)
+
+        if path[:1] != ["me"] or len(path) < 2:
+            return _error(404, "ResourceNotFound", "Resource not found for the segment.")
+
+        resource = path[1:]
+
+        if resource == ["sendMail"] and method == "POST":
+            message = json.loads(body)["message"]
+            self._store_draft(message=message, folder_id="sentitems")
+            return 202, {}, None
+
+        if resource[0] == "mailFolders":
+            return self._route_folders(method=method, resource=resource[1:], query=query, headers=headers)
+
+        if resource[0] == "messages":
+            return self._route_messages(method=method, resource=resource[1:], query=query, headers=headers, body=body)
+
+        return _error(404, "ResourceNotFound", "Resource not found for the segment.")
+
+    def _route_folders(self, method: str, resource: List[str], query: Dict, headers: Dict) -> Tuple[int, Dict, object]:
+        """Answers the requests under /me/mailFolders."""
+
+        if method != "GET":
+            return _error(405, "ErrorInvalidRequest", "The method is not supported.")
+
+        mailbox = self.mailbox
+
+        if not resource:
+            root_folders = [
+                folder for folder in mailbox.folders.values()
+                if folder["id"] in mailbox.well_known.values()
+            ]
+            return 200, {}, self._page(items=[self._folder(folder) for folder in root_folders], query=query, headers=headers, path="me/mailFolders")
+
+        if resource == ["delta"]:
+            return self._delta(
+                changes=lambda since, until: mailbox.folder_changes(since=since, until=until),
+                render=lambda folder: _project(self._folder(folder), query),
+                odata_type="#microsoft.graph.mailFolder",
+                query=query,
+                headers=headers,
+                path="me/mailFolders/delta"
+            )
+
+        folder_id = mailbox.resolve_folder(resource[0])
+        if folder_id is None:
+            return _error(404, "ErrorInvalidIdMalformed", "Id is malformed.")
+
+        if len(resource) == 1:
+            return 200, {}, _project(self._folder(mailbox.folders[folder_id]), query)
+
+        if resource[1:] == ["childFolders"]:
+            children = [
+                self._folder(folder) for folder in mailbox.folders.values()
+                if folder["parentFolderId"] == folder_id
+            ]
+            return 200, {}, self._page(items=children, query=query, headers=headers, path="/".join(["me", "mailFolders"] + resource))
+
+        if resource[1:] == ["messages"]:
+            return self._list_messages(folder_id=folder_id, query=query, headers=headers, path="/".join(["me", "mailFolders"] + resource))
+
+        if resource[1:] == ["messages", "delta"]:
+            return self._delta(
+                changes=lambda since, until: mailbox.changes(folder_id=folder_id, since=since, until=until),
+                render=lambda record: self._message(record=record, query=query, headers=headers),
+                odata_type="#microsoft.graph.message",
+                query=query,
+                headers=headers,
+                path="/".join(["me", "mailFolders"] + resource)
+            )
+
+        if len(resource) == 3 and resource[1] == "messages":
+            return self._route_messages(method=method, resource=resource[2:], query=query, headers=headers, body=b"")
+
+        return _error(404, "ResourceNotFound", "Resource not found for the segment.")
+
+    def _folder(self, folder: Dict) -> Dict:
+        """Adds the counts to a folder."""
+
+        mailbox = self.mailbox
+        records = mailbox.list_messages(folder_id=folder["id"])
+
+        return dict(
+            folder,
+            childFolderCount=sum(1 for child in mailbox.folders.values() if child["parentFolderId"] == folder["id"]),
+            totalItemCount=len(records),
+            unreadItemCount=sum(1 for record in records if not record["message"]["isRead"])
+        )
+
+    def _route_messages(self, method: str, resource: List[str], query: Dict, headers: Dict, body: bytes) -> Tuple[int, Dict, object]:
+        """Answers the requests under /me/messages."""
+
+        mailbox = self.mailbox
+
+        if not resource:
+            if method == "GET":
+                return self._list_messages(folder_id=None, query=query, headers=headers, path="me/messages")
+            if method == "POST":
+                record = self._store_draft(message=json.loads(body), folder_id="drafts")
+                return 201, {}, record["message"]
+            return _error(405, "ErrorInvalidRequest", "The method is not supported.")
+
+        record = mailbox.messages.get(resource[0])
+        if record is None:
+            return _error(404, "ErrorItemNotFound", "The specified object was not found in the store.")
+
+        if len(resource) == 1:
+            if method == "DELETE":
+                mailbox.delete_messages([resource[0]])
+                return 204, {}, None
+            return 200, {}, self._message(record=record, query=query, headers=headers)
+
+        if resource[1:] == ["send"] and method == "POST":
+            mailbox.move_message(message_id=resource[0], folder_id="sentitems")
+            return 202, {}, None
+
+        if resource[1] != "attachments":
+            return _error(404, "ResourceNotFound", "Resource not found for the segment.")
+
+        if len(resource) == 2:
+            if method == "POST":
+                attachment = json.loads(body)
+                return 201, {}, self._store_attachment(
+                    record=record,
+                    name=attachment["name"],
+                    size=len(base64.b64decode(attachment.get("contentBytes", "")))
+                )
+            attachments = [self._attachment(record=record, attachment=attachment) for attachment in record["attachments"]]
+            return 200, {}, {"value": [_project(attachment, query) for attachment in attachments]}
+
+        if resource[2] == "createUploadSession" and method == "POST":
+            item = json.loads(body)["AttachmentItem"]
+            token = hashlib.sha1(f"{resource[0]}:{item['name']}:{time.time()}".encode()).hexdigest()
+            with self._lock:
+                self._uploads[token] = {"record": record, "name": item["name"], "size": item["size"], "received": 0}
+            return 201, {}, {
+                "uploadUrl": f"{self.url}/upload/{token}",
+                "expirationDateTime": (datetime.now(timezone.utc) + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "nextExpectedRanges": ["0-"]
+            }
+
+        attachment = next((attachment for attachment in record["attachments"] if attachment["id"] == resource[2]), None)
+        if attachment is None:
+            return _error(404, "ErrorItemNotFound", "The specified object was not found in the store.")
+
+        if len(resource) == 3:
+            return 200, {}, _project(self._attachment(record=record, attachment=attachment, content=True), query)
+
+        if resource[3:] == ["$value"]:
+            return self._attachment_value(attachment=attachment, headers=headers)
+
+        return _error(404, "ResourceNotFound", "Resource not found for the segment.")
+
+    def _list_messages(self, folder_id: str, query: Dict, headers: Dict, path: str) -> Tuple[int, Dict, object]:
+        """Answers a message listing."""
+
+        records = self.mailbox.list_messages(folder_id=folder_id)
+
+        if query.get("$orderby", "").replace("%20", " ").endswith(" asc"):
+            records = records[::-1]
+
+        page = self._page(items=records, query=query, headers=headers, path=path)
+        page["value"] = [self._message(record=record, query=query, headers=headers) for record in page["value"]]
+
+        return 200, _preference_applied(headers), page
+
+    def _delta(
+        self,
+        changes: Callable[[int, int], List[Tuple[int, object]]],
+        render: Callable[[object], Dict],
+        odata_type: str,
+        query: Dict,
+        headers: Dict,
+        path: str
+    ) -> Tuple[int, Dict, object]:
+        """Answers a delta query, the state is kept in the tokens.
+        Removed items are given as ids by `changes`, the others are
+        rendered with `render`."""
+
+        try:
+            if "$skiptoken" in query:
+                since, until, offset = [int(part) for part in query["$skiptoken"].split(".")]
+            else:
+                since, until, offset = int(query.get("$deltatoken", 0)), self.mailbox.sequence, 0
+        except ValueError:
+            return _error(400, "SyncStateInvalid", "The sync state is invalid.")
+
+        changes = changes(since, until)
+        page_size = _max_page_size(headers) or self.page_size
+        page = changes[offset:offset + page_size]
+
+        value = []
+        for _, change in page:
+            if isinstance(change, str):
+                value.append({"@odata.type": odata_type, "id": change, "@removed": {"reason": "deleted"}})
+            else:
+                value.append(render(change))
+
+        links = {name: query[name] for name in ["$select"] if name in query}
+        content = {"value": value}
+
+        if offset + page_size < len(changes):
+            links["$skiptoken"] = f"{since}.{until}.{offset + page_size}"
+            content["@odata.nextLink"] = self._link(path=path, query=links)
+        else:
+            links["$deltatoken"] = str(until)
+            content["@odata.deltaLink"] = self._link(path=path, query=links)
+
+        return 200, _preference_applied(headers), content
+
+    def _page(self, items: List, query: Dict, headers: Dict, path: str) -> Dict:
+        """Cuts a page out of a collection and links the next one."""
+
+        top = int(query.get("$top", 0)) or _max_page_size(headers) or self.page_size
+        top = min(top, 1000)
+        skip = int(query.get("$skip", 0))
+
+        content = {"value": items[skip:skip + top]}
+
+        if query.get("$count") == "true":
+            content["@odata.count"] = len(items)
+
+        if skip + top < len(items):
+            content["@odata.nextLink"] = self._link(path=path, query=dict(query, **{"$skip": str(skip + top)}))
+
+        return content
+
+    def _link(self, path: str, query: Dict) -> str:
+        """Builds an absolute link back to the server."""
+
+        return f"{self.url}/v1.0/{path}?" + urlencode(query, safe="$,'()/:", quote_via=quote)
+
+    def _message(self, record: Dict, query: Dict, headers: Dict) -> Dict:
+        """Renders a message with the $select and Prefer of the request."""
+
+        message = _project(record["message"], query)
+
+        if "body" in message and 'outlook.body-content-type="text"' in headers.get("prefer", ""):
+            message["body"] = {"contentType": "text", "content": record["text"]}
+
+        return message
+
+    def _attachment(self, record: Dict, attachment: Dict, content: bool = False) -> Dict:
+        """Renders an attachment, with its content if asked for."""
+
+        attachment = dict(attachment, lastModifiedDateTime=record["message"]["sentDateTime"])
+
+        if content:
+            attachment["contentBytes"] = base64.b64encode(self.mailbox.attachment_bytes(attachment)).decode()
+
+        return attachment
+
+    def _attachment_value(self, attachment: Dict, headers: Dict) -> Tuple[int, Dict, object]:
+        """Answers the raw content of an attachment, honoring Range."""
+
+        content = self.mailbox.attachment_bytes(attachment)
+        match = re.match(r"bytes=(\d+)-(\d*)$", headers.get("range", ""))
+
+        if match is None:
+            return 200, {"Content-Type": "application/octet-stream"}, content
+
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(content) - 1
+
+        if start >= len(content):
+            return 416, {"Content-Range": f"bytes */{len(content)}"}, b""
+
+        return 206, {
+            "Content-Type": "application/octet-stream",
+            "Content-Range": f"bytes {start}-{end}/{len(content)}"
+        }, content[start:end + 1]
+
+    def _store_draft(self, message: Dict, folder_id: str) -> Dict:
+        """Stores a message sent or saved by the client."""
+
+        mailbox = self.mailbox
+
+        with mailbox._lock:
+            message_id = mailbox.add_messages(count=1, folder_id=folder_id)[0]
+            record = mailbox.messages[message_id]
+            record["message"]["subject"] = message.get("subject", "")
+            record["message"]["body"] = message.get("body", {"contentType": "text", "content": ""})
+            record["text"] = _HTML_TAG.sub("", record["message"]["body"].get("content", ""))
+            record["message"]["toRecipients"] = message.get("toRecipients", [])
+            record["attachments"] = []
+            for attachment in message.get("attachments", []):
+                self._store_attachment(
+                    record=record,
+                    name=attachment["name"],
+                    size=len(base64.b64decode(attachment.get("contentBytes", "")))
+                )
+            record["message"]["hasAttachments"] = len(record["attachments"]) > 0
+
+        return record
+
+    def _store_attachment(self, record: Dict, name: str, size: int) -> Dict:
+        """Adds an attachment to a stored message."""
+
+        attachment = {
+            "@odata.type": "#microsoft.graph.fileAttachment",
+            "id": self.mailbox._make_id("attachment", f"{record['message']['id']}:{name}") + "BEgAQ",
+            "name": name,
+            "contentType": "application/octet-stream",
+            "size": size,
+            "isInline": False
+        }
+        record["attachments"].append(attachment)
+        record["message"]["hasAttachments"] = True
+
+        return attachment
+
+    def _upload_chunk(self, token: str, headers: Dict, body: bytes) -> Tuple[int, Dict, object]:
+        """Answers a chunk sent to an upload session."""
+
+        with self._lock:
+            upload = self._uploads.get(token)
+
+        if upload is None:
+            return _error(404, "ItemNotFound", "The upload session was not found.")
+
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)$", headers.get("content-range", ""))
+        if match is None or int(match.group(1)) != upload["received"] or int(match.group(2)) - int(match.group(1)) + 1 != len(body):
+            return _error(416, "InvalidRange", "The Content-Range does not follow the bytes received.")
+
+        upload["received"] = int(match.group(2)) + 1
+
+        if upload["received"] < upload["size"]:
+            return 200, {}, {
+                "expirationDateTime": (datetime.now(timezone.utc) + timedelta(hours=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "nextExpectedRanges": [f"{upload['received']}-"]
+            }
+
+        with self._lock:
+            del self._uploads[token]
+        self._store_attachment(record=upload["record"], name=upload["name"], size=upload["size"])
+
+        return 201, {}, None
+
+
+class FakeGraphClient():
+
+    """
+    ### Overview:
+    ----
+    A stand-in for `MicrosoftGraphClient` connected to a
+    `FakeGraphServer`, it has the attributes `GraphSession`,
+    `AsyncGraphSession` and `MSGraphOutlook` use and a token that
+    never expires.
+    """
+
+    def __init__(self, server: FakeGraphServer, **session_args) -> None:
+        """Initializes the `FakeGraphClient`.
+
+        ### Parameters
+        ----
+        server : FakeGraphServer
+            The server to connect to.
+
+        **session_args :
+            Passed on to `GraphSession`, e.g. `rate_limiter`.
+        """
+
+        self.RESOURCE = server.url + "/"
+        self.api_version = "v1.0"
+        self.access_token = server.access_token
+        self.graph_session = None
+
+        self._session_args = session_args
+
+    def login(self) -> bool:
+        """Creates the session, there is nothing to log in to."""
+
+        self.graph_session = GraphSession(client=self, **self._session_args)
+
+        return True
+
+    def _token_validation(self, nseconds: int = 60) -> None:
+        pass
+
+    def _renew_token(self, used_token: str) -> None:
+        pass
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+
+    """The HTTP server of `FakeGraphServer`."""
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients closing their pooled connections are not errors.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class _FakeGraphHandler(BaseHTTPRequestHandler):
+
+    """Hands the requests of the HTTP server to `FakeGraphServer.handle`."""
+
+    protocol_version = "HTTP/1.1"
+
+    def _dispatch(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        headers = {name.lower(): value for name, value in self.headers.items()}
+
+        fake_server: FakeGraphServer = self.server.fake_server
+        try:
+            status, response_headers, content = fake_server.handle(
+                method=self.command,
+                target=self.path,
+                headers=headers,
+                body=body
+            )
+        except Exception as error:
+            status, response_headers, content = _error(500, "InternalServerError", repr(error))
+
+        if isinstance(content, (dict, list)):
+            content = json.dumps(content).encode()
+            response_headers = dict(response_headers, **{"Content-Type": "application/json"})
+        elif content is None:
+            content = b""
+
+        if (
+            fake_server.compress
+            and len(content) > 1024
+            and "gzip" in headers.get("accept-encoding", "")
+            and response_headers.get("Content-Type") == "application/json"
+        ):
+            content = gzip.compress(content, compresslevel=1)
+            response_headers["Content-Encoding"] = "gzip"
+
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+        fake_server._count("bytes_sent", len(content))
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+    do_PUT = _dispatch
+    do_PATCH = _dispatch
+    do_DELETE = _dispatch
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def _split_target(target: str) -> Tuple[List[str], Dict]:
+    """Splits a request target into its path segments, without the
+    API version, and its query options."""
+
+    parts = urlsplit(target)
+    path = [segment for segment in parts.path.split("/") if segment]
+
+    if path[:1] in (["v1.0"], ["beta"]):
+        path = path[1:]
+
+    return path, dict(parse_qsl(parts.query, keep_blank_values=True))
+
+
+def _project(item: Dict, query: Dict) -> Dict:
+    """Applies $select to an item, id and @odata.type are always kept."""
+
+    if "$select" not in query:
+        return dict(item)
+
+    fields = set(query["$select"].split(",")) | {"id", "@odata.type"}
+
+    return {name: value for name, value in item.items() if name in fields}
+
+
+def _max_page_size(headers: Dict) -> int:
+    """Reads odata.maxpagesize from the Prefer header, 0 if missing."""
+
+    match = re.search(r"odata\.maxpagesize=(\d+)", headers.get("prefer", ""))
+
+    return int(match.group(1)) if match else 0
+
+
+def _preference_applied(headers: Dict) -> Dict:
+    """Echoes the body type preference like Graph does."""
+
+    if 'outlook.body-content-type="text"' in headers.get("prefer", ""):
+        return {"Preference-Applied": 'outlook.body-content-type="text"'}
+
+    return {}
+
+
+def _error(status: int, code: str, message: str, retry_after: float = None) -> Tuple[int, Dict, object]:
+    """Builds a Graph error response."""
+
+    headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+
+    return status, headers, {"error": {"code": code, "message": message}}
@@ -0,0 +1,407 @@
+import json
+import logging
+import re
+import threading
+import time
+
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlsplit
+
+
+# Upper bounds in seconds of the latency histogram buckets, the last
+# bucket holds everything slower.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Message, folder and attachment ids are long base64 strings, and some
+# segments carry them as key arguments, e.g. "messages('AAMk...')".
+_ID_SEGMENT = re.compile(r"^[A-Za-z0-9_=+\-]{32,}$")
+_KEY_ARGUMENT = re.compile(r"\('[^']*'\)")
+_VERSION_SEGMENT = re.compile(r"^(v1\.0|v2\.0|beta)$")
+
+
+def normalize_endpoint(method: str, url: str) -> str:
+    """Turns a request into the endpoint name its metrics are kept
+    under, e.g. "GET /me/messages/{id}/attachments".
+
+    ### Parameters
+    ----
+    method : str
+        The Request method.
+
+    url : str
+        The full URL of the request.
+
+    ### Returns
+    ----
+    str:
+        The method and the path without host, API version, query
+        string and ids.
+    """
+
+    path = urlsplit(url).path
+    segments = []
+
+    for segment in path.split("/"):
+        if not segment or _VERSION_SEGMENT.match(segment):
+            continue
+        segment = _KEY_ARGUMENT.sub("('{id}')", segment)
+        segments.append("{id}" if _ID_SEGMENT.match(segment) else segment)
+
+    return method.upper() + " /" + "/".join(segments)
+
+
+class EndpointMetrics():
+
+    """
+    ### Overview:
+    ----
+    The latency histogram, bytes transferred and status codes of
+    one endpoint. Not thread safe on its own, `GraphMetrics` holds
+    the lock.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        """Initializes the `EndpointMetrics` with all counters at 0.
+
+        ### Parameters
+        ----
+        buckets : tuple (optional, Default=LATENCY_BUCKETS)
+            The upper bounds in seconds of the latency buckets.
+        """
+
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.status_counts = {}
+
+    def observe(
+        self,
+        status: Optional[int],
+        seconds: float,
+        bytes_sent: int,
+        bytes_received: int
+    ) -> None:
+        """Adds one request to the metrics."""
+
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+
+        self.bucket_counts[index] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+
+        key = str(status) if status is not None else "connection_error"
+        self.status_counts[key] = self.status_counts.get(key, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        """Estimates a latency percentile from the histogram.
+
+        ### Parameters
+        ----
+        fraction : float
+            The percentile as a fraction, e.g. 0.95.
+
+        ### Returns
+        ----
+        float:
+            The upper bound of the bucket the percentile falls in,
+            the slowest request for the last bucket.
+        """
+
+        if self.count == 0:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+
+        for index, bucket_count in enumerate(self.bucket_counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max_seconds)
+                break
+
+        return self.max_seconds
+
+    def to_dict(self) -> Dict:
+        """Returns the metrics as a dictionary."""
+
+        histogram = {
+            f"le_{bound}": bucket_count
+            for bound, bucket_count in zip(self.buckets, self.bucket_counts)
+        }
+        histogram["le_inf"] = self.bucket_counts[-1]
+
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total_seconds, 3),
+            "mean_seconds": round(self.total_seconds / self.count, 3) if self.count else 0.0,
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+            "max_seconds": round(self.max_seconds, 3),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "status_counts": dict(self.status_counts),
+            "latency_histogram": histogram
+        }
+
+
+class GraphMetrics():
+
+    """
+    ### Overview:
+    ----
+    Thread safe instrumentation of the requests sent by a session:
+    per-endpoint latency histograms, bytes transferred and status
+    codes, plus hooks that are called after every request so the
+    numbers can be exported elsewhere.
+    """
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS) -> None:
+        """Initializes the `GraphMetrics`.
+
+        ### Parameters
+        ----
+        buckets : tuple (optional, Default=LATENCY_BUCKETS)
+            The upper bounds in seconds of the latency buckets.
+
+        ### Usage:
+        ----
+            >>> metrics = GraphMetrics()
+            >>> metrics.add_hook(log_request)
+            >>> graph_session = GraphSession(client=graph_client, metrics=metrics)
+        """
+
+        self.buckets = buckets
+        self.started = time.time()
+
+        self._endpoints: Dict[str, EndpointMetrics] = {}
+        self._hooks: List[Callable[[Dict], None]] = []
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: Callable[[Dict], None]) -> None:
+        """Registers a function called after every request.
+
+        ### Overview:
+        ----
+        The hook gets a dictionary with the "endpoint", "method",
+        "url", "status" (None for a connection error), "seconds",
+        "bytes_sent", "bytes_received" and "attempt" of the request.
+        It runs on the thread that sent the request, so it should
+        be quick. Errors raised by a hook are logged and ignored.
+
+        ### Parameters
+        ----
+        hook : Callable[[Dict], None]
+            The function to call.
+        """
+
+        with self._lock:
+            self._hooks.append(hook)
+
+    def remove_hook(self, hook: Callable[[Dict], None]) -> None:
+        """Unregisters a function added with `add_hook`."""
+
+        with self._lock:
+            self._hooks.remove(hook)
+
+    def record(
+        self,
+        method: str,
+        url: str,
+        status: Optional[int],
+        seconds: float,
+        bytes_sent: int = 0,
+        bytes_received: int = 0,
+        attempt: int = 0
+    ) -> None:
+        """Records one request sent to Microsoft Graph.
+
+        ### Parameters
+        ----
+        method : str
+            The Request method.
+
+        url : str
+            The full URL of the request.
+
+        status : int
+            The status code, None if no response came back.
+
+        seconds : float
+            The time the request took.
+
+        bytes_sent : int (optional, Default=0)
+            The size of the request body.
+
+        bytes_received : int (optional, Default=0)
+            The size of the response body.
+
+        attempt : int (optional, Default=0)
+            The number of retries made before this request.
+        """
+
+        endpoint = normalize_endpoint(method=method, url=url)
+
+        with self._lock:
+            if endpoint not in self._endpoints:
+                self._endpoints[endpoint] = EndpointMetrics(buckets=self.buckets)
+            self._endpoints[endpoint].observe(
+                status=status,
+                seconds=seconds,
+                bytes_sent=bytes_sent,
+                bytes_received=bytes_received
+            )
+            hooks = list(self._hooks)
+
+        if not hooks:
+            return
+
+        event = {
+            "endpoint": endpoint,
+            "method": method.upper(),
+            "url": url,
+            "status": status,
+            "seconds": seconds,
+            "bytes_sent": bytes_sent,
+            "bytes_received": bytes_received,
+            "attempt": attempt
+        }
+
+        for hook in hooks:
+            try:
+                hook(event)
+            except Exception:
+                logging.exception("Metrics hook failed")
+
+    def add_bytes_received(self, method: str, url: str, bytes_received: int) -> None:
+        """Adds bytes read after a request was recorded, e.g. the
+        body of a streamed download."""
+
+        endpoint = normalize_endpoint(method=method, url=url)
+
+        with self._lock:
+            if endpoint in self._endpoints:
+                self._endpoints[endpoint].bytes_received += bytes_received
+
+    def reset(self) -> None:
+        """Clears all the metrics, the hooks are kept."""
+
+        with self._lock:
+            self._endpoints = {}
+            self.started = time.time()
+
+    def snapshot(self, retry_stats: object = None) -> Dict:
+        """Returns a copy of the metrics.
+
+        ### Parameters
+        ----
+        retry_stats : RetryStats (optional, Default=None)
+            The retry counters of the session, added under "retries".
+
+        ### Returns
+        ----
+        dict:
+            The totals and the metrics of every endpoint.
+        """
+
+        with self._lock:
+            endpoints = {
+                endpoint: endpoint_metrics.to_dict()
+                for endpoint, endpoint_metrics in self._endpoints.items()
+            }
+
+        snapshot = {
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "requests": sum(metrics["count"] for metrics in endpoints.values()),
+            "request_seconds": round(sum(metrics["total_seconds"] for metrics in endpoints.values()), 3),
+            "bytes_sent": sum(metrics["bytes_sent"] for metrics in endpoints.values()),
+            "bytes_received": sum(metrics["bytes_received"] for metrics in endpoints.values()),
+            "endpoints": endpoints
+        }
+
+        if retry_stats is not None:
+            snapshot["retries"] = retry_stats.snapshot()
+
+        return snapshot
+
+    def report(self, retry_stats: object = None) -> str:
+        """Formats the metrics as a table, slowest endpoints first.
+
+        ### Parameters
+        ----
+        retry_stats : RetryStats (optional, Default=None)
+            The retry counters of the session, added at the end.
+
+        ### Returns
+        ----
+        str:
+            The report.
+        """
+
+        snapshot = self.snapshot(retry_stats=retry_stats)
+        endpoints = sorted(
+            snapshot["endpoints"].items(),
+            key=lambda item: item[1]["total_seconds"],
+            reverse=True
+        )
+
+        lines = [
+            f"{snapshot['requests']} requests, {snapshot['request_seconds']}s in requests, "
+            f"{snapshot['bytes_received']} bytes received, {snapshot['bytes_sent']} bytes sent "
+            f"in {snapshot['elapsed_seconds']}s",
+            f"{'endpoint':<60} {'count':>7} {'total s':>9} {'mean s':>8} {'p95 s':>7} {'MB in':>8}  statuses"
+        ]
+
+        for endpoint, metrics in endpoints:
+            statuses = " ".join(
+                f"{status}:{count}" for status, count in sorted(metrics["status_counts"].items())
+            )
+            lines.append(
+                f"{endpoint[:60]:<60} {metrics['count']:>7} {metrics['total_seconds']:>9.2f} "
+                f"{metrics['mean_seconds']:>8.3f} {metrics['p95_seconds']:>7.2f} "
+                f"{metrics['bytes_received'] / 1048576:>8.2f}  {statuses}"
+            )
+
+        if "retries" in snapshot:
+            lines.append(" ".join(f"{name}: {count}" for name, count in snapshot["retries"].items()))
+
+        return "\n".join(lines)
+
+    def export_json(self, path: str, retry_stats: object = None) -> None:
+        """Writes `snapshot` to a json file.
+
+        ### Parameters
+        ----
+        path : str
+            The path of the file.
+
+        retry_stats : RetryStats (optional, Default=None)
+            The retry counters of the session.
+        """
+
+        with open(path, "w") as file:
+            json.dump(self.snapshot(retry_stats=retry_stats), file, indent=4)
+
+
+def log_request(event: Dict) -> None:
+    """A hook for `GraphMetrics.add_hook` that logs every request at
+    DEBUG level, and the failed ones at WARNING level."""
+
+    level = logging.DEBUG if event["status"] is not None and event["status"] < 400 else logging.WARNING
+    logging.log(
+        level,
+        f"{event['endpoint']} {event['status']} {event['seconds']:.3f}s "
+        f"{event['bytes_received']} bytes (attempt {event['attempt']})"
+    )
@@ -0,0 +1,269 @@
+import random
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+from typing import Dict
+from typing import Optional
+
+
+class RetryPolicy():
+
+    """
+    ### Overview:
+    ----
+    Decides which responses are retried and how long to wait
+    before the next attempt.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        retry_statuses: tuple = (429, 500, 502, 503, 504)
+    ) -> None:
+        """Initializes the `RetryPolicy`.
+
+        ### Parameters
+        ----
+        max_retries : int (optional, Default=6)
+            The number of times a request is retried before
+            the last response is handed back.
+
+        backoff_base : float (optional, Default=1.0)
+            The wait in seconds before the first retry when the
+            server does not send a Retry-After header, doubled
+            on every following retry.
+
+        backoff_cap : float (optional, Default=60.0)
+            The longest wait in seconds between two attempts.
+
+        retry_statuses : tuple (optional, Default=(429, 500, 502, 503, 504))
+            The status codes that are retried.
+        """
+
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_statuses = retry_statuses
+
+    def should_retry(self, status_code: int) -> bool:
+        """Checks if a response with `status_code` is retried.
+
+        ### Parameters
+        ----
+        status_code : int
+            The status code of the response.
+
+        ### Returns
+        ----
+        bool:
+            `True` if the request should be sent again.
+        """
+
+        return status_code in self.retry_statuses
+
+    def compute_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Computes how long to wait before the next attempt.
+
+        ### Overview:
+        ----
+        The server's Retry-After is honored as is. Without it, a
+        "full jitter" exponential backoff is used: a random wait
+        between 0 and `backoff_base * 2 ** attempt`, capped at
+        `backoff_cap`, so that workers throttled at the same time
+        do not all come back at the same time.
+
+        ### Parameters
+        ----
+        attempt : int
+            The number of retries already made, 0 for the first.
+
+        retry_after : float (optional, Default=None)
+            The wait in seconds asked for by the server.
+
+        ### Returns
+        ----
+        float:
+            The number of seconds to wait.
+        """
+
+        if retry_after is not None:
+            return retry_after
+
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Parses a Retry-After header.
+
+        ### Parameters
+        ----
+        value : str
+            The header value, either a number of seconds or an
+            HTTP date.
+
+        ### Returns
+        ----
+        float:
+            The number of seconds to wait, `None` if the header
+            is missing or cannot be parsed.
+        """
+
+        if value is None:
+            return None
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+class TokenBucket():
+
+    """
+    ### Overview:
+    ----
+    A thread safe token bucket that spaces out requests so that
+    all the workers sharing it stay under a request budget.
+    """
+
+    def __init__(self, rate: float, capacity: float = None) -> None:
+        """Initializes the `TokenBucket`.
+
+        ### Parameters
+        ----
+        rate : float
+            The number of tokens added per second, i.e. the
+            sustained number of requests per second.
+
+        capacity : float (optional, Default=None)
+            The largest burst allowed, defaults to `rate`.
+        """
+
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Takes `tokens` from the bucket without blocking.
+
+        ### Overview:
+        ----
+        The tokens are always taken, the bucket can go into
+        debt. The caller has to wait the returned number of
+        seconds before using them, which lets both threads and
+        asyncio tasks share the same bucket.
+
+        ### Parameters
+        ----
+        tokens : float (optional, Default=1)
+            The number of tokens needed.
+
+        ### Returns
+        ----
+        float:
+            The number of seconds to wait before going ahead.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= tokens
+
+            wait = max(0.0, -self._tokens / self.rate)
+
+            return max(wait, self._paused_until - now)
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Blocks until `tokens` are available and takes them.
+
+        ### Parameters
+        ----
+        tokens : float (optional, Default=1)
+            The number of tokens needed.
+        """
+
+        wait = self.reserve(tokens=tokens)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every caller for the next `seconds`.
+
+        ### Overview:
+        ----
+        Used when the server throttles, so that all workers back
+        off together instead of each one finding out on its own.
+
+        ### Parameters
+        ----
+        seconds : float
+            The number of seconds to hold back for.
+        """
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RetryStats():
+
+    """
+    ### Overview:
+    ----
+    Thread safe counters of the throttled, retried and failed
+    requests of a session.
+    """
+
+    def __init__(self) -> None:
+        """Initializes the `RetryStats` with all counters at 0."""
+
+        self._counters = {
+            "throttles": 0,
+            "retries": 0,
+            "connection_errors": 0,
+            "give_ups": 0
+        }
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, count: int = 1) -> None:
+        """Adds `count` to the counter `name`.
+
+        ### Parameters
+        ----
+        name : str
+            One of ["throttles", "retries", "connection_errors", "give_ups"]
+
+        count : int (optional, Default=1)
+            The amount to add.
+        """
+
+        with self._lock:
+            self._counters[name] += count
+
+    def snapshot(self) -> Dict:
+        """Returns a copy of the counters.
+
+        ### Returns
+        ----
+        dict:
+            The counter names mapped to their values.
+        """
+
+        with self._lock:
+            return dict(self._counters)
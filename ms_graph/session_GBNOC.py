@@ -1,8 +1,8 @@
+import hashlib
 import json as json_lib
 import logging
 # import pathlib
 import time
-import math
 
 from typing import Dict
 from typing import List
@@ -10,24 +10,62 @@ from typing import Union
 import os
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from ms_graph.metrics_GBNOC import GraphMetrics
+from ms_graph.retry_GBNOC import RetryPolicy
+from ms_graph.retry_GBNOC import RetryStats
+from ms_graph.retry_GBNOC import TokenBucket
 
 class GraphSession():
 
     """Serves as the Session for the Current Microsoft
     Graph API."""
 
-    def __init__(self, client: object) -> None:
+    def __init__(
+        self,
+        client: object,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        retry_policy: RetryPolicy = None,
+        rate_limiter: TokenBucket = None,
+        metrics: GraphMetrics = None
+    ) -> None:
         """Initializes the `GraphSession` client.
 
         ### Overview:
         ----
         The GraphSession object handles all the requests made
         for the different endpoints on the Microsoft Graph API.
+        All requests go through one long-lived `requests.Session`,
+        so connections (and their TLS handshake through the proxy)
+        are kept alive and reused across requests and threads.
 
         ### Arguments:
         ----
         client (str): The Microsoft Graph API Python Client.
 
+        pool_connections (int): The number of hosts to keep a
+            connection pool for. (default: {10})
+
+        pool_maxsize (int): The number of connections kept open per
+            host, should be at least the number of threads sharing
+            the session. (default: {10})
+
+        retry_policy (RetryPolicy): Decides which responses are
+            retried and the backoff between attempts.
+            (default: {RetryPolicy()})
+
+        rate_limiter (TokenBucket): Spaces out the requests of all
+            threads using the session. Pass the same bucket to
+            several sessions on the same mailbox to share the
+            budget. (default: {16 requests per second, Graph's
+            10,000 requests per 10 minutes per mailbox})
+
+        metrics (GraphMetrics): Records the latency, bytes and
+            status code of every request sent, see
+            `metrics_report`. (default: {GraphMetrics()})
+
         ### Usage:
         ----
             >>> graph_session = GraphSession()
@@ -44,7 +82,37 @@ class GraphSession():
         # logging.basicConfig(filename="logs/log_file_custom.log",level=logging.INFO,format=log_format)
 
         self.client: MicrosoftGraphClient = client
-        
+
+        # Define the long-lived session, its connection pool is thread safe.
+        self.request_session = requests.Session()
+        self.request_session.verify = True
+        self.request_session.headers.update({
+            "Accept-Encoding": "gzip, deflate",
+            "Connection": "keep-alive"
+        })
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize
+        )
+        self.request_session.mount("https://", adapter)
+        self.request_session.mount("http://", adapter)
+
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else TokenBucket(rate=16)
+        self.retry_stats = RetryStats()
+        self.metrics = metrics if metrics is not None else GraphMetrics()
+
+    def close(self) -> None:
+        """Closes the session and all its pooled connections."""
+
+        self.request_session.close()
+
+    def metrics_report(self) -> str:
+        """Returns the request metrics and retry counters of the
+        session as a table, see `GraphMetrics.report`."""
+
+        return self.metrics.report(retry_stats=self.retry_stats)
 
     def build_headers(self, additional_args: dict = None) -> Dict:
         """Used to build the headers needed to make the request.
@@ -61,6 +129,10 @@ class GraphSession():
             A dictionary containing all the components.
         """
 
+        # Make sure the token outlives the request, this only refreshes
+        # if the client's background refresher has fallen behind.
+        self.client._token_validation()
+
         # Define the base headers.
         headers = {
             "Authorization": f"Bearer {self.client.access_token}"
@@ -77,7 +149,9 @@ class GraphSession():
         ### Parameters
         ----
         endpoint : str
-            The endpoint used to make the full URL.
+            The endpoint used to make the full URL. Absolute URLs, such
+            as the `@odata.nextLink` or `@odata.deltaLink` returned by
+            paged responses, are passed through unchanged.
 
         ### Returns
         ----
@@ -85,42 +159,97 @@ class GraphSession():
             The full URL with the endpoint needed.
         """
 
+        if endpoint.startswith("https://") or endpoint.startswith("http://"):
+            return endpoint
+
         url = self.client.RESOURCE + self.client.api_version + "/" + endpoint
 
         return url
 
-    def cearte_session_return_response(self,method,headers,url,params,data,json):
-        # Define a new session.
-        request_session = requests.Session()
-        request_session.verify = True
-
-        # Define a new request.
-        request_request = requests.Request(
+    def cearte_session_return_response(self,method,headers,url,params,data,json,stream=False):
+        # Define a new request, merged with the session headers so that
+        # compressed responses are accepted.
+        request_request = self.request_session.prepare_request(requests.Request(
             method=method.upper(),
             headers=headers,
             url=url,
             params=params,
             data=data,
             json=json
-        ).prepare()
-
-        # Send the request.
-        response: requests.Response = request_session.send(
-            request=request_request
-        )
-
-        # Close the session.
-        request_session.close()
-
-        # If it"s okay and no details.
-        if response.status_code==429 or response.status_code==503:
-            print("Too Many request/service is temporarily unavailable, status code: ",response.status_code,". Wait for ",response.request.headers['retry-after']," seconds")
-            time.sleep(math.ceil(response.request.headers['retry-after']))
-            self.cearte_session_return_response(method,headers,url,params,data,json)
-        elif response.status_code==500 or response.status_code==504:
-            print("There was an internal server error/timeout while processing the request.")
-            self.cearte_session_return_response(method,headers,url,params,data,json)
-        return response,requests
+        ))
+
+        body = request_request.body
+        bytes_sent = len(body) if body is not None else 0
+        attempt = 0
+
+        while True:
+            # Wait for a slot in the request budget shared by all threads.
+            self.rate_limiter.acquire()
+
+            started = time.perf_counter()
+
+            try:
+                # Send the request, reusing a pooled connection if one is open.
+                response: requests.Response = self.request_session.send(
+                    request=request_request,
+                    stream=stream
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.metrics.record(
+                    method=method,
+                    url=request_request.url,
+                    status=None,
+                    seconds=time.perf_counter() - started,
+                    bytes_sent=bytes_sent,
+                    attempt=attempt
+                )
+                self.retry_stats.increment("connection_errors")
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment("give_ups")
+                    raise
+                delay = self.retry_policy.compute_delay(attempt)
+                logging.warning(f"Connection failed, retrying in {delay:.1f} seconds")
+            else:
+                # A streamed body is counted by whoever reads it.
+                self.metrics.record(
+                    method=method,
+                    url=request_request.url,
+                    status=response.status_code,
+                    seconds=time.perf_counter() - started,
+                    bytes_sent=bytes_sent,
+                    bytes_received=0 if stream else self._wire_bytes(response),
+                    attempt=attempt
+                )
+
+                # If it"s okay and no details.
+                if not self.retry_policy.should_retry(response.status_code):
+                    return response,requests
+
+                if response.status_code==429 or response.status_code==503:
+                    self.retry_stats.increment("throttles")
+
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment("give_ups")
+                    return response,requests
+
+                retry_after = self.retry_policy.parse_retry_after(
+                    response.headers.get("Retry-After")
+                )
+                delay = self.retry_policy.compute_delay(attempt, retry_after)
+
+                if response.status_code==429 or response.status_code==503:
+                    # Hold back every thread, not just this one.
+                    self.rate_limiter.pause(delay)
+                    logging.warning(f"Throttled with status code {response.status_code}, waiting {delay:.1f} seconds")
+                else:
+                    logging.warning(f"Server error {response.status_code}, retrying in {delay:.1f} seconds")
+
+                # Hand the connection back to the pool before retrying.
+                response.close()
+
+            self.retry_stats.increment("retries")
+            time.sleep(delay)
+            attempt += 1
 
 
     def make_request(
@@ -166,12 +295,24 @@ class GraphSession():
             so if this is set to True it will only return
             the status code.
 
+        download : bool (optional, Default=False)
+            If set to True the response body is streamed to
+            `download_path`, see `download_file`.
+
         ### Returns:
         ----
         Union[List, Dict]:
             The resource object or objects.
         """
 
+        if download:
+            return self.download_file(
+                endpoint=endpoint,
+                download_path=download_path,
+                params=params,
+                additional_headers=additional_headers
+            )
+
         # Build the URL.
         url = self.build_url(endpoint=endpoint)
         logging.info(f"URL: {url}")
@@ -181,25 +322,17 @@ class GraphSession():
 
         response,requests = self.cearte_session_return_response(method,headers,url,params,data,json)
 
-        
+        if response.status_code == 401:
+            # The token was rejected after it was sent, renew it and retry once.
+            self.client._renew_token(used_token=headers["Authorization"][len("Bearer "):])
+            headers = self.build_headers(additional_args=additional_headers)
+            response,requests = self.cearte_session_return_response(method,headers,url,params,data,json)
 
         if response.ok and expect_no_response:
-            print("----------first response---------------")
             return {"status_code": response.status_code}
         elif response.ok and len(response.content) > 0:
-            print("----------second response---------------")
-            if download:
-                # To Download file
-                with open(download_path , 'wb') as file:
-                    file.write(response.content)
-                print("----download success---")
-                return [response.status_code]
-            else:
-                print("response:",response)
-                print("response json:",response.json())
-                return [response.status_code,response.json()]
+            return [response.status_code,response.json()]
         elif len(response.content) == 0 and response.ok:
-            print("----------Third response---------------")
             return {
                 "message": "Request was successful, status code provided.",
                 "status_code": response.status_code
@@ -209,8 +342,6 @@ class GraphSession():
         elif not response.ok:
             # print("-----original error response--------------")
             # print(response.json())
-            print("----------Fourth response---------------")
-            print(response)
 
             # # Define the error dict.
             # error_dict = {
@@ -223,4 +354,366 @@ class GraphSession():
 
             # # Log the error.
             # logging.error(msg=json_lib.dumps(obj=error_dict, indent=4))
-            raise requests.HTTPError()
\ No newline at end of file
+            raise requests.HTTPError(
+                f"{response.status_code} error for url: {response.url}",
+                response=response
+            )
+
+    def download_file(
+        self,
+        endpoint: str,
+        download_path: str,
+        params: dict = None,
+        additional_headers: dict = None,
+        expected_size: int = None,
+        expected_sha256: str = None,
+        chunk_size: int = 1024 * 1024
+    ) -> List:
+        """Streams a file to disk in chunks, resuming partial downloads.
+
+        ### Overview:
+        ----
+        The body is written to `download_path + ".part"` one chunk
+        at a time, so memory use does not depend on the file size,
+        and the part file is renamed to `download_path` only once
+        it is complete. A part file left behind by an interrupted
+        download is resumed with a Range request; if the server
+        ignores the range, the download starts over. A complete
+        file already at `download_path` is not downloaded again.
+
+        ### Arguments:
+        ----
+        endpoint : str
+            The API URL endpoint of the file content.
+
+        download_path : str
+            The path the file is saved to.
+
+        params : dict (optional, Default=None)
+            The URL params for the request.
+
+        additional_headers : dict (optional, Default=None)
+            Any additional headers that need to be sent in the
+            request.
+
+        expected_size : int (optional, Default=None)
+            The file size in bytes. An existing file of another
+            size is downloaded again, and a download of another
+            size raises an error.
+
+        expected_sha256 : str (optional, Default=None)
+            The hex SHA-256 of the file, checked the same way as
+            `expected_size`.
+
+        chunk_size : int (optional, Default=1 MB)
+            The number of bytes read and written at a time.
+
+        ### Returns:
+        ----
+        List:
+            The status code of the download, 304 if the file was
+            already downloaded.
+        """
+
+        if os.path.exists(download_path) and self._file_matches(
+            path=download_path,
+            expected_size=expected_size,
+            expected_sha256=expected_sha256
+        ):
+            logging.debug(f"Already downloaded, skipped: {download_path}")
+            return [304]
+
+        url = self.build_url(endpoint=endpoint)
+        part_path = download_path + ".part"
+        attempt = 0
+        renewed = False
+
+        while True:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+            headers = self.build_headers(additional_args=additional_headers)
+            if offset > 0:
+                headers["Range"] = f"bytes={offset}-"
+
+            response, _ = self.cearte_session_return_response(
+                "get", headers, url, params, None, None, stream=True
+            )
+
+            if response.status_code == 401 and not renewed:
+                # The token was rejected after it was sent, renew it and retry once.
+                response.close()
+                self.client._renew_token(used_token=headers["Authorization"][len("Bearer "):])
+                renewed = True
+                continue
+
+            if response.status_code == 416 and offset > 0:
+                # The part file does not fit the file anymore, start over.
+                response.close()
+                os.remove(part_path)
+                continue
+
+            if not response.ok:
+                response.close()
+                raise requests.HTTPError(
+                    f"{response.status_code} error for url: {response.url}",
+                    response=response
+                )
+
+            # Append if the server sent the rest, otherwise it sent it all.
+            mode = "ab" if response.status_code == 206 else "wb"
+            received = 0
+
+            try:
+                with open(part_path, mode) as file:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+                        received += len(chunk)
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                # Keep what was written and resume from there.
+                self.retry_stats.increment("connection_errors")
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment("give_ups")
+                    raise
+                self.retry_stats.increment("retries")
+                time.sleep(self.retry_policy.compute_delay(attempt))
+                attempt += 1
+                continue
+            finally:
+                response.close()
+                self.metrics.add_bytes_received(
+                    method="get",
+                    url=url,
+                    bytes_received=self._wire_bytes(response, read=received)
+                )
+
+            break
+
+        if not self._file_matches(
+            path=part_path,
+            expected_size=expected_size,
+            expected_sha256=expected_sha256
+        ):
+            os.remove(part_path)
+            raise ValueError(f"Downloaded file does not match the expected size or hash: {download_path}")
+
+        os.replace(part_path, download_path)
+        logging.debug(f"Downloaded: {download_path}")
+
+        return [response.status_code]
+
+    def upload_file(
+        self,
+        upload_url: str,
+        file_path: str,
+        chunk_size: int = 10 * 327680
+    ) -> Dict:
+        """Uploads a file to an upload session in ranged chunks.
+
+        ### Overview:
+        ----
+        The file is read and sent `chunk_size` bytes at a time, so
+        memory use does not depend on the file size. Each chunk is
+        retried with the session's retry policy.
+
+        ### Arguments:
+        ----
+        upload_url : str
+            The `uploadUrl` returned when creating the upload session.
+
+        file_path : str
+            The path of the file to upload.
+
+        chunk_size : int (optional, Default=3,276,800)
+            The number of bytes sent per request, Microsoft Graph
+            needs a multiple of 320 KiB below 4 MB.
+
+        ### Returns:
+        ----
+        Dict:
+            The status code of the last chunk.
+        """
+
+        total_size = os.path.getsize(file_path)
+        start = 0
+        status_code = None
+
+        with open(file_path, "rb") as file:
+            while start < total_size:
+                chunk = file.read(chunk_size)
+                end = start + len(chunk) - 1
+
+                # The upload URL is pre-authenticated, so no Authorization header.
+                headers = {
+                    "Content-Length": str(len(chunk)),
+                    "Content-Range": f"bytes {start}-{end}/{total_size}",
+                    "Content-Type": "application/octet-stream"
+                }
+
+                response, _ = self.cearte_session_return_response(
+                    "put", headers, upload_url, None, chunk, None
+                )
+
+                if not response.ok:
+                    raise requests.HTTPError(
+                        f"{response.status_code} error for url: {response.url}",
+                        response=response
+                    )
+
+                status_code = response.status_code
+                start = end + 1
+
+        return {"status_code": status_code}
+
+    def _wire_bytes(self, response: requests.Response, read: int = None) -> int:
+        """Returns the number of body bytes of a response read off the
+        connection, before they were decompressed. Falls back on
+        `read`, the decompressed bytes counted by the caller, or else
+        on the `Content-Length` header."""
+
+        try:
+            return int(response.raw.tell())
+        except (AttributeError, TypeError, ValueError):
+            if read is not None:
+                return read
+            return int(response.headers.get("Content-Length") or 0)
+
+    def _file_matches(
+        self,
+        path: str,
+        expected_size: int = None,
+        expected_sha256: str = None
+    ) -> bool:
+        """Checks a file against the expected size and SHA-256, any
+        file matches if neither is given."""
+
+        if expected_size is not None and os.path.getsize(path) != expected_size:
+            return False
+
+        if expected_sha256 is not None:
+            sha256 = hashlib.sha256()
+            with open(path, "rb") as file:
+                for block in iter(lambda: file.read(1024 * 1024), b""):
+                    sha256.update(block)
+            if sha256.hexdigest() != expected_sha256.lower():
+                return False
+
+        return True
+
+    def make_batch_request(
+        self,
+        batch_requests: List[Dict],
+        batch_size: int = 20
+    ) -> List[Dict]:
+        """Sends many requests through the JSON `$batch` endpoint.
+
+        ### Overview:
+        ----
+        The requests are packed `batch_size` at a time (20 is the
+        most Microsoft Graph accepts) into one `/$batch` call each,
+        and the responses are handed back in the same order as
+        `batch_requests`. Sub-requests that come back throttled or
+        with a server error are sent again in a later batch, using
+        the session's retry policy.
+
+        ### Arguments:
+        ----
+        batch_requests : List[Dict]
+            The requests, each a dictionary with a "url" relative to
+            the API version (e.g. "/me/messages/{id}/attachments"),
+            and optionally a "method" (default "GET"), "headers" and
+            a json "body".
+
+        batch_size : int (optional, Default=20)
+            The number of sub-requests per `/$batch` call.
+
+        ### Returns:
+        ----
+        List[Dict]:
+            One dictionary per request with its "status", "headers"
+            and "body".
+
+        ### Usage:
+        ----
+            >>> graph_session.make_batch_request(
+                    batch_requests=[
+                        {"url": "/me/mailFolders/inbox"},
+                        {"url": "/me/mailFolders/sentitems"}
+                    ]
+                )
+        """
+
+        results = [None] * len(batch_requests)
+        pending = list(range(len(batch_requests)))
+        attempt = 0
+
+        while pending:
+            retry = []
+            retry_after = None
+            throttled = False
+
+            for start in range(0, len(pending), batch_size):
+                chunk = pending[start:start + batch_size]
+
+                sub_requests = []
+                for index in chunk:
+                    batch_request = batch_requests[index]
+                    sub_request = {
+                        "id": str(index),
+                        "method": batch_request.get("method", "GET").upper(),
+                        "url": batch_request["url"]
+                    }
+                    headers = dict(batch_request.get("headers", {}))
+                    if "body" in batch_request:
+                        sub_request["body"] = batch_request["body"]
+                        headers.setdefault("Content-Type", "application/json")
+                    if headers:
+                        sub_request["headers"] = headers
+                    sub_requests.append(sub_request)
+
+                # Every sub-request counts against the request budget,
+                # make_request takes the token for the batch itself.
+                if len(chunk) > 1:
+                    self.rate_limiter.acquire(tokens=len(chunk) - 1)
+
+                content = self.make_request(
+                    method="post",
+                    endpoint="/$batch",
+                    json={"requests": sub_requests}
+                )
+
+                for sub_response in content[1]["responses"]:
+                    index = int(sub_response["id"])
+                    status = sub_response["status"]
+                    headers = sub_response.get("headers", {})
+
+                    if (
+                        self.retry_policy.should_retry(status)
+                        and attempt < self.retry_policy.max_retries
+                    ):
+                        retry.append(index)
+                        if status == 429 or status == 503:
+                            throttled = True
+                            self.retry_stats.increment("throttles")
+                        wait = self.retry_policy.parse_retry_after(
+                            headers.get("Retry-After")
+                        )
+                        if wait is not None:
+                            retry_after = max(wait, retry_after or 0)
+                    else:
+                        results[index] = {
+                            "status": status,
+                            "headers": headers,
+                            "body": sub_response.get("body")
+                        }
+
+            if retry:
+                delay = self.retry_policy.compute_delay(attempt, retry_after)
+                if throttled:
+                    self.rate_limiter.pause(delay)
+                self.retry_stats.increment("retries", len(retry))
+                time.sleep(delay)
+                attempt += 1
+
+            pending = sorted(retry)
+
+        return results
\ No newline at end of file
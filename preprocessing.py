@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+This module runs the CPU bound preprocessing of the raw emails, the html to
+text conversion of extract_email_info, strip_quoted_reply and normalize_text,
+across a pool of processes.
+
+Functions:
+    preprocess_email
+    preprocess_emails
+"""
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from helper_functions import normalize_text
+from helper_functions import strip_quoted_reply
+from microsoft_graph_outlook import MSGraphOutlook
+
+graph = MSGraphOutlook()
+
+
+def preprocess_email(email_content : dict, strip_replies = True) -> dict:
+    """
+    Extracts the email information and normalizes the email message.
+
+    Args:
+        email_content (dict): dictionary of the raw email attributes
+        strip_replies (bool): keep only the new content of the message, without
+        the reply history, signature and disclaimer under it, default True
+
+    Raises:
+        TypeError: If 'email_content' is not a dict
+
+    Returns:
+        dict: dictionary of the processed email attributes, as returned by
+        MSGraphOutlook.extract_email_info, with the 'message' normalized
+
+    Examples:
+        >>> preprocess_email(email_content[0])
+        returns the processed email attributes of the first email
+
+    """
+
+    email_info = graph.extract_email_info(email_content)
+    if strip_replies:
+        email_info['message'] = strip_quoted_reply(email_info['message'])
+    email_info['message'] = normalize_text(email_info['message'])
+
+    return email_info
+
+
+def preprocess_chunk(email_contents : list, strip_replies = True) -> list:
+    """
+    Preprocesses a chunk of emails in a worker process
+    """
+
+    return [preprocess_email(x, strip_replies) for x in email_contents]
+
+
+def preprocess_emails(email_contents, max_workers = None, chunk_size = 200,
+                      max_chunks_in_flight = None, strip_replies = True):
+    """
+    Preprocesses many emails across a pool of processes. The emails are sent
+    to the workers in chunks of 'chunk_size' and read from 'email_contents'
+    only as workers need them, with at most 'max_chunks_in_flight' chunks
+    waiting or being processed, so memory use does not depend on the number
+    of emails. The results come back in the order of 'email_contents'.
+
+    Scripts using it need an `if __name__ == '__main__':` guard, as the
+    workers import the main module on Windows.
+
+    Args:
+        email_contents (iterable): dictionaries of the raw email attributes,
+        e.g. EmailArchive.iter_emails()
+        max_workers (int): number of worker processes, default is the number
+        of cores. 1 preprocesses the emails in this process, without a pool
+        chunk_size (int): number of emails sent to a worker at a time,
+        default 200
+        max_chunks_in_flight (int): number of chunks sent to the workers and
+        not yet returned, default twice the number of workers
+        strip_replies (bool): keep only the new content of the messages, see
+        preprocess_email
+
+    Raises:
+        TypeError: If 'max_workers', 'chunk_size' or 'max_chunks_in_flight'
+        is not an integer
+        ValueError: If 'max_workers', 'chunk_size' or 'max_chunks_in_flight'
+        is less than 1
+
+    Yields:
+        dict: dictionary of the processed email attributes, see
+        preprocess_email
+
+    Examples:
+        >>> email_content_processed = list(preprocess_emails(archive.iter_emails()))
+        preprocesses all archived emails on all cores
+
+    """
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    if max_chunks_in_flight is None:
+        max_chunks_in_flight = 2 * max_workers
+
+    for name, value in [('max workers', max_workers), ('chunk size', chunk_size),
+                        ('max chunks in flight', max_chunks_in_flight)]:
+        if not isinstance(value, int):
+            raise TypeError (f'{name} needs to be an integer')
+        if value < 1:
+            raise ValueError (f'{name} needs to be at least 1')
+
+    email_contents = iter(email_contents)
+
+    if max_workers == 1:
+        for email_content in email_contents:
+            yield preprocess_email(email_content, strip_replies)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = deque()
+
+        while True:
+            #keep the workers busy, without reading ahead more than needed
+            while len(in_flight) < max_chunks_in_flight:
+                chunk = list(islice(email_contents, chunk_size))
+                if len(chunk) == 0:
+                    break
+                in_flight.append(executor.submit(preprocess_chunk, chunk, strip_replies))
+
+            if len(in_flight) == 0:
+                break
+
+            #the oldest chunk first, so the results stay in order
+            for email_info in in_flight.popleft().result():
+                yield email_info
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+This module memoizes the query embeddings and named entities of find_email,
+so that a query asked again, or asked with a different spacing or final
+punctuation, does not call the models again. The embeddings are also shared
+by queries that only differ in case.
+
+Classes:
+    QueryCache
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache (object):
+
+    """
+    A least recently used cache of query results, keyed by the kind of
+    result, the model and the normalized query. Only the embeddings are keyed
+    by the query in lower case, the named entities depend on the case of the
+    query, e.g. 'Wei Fong' and 'wei fong'. Results older than 'ttl' seconds
+    are computed again. With a 'path', every new result is appended
+    to a json lines file, from which the cache is loaded in the next session.
+    """
+
+    def __init__ (self, max_entries = 1024, ttl = 86400, path = None) -> None:
+        """
+        Creates the cache, loading it from 'path' if the file exists.
+
+        Args:
+            max_entries (int): maximum number of results kept, the least
+            recently used are evicted first, default 1024. 0 turns the cache
+            off
+            ttl (float): seconds a result is kept, default 86400 (a day). None
+            keeps the results until they are evicted
+            path (str): json lines file every new result is appended to,
+            default None to only keep it in memory
+
+        Raises:
+            TypeError: If 'max_entries' is not an integer, or 'path' is not a
+            string
+
+        Returns:
+            None
+
+        Examples:
+            >>> query_cache = QueryCache(path = 'data/query_cache.jsonl')
+            >>> find_email("martin's farewell", 5, df, df_long, query_cache = query_cache)
+            >>> find_email("Martin's farewell?", 5, df, df_long, query_cache = query_cache)
+            the second search does not call the models
+
+        """
+
+        if not isinstance(max_entries, int):
+            raise TypeError ('Max entries needs to be an integer')
+
+        if path is not None and not isinstance(path, str):
+            raise TypeError ('Path needs to be a string')
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+        if path is not None and os.path.exists(path):
+            self._load()
+
+    def __len__ (self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def normalize (query : str, lower_case = True) -> str:
+        """
+        Normalizes a query: single spaces, no final punctuation and, unless
+        'lower_case' is False, lower case.
+
+        Args:
+            query (str): the query
+            lower_case (bool): also lower the case of the query, default True
+
+        Returns:
+            str: the normalized query
+
+        Examples:
+            >>> QueryCache.normalize("  Martin's   farewell? ")
+            returns "martin's farewell"
+            >>> QueryCache.normalize("  Martin's   farewell? ", lower_case = False)
+            returns "Martin's farewell"
+
+        """
+
+        if lower_case:
+            query = query.lower()
+
+        return ' '.join(query.split()).rstrip('?.! ')
+
+    def get (self, kind : str, query : str, model : str):
+        """
+        Looks up a result.
+
+        Args:
+            kind (str): the kind of result, e.g. 'embedding' or 'ner'
+            query (str): the query
+            model (str): the model or deployment the result is from
+
+        Returns:
+            the result, None if it is not in the cache or has expired
+
+        """
+
+        key = self._key(kind, query, model)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[1]
+
+    def put (self, kind : str, query : str, model : str, value) -> None:
+        """
+        Stores a result, see get. The result needs to be json serializable
+        when the cache has a path.
+        """
+
+        if self.max_entries == 0:
+            return
+
+        with self._lock:
+            key = self._key(kind, query, model)
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            self._evict()
+
+            if self.path is not None:
+                self._append(key, self._entries[key])
+
+    def get_or_compute (self, kind : str, query : str, model : str, function):
+        """
+        Looks up a result, computing and storing it if it is not in the cache.
+
+        Args:
+            kind (str): the kind of result, e.g. 'embedding' or 'ner'
+            query (str): the query
+            model (str): the model or deployment the result is from
+            function (callable): computes the result, without arguments
+
+        Returns:
+            the result
+
+        Examples:
+            >>> query_cache.get_or_compute('ner', query, 'gpt-35-turbo', lambda: get_NER(labels, query))
+            returns the named entities of the query
+
+        """
+
+        value = self.get(kind, query, model)
+        if value is None:
+            value = function()
+            self.put(kind, query, model, value)
+
+        return value
+
+    def stats (self) -> dict:
+        """
+        Gets the number of results in the cache and the hits and misses since
+        it was created.
+
+        Returns:
+            dict: entries, hits, misses and hit_rate
+
+        """
+
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups > 0 else 0.0
+        }
+
+    def clear (self) -> None:
+        """
+        Removes all results from the cache, and from its file
+        """
+
+        with self._lock:
+            self._entries.clear()
+            if self.path is not None:
+                self._write()
+
+    def _key (self, kind : str, query : str, model : str) -> str:
+
+        """
+        Key of a result, as a string so the cache can be saved as json. Only
+        the embeddings ignore the case of the query
+        """
+
+        return '\n'.join([kind, model, self.normalize(query, lower_case = kind == 'embedding')])
+
+    def _evict (self) -> None:
+
+        """
+        Removes the least recently used results over max_entries
+        """
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load (self) -> None:
+
+        """
+        Replays the file, the last line of a key wins, and rewrites it
+        without the replaced, expired and evicted results
+        """
+
+        lines = 0
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    key, stored, value = json.loads(line)
+                except ValueError:
+                    #a line cut short by a crash
+                    continue
+                lines = lines + 1
+                self._entries[key] = (stored, value)
+                self._entries.move_to_end(key)
+
+        if self.ttl is not None:
+            now = time.time()
+            for key in [x for x, (stored, _) in self._entries.items() if now - stored > self.ttl]:
+                del self._entries[key]
+        self._evict()
+
+        if lines > len(self._entries):
+            self._write()
+
+    def _append (self, key : str, entry : tuple) -> None:
+
+        """
+        Appends one result to the file
+        """
+
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps([key, entry[0], entry[1]]) + '\n')
+
+    def _write (self) -> None:
+
+        """
+        Writes all the results, oldest first, replacing the file in one step
+        """
+
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as file:
+            for key, (stored, value) in self._entries.items():
+                file.write(json.dumps([key, stored, value]) + '\n')
+        os.replace(self.path + '.tmp', self.path)
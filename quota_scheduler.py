@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+This module paces the Azure OpenAI calls of helper_functions against the
+requests per minute and tokens per minute quotas of a deployment, and retries
+the calls throttled with a 429 after the wait the service asks for.
+
+Classes:
+    QuotaScheduler
+"""
+import re
+import threading
+import time
+
+import openai
+
+from ms_graph.retry_GBNOC import RetryPolicy
+from ms_graph.retry_GBNOC import RetryStats
+from ms_graph.retry_GBNOC import TokenBucket
+
+#one part of an x-ratelimit-reset-* header, e.g. '6m0s', '1s' or '20ms'
+reset_part_pattern = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+RESET_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+class QuotaScheduler (object):
+
+    """
+    Paces calls to one Azure OpenAI deployment under its quotas, with one
+    token bucket for the requests per minute and one for the tokens per
+    minute, shared by all the threads making calls. Azure OpenAI enforces the
+    quotas over short windows, so each bucket holds at most 10 seconds of its
+    budget and bursts are spread out instead of being rejected.
+
+    A throttled call holds back every caller for the wait taken from the
+    retry-after-ms, retry-after or x-ratelimit-reset-* headers of the 429,
+    or an exponential backoff without them, and is tried again. Server
+    errors and connection errors are retried the same way, holding back only
+    the call that failed.
+    """
+
+    def __init__ (self, requests_per_minute = None, tokens_per_minute = None,
+                  retry_policy = None, name = 'azure openai') -> None:
+        """
+        Creates a scheduler for one deployment.
+
+        Args:
+            requests_per_minute (int): the requests per minute quota, default
+            None for no pacing of the requests
+            tokens_per_minute (int): the tokens per minute quota, default None
+            for no pacing of the tokens
+            retry_policy (RetryPolicy): how many times and after how long a
+            throttled call is retried, default RetryPolicy()
+            name (str): the name of the deployment, used in the report
+
+        Raises:
+            ValueError: If 'requests_per_minute' or 'tokens_per_minute' is not
+            more than 0
+
+        Returns:
+            None
+
+        Examples:
+            >>> scheduler = QuotaScheduler(requests_per_minute = 720, tokens_per_minute = 120000)
+            >>> scheduler.run(lambda: client.embeddings.create(input = texts, model = model), tokens = 2400)
+            returns the response, once the quotas allow it
+            >>> scheduler.report()
+            returns the throughput achieved
+
+        """
+
+        for value in [requests_per_minute, tokens_per_minute]:
+            if value is not None and value <= 0:
+                raise ValueError ('Requests and tokens per minute need to be more than 0')
+
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.name = name
+        self.retry_stats = RetryStats()
+
+        self._request_bucket = None
+        if requests_per_minute is not None:
+            self._request_bucket = TokenBucket(rate=requests_per_minute / 60,
+                                               capacity=max(1, requests_per_minute / 6))
+
+        self._token_bucket = None
+        if tokens_per_minute is not None:
+            self._token_bucket = TokenBucket(rate=tokens_per_minute / 60,
+                                             capacity=max(1, tokens_per_minute / 6))
+
+        self._lock = threading.Lock()
+        self._started = None
+        self._requests = 0
+        self._tokens = 0
+        self._waited = 0.0
+
+    def run (self, function, tokens = 0):
+        """
+        Calls 'function' once the quotas allow it, retrying it while it is
+        throttled.
+
+        Args:
+            function (callable): the call to make, without arguments
+            tokens (int): the estimated number of tokens of the call. When the
+            result has a usage, e.g. a chat completion, the tokens used above
+            the estimate are also taken from the budget. The budget is taken
+            once, the retries of a throttled call are not charged again
+
+        Raises:
+            openai.APIStatusError: If the call still fails with a status of
+            the retry policy, e.g. 429, after its retries, or fails with
+            another status
+            openai.APIConnectionError: If the call still cannot connect after
+            the retries of the retry policy
+
+        Returns:
+            the result of 'function'
+
+        """
+
+        #the budget is taken once per call, retries of a rejected call are not
+        #charged again
+        self._wait(tokens)
+
+        attempt = 0
+        while True:
+            try:
+                result = function()
+            except (openai.APIStatusError, openai.APIConnectionError) as e:
+                throttled = isinstance(e, openai.RateLimitError)
+                if isinstance(e, openai.APIStatusError):
+                    if not self.retry_policy.should_retry(e.status_code):
+                        raise
+                    if throttled:
+                        self.retry_stats.increment('throttles')
+                else:
+                    self.retry_stats.increment('connection_errors')
+
+                if attempt >= self.retry_policy.max_retries:
+                    self.retry_stats.increment('give_ups')
+                    raise
+
+                retry_after = None
+                if isinstance(e, openai.APIStatusError):
+                    retry_after = self.parse_reset(e.response.headers)
+                delay = self.retry_policy.compute_delay(attempt, retry_after)
+
+                #a throttle also holds back every other caller
+                if throttled:
+                    for bucket in [self._request_bucket, self._token_bucket]:
+                        if bucket is not None:
+                            bucket.pause(delay)
+                time.sleep(delay)
+
+                self.retry_stats.increment('retries')
+                attempt = attempt + 1
+                continue
+
+            used_tokens = tokens
+            usage = getattr(result, 'usage', None)
+            if usage is not None and getattr(usage, 'total_tokens', None) is not None:
+                used_tokens = max(tokens, usage.total_tokens)
+                if self._token_bucket is not None and used_tokens > tokens:
+                    #taken without waiting, the next call waits for it
+                    self._token_bucket.reserve(used_tokens - tokens)
+
+            with self._lock:
+                self._requests = self._requests + 1
+                self._tokens = self._tokens + used_tokens
+
+            return result
+
+    def report (self) -> dict:
+        """
+        Gets the throughput achieved since the first call.
+
+        Returns:
+            dict: requests, tokens, seconds, requests_per_minute,
+            tokens_per_minute, waited_seconds, the time spent waiting for the
+            quotas, and the retry counters
+
+        """
+
+        with self._lock:
+            seconds = time.monotonic() - self._started if self._started is not None else 0.0
+            minutes = seconds / 60
+            report = {
+                'name': self.name,
+                'requests': self._requests,
+                'tokens': self._tokens,
+                'seconds': round(seconds, 3),
+                'requests_per_minute': round(self._requests / minutes, 1) if minutes > 0 else 0.0,
+                'tokens_per_minute': round(self._tokens / minutes, 1) if minutes > 0 else 0.0,
+                'waited_seconds': round(self._waited, 3)
+            }
+
+        report.update(self.retry_stats.snapshot())
+        return report
+
+    @staticmethod
+    def parse_reset (headers) -> float:
+        """
+        Gets the wait asked for by a 429 from its headers.
+
+        Args:
+            headers (dict): the headers of the response
+
+        Returns:
+            float: the number of seconds to wait, None if the headers do not
+            say
+
+        """
+
+        if headers is None:
+            return None
+
+        if headers.get('retry-after-ms') is not None:
+            try:
+                return max(0.0, float(headers.get('retry-after-ms')) / 1000)
+            except ValueError:
+                pass
+
+        retry_after = RetryPolicy.parse_retry_after(headers.get('retry-after'))
+        if retry_after is not None:
+            return retry_after
+
+        #the longest of the request and token resets, e.g. '6m0s'
+        resets = []
+        for name in ['x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens']:
+            value = headers.get(name)
+            if value is None:
+                continue
+            parts = reset_part_pattern.findall(value)
+            if len(parts) > 0:
+                resets.append(sum(float(number) * RESET_UNITS[unit] for number, unit in parts))
+
+        return max(resets) if len(resets) > 0 else None
+
+    def _wait (self, tokens : int) -> None:
+
+        """
+        Blocks until the request and token budgets allow one more call
+        """
+
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+
+        wait = 0.0
+        if self._request_bucket is not None:
+            wait = max(wait, self._request_bucket.reserve(1))
+        if self._token_bucket is not None and tokens > 0:
+            wait = max(wait, self._token_bucket.reserve(tokens))
+
+        if wait > 0:
+            time.sleep(wait)
+            with self._lock:
+                self._waited = self._waited + wait